@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+上游调用准入控制
+按 (模型, 上游 origin) 划分通道，每个通道限制同时在途的请求数；
+超出时在通道内排队，按用户做加权公平排队 (start-time fair queuing)，
+一个用户连续提交大量请求不会饿死其他用户；队列已满时立即拒绝并给出预计等待时间
+"""
+
+import asyncio
+import hashlib
+import heapq
+import itertools
+import math
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional
+
+from .deadline import Deadline
+from .http_pool import origin_of
+
+# 没有历史数据时假定的单次调用耗时 (秒)，用于估算等待时间
+DEFAULT_SERVICE_SECONDS = 30.0
+
+
+class AdmissionRejected(Exception):
+    """队列已满或排队超时；retry_after 为建议的重试等待秒数"""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+@dataclass
+class AdmissionClient:
+    """排队身份: 同一 user 的请求在公平排队中视为一个流，weight 越大分到的份额越多"""
+    user: str
+    weight: float = 1.0
+
+
+ANONYMOUS = AdmissionClient("anonymous")
+
+# 调用链通过准入 (排队放行或无需排队) 时的回调，见 on_admitted
+_admitted_callback: ContextVar[Optional[Callable[[], None]]] = ContextVar("admitted_callback", default=None)
+
+
+@contextmanager
+def on_admitted(callback: Callable[[], None]):
+    """
+    在此上下文中 (含在其中创建的 asyncio 任务) 的上游调用每次通过准入时调用 callback，
+    供耗时统计与对冲计时排除排队时间
+    """
+    token = _admitted_callback.set(callback)
+    try:
+        yield
+    finally:
+        _admitted_callback.reset(token)
+
+
+def _notify_admitted():
+    callback = _admitted_callback.get()
+    if callback:
+        callback()
+
+
+class _Ticket:
+    __slots__ = ("lane", "user", "start", "finish", "grant", "granted", "cancelled", "admitted_at")
+
+    def __init__(self, lane: "_Lane", user: str, grant: Callable[[], None]):
+        self.lane = lane
+        self.user = user
+        self.start = 0.0
+        self.finish = 0.0
+        self.grant = grant
+        self.granted = False
+        self.cancelled = False
+        self.admitted_at = 0.0
+
+
+class _Lane:
+    """一个 (模型, origin) 通道"""
+
+    def __init__(self, model: str, origin: str, limit: int):
+        self.model = model
+        self.origin = origin
+        self.limit = limit
+        self.in_flight = 0
+        self.waiting = 0
+        self.heap: List = []
+        self.virtual_time = 0.0
+        self.user_finish: Dict[str, float] = {}
+        self.service_ewma: Optional[float] = None
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+
+    def estimate_wait(self, position: int) -> float:
+        service = self.service_ewma or DEFAULT_SERVICE_SECONDS
+        return service * math.ceil(position / max(1, self.limit))
+
+    def to_dict(self) -> Dict:
+        return {
+            "model": self.model,
+            "origin": self.origin,
+            "limit": self.limit,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "avg_service": round(self.service_ewma, 2) if self.service_ewma is not None else None,
+            "estimated_wait": round(self.estimate_wait(self.waiting + 1), 1) if self.in_flight >= self.limit else 0,
+        }
+
+
+class AdmissionController:
+    """
+    config.json -> admission:
+      - max_in_flight: 每个通道同时在途的上游请求数
+      - models: 按模型覆盖 max_in_flight，如 {"gemini-3-pro-image-preview": 4}
+      - max_queue: 每个通道最多排队的请求数，超出立即拒绝 (503 + Retry-After)
+      - queue_timeout: 最长排队秒数 (同时不超过请求截止时间)
+      - pro_weight: Pro 用户的公平排队权重
+    同步 (批量线程) 与异步 (FastAPI) 调用方共用同一组通道
+    """
+
+    def __init__(self, cfg: Optional[Dict] = None):
+        cfg = cfg or {}
+        self.enabled = bool(cfg.get("enabled", True))
+        self.max_in_flight = int(cfg.get("max_in_flight", 8))
+        self.model_limits = cfg.get("models", {}) or {}
+        self.max_queue = int(cfg.get("max_queue", 32))
+        self.queue_timeout = float(cfg.get("queue_timeout", 60))
+        self.pro_weight = float(cfg.get("pro_weight", 2.0))
+        self.ewma_alpha = float(cfg.get("ewma_alpha", 0.2))
+
+        self._lock = threading.Lock()
+        self._lanes: Dict[tuple, _Lane] = {}
+        self._seq = itertools.count()
+
+    # --- 排队身份 ---
+
+    def client(self, user_id: Optional[int] = None, is_pro: bool = False, api_key: Optional[str] = None) -> AdmissionClient:
+        if user_id is not None:
+            return AdmissionClient(f"user:{user_id}", self.pro_weight if is_pro else 1.0)
+        if api_key:
+            return AdmissionClient("byok:" + hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:12])
+        return ANONYMOUS
+
+    # --- 通道 ---
+
+    def _lane(self, model: str, base_url: str) -> _Lane:
+        origin = origin_of(base_url)
+        key = (model or "", origin)
+        lane = self._lanes.get(key)
+        if lane is None:
+            limit = int(self.model_limits.get(model or "", self.max_in_flight))
+            lane = self._lanes[key] = _Lane(model or "", origin, max(1, limit))
+        return lane
+
+    def _enqueue(self, model: str, base_url: str, client: AdmissionClient, grant: Callable[[], None]) -> _Ticket:
+        with self._lock:
+            lane = self._lane(model, base_url)
+            ticket = _Ticket(lane, client.user, grant)
+
+            if lane.in_flight < lane.limit and lane.waiting == 0:
+                self._admit(lane, ticket)
+                return ticket
+
+            if lane.waiting >= self.max_queue:
+                lane.rejected += 1
+                wait = lane.estimate_wait(lane.waiting + 1)
+                raise AdmissionRejected(f"上游繁忙 ({lane.model})，预计等待 {wait:.0f} 秒", wait)
+
+            # 公平排队: 该用户的新请求排在其上一个请求之后，权重越大间隔越小
+            ticket.start = max(lane.virtual_time, lane.user_finish.get(client.user, 0.0))
+            ticket.finish = ticket.start + 1.0 / max(client.weight, 0.01)
+            lane.user_finish[client.user] = ticket.finish
+            heapq.heappush(lane.heap, (ticket.finish, next(self._seq), ticket))
+            lane.waiting += 1
+            return ticket
+
+    def _admit(self, lane: _Lane, ticket: _Ticket):
+        ticket.granted = True
+        ticket.admitted_at = time.monotonic()
+        lane.in_flight += 1
+        lane.admitted += 1
+
+    def _dispatch(self, lane: _Lane):
+        """在锁内调用: 有空位时按 finish 顺序放行排队的请求"""
+        while lane.heap and lane.in_flight < lane.limit:
+            _, _, ticket = heapq.heappop(lane.heap)
+            if ticket.cancelled:
+                continue
+            lane.waiting -= 1
+            lane.virtual_time = ticket.start
+            self._admit(lane, ticket)
+            ticket.grant()
+
+        # 清理已经落后于虚拟时间的用户记录
+        if len(lane.user_finish) > 256:
+            lane.user_finish = {u: f for u, f in lane.user_finish.items() if f > lane.virtual_time}
+
+    def _release(self, ticket: _Ticket):
+        with self._lock:
+            lane = ticket.lane
+            lane.in_flight -= 1
+            held = time.monotonic() - ticket.admitted_at
+            if lane.service_ewma is None:
+                lane.service_ewma = held
+            else:
+                lane.service_ewma += self.ewma_alpha * (held - lane.service_ewma)
+            self._dispatch(lane)
+
+    def _cancel(self, ticket: _Ticket) -> bool:
+        """放弃排队；返回 False 表示在此之前已被放行 (调用方需正常执行并释放)"""
+        with self._lock:
+            if ticket.granted:
+                return False
+            ticket.cancelled = True
+            ticket.lane.waiting -= 1
+            ticket.lane.timed_out += 1
+            return True
+
+    def _timeout(self, deadline: Optional[Deadline]) -> float:
+        remaining = deadline.remaining() if deadline else None
+        return self.queue_timeout if remaining is None else max(0.0, min(self.queue_timeout, remaining))
+
+    def _timed_out(self, ticket: _Ticket) -> AdmissionRejected:
+        wait = ticket.lane.estimate_wait(ticket.lane.waiting + 1)
+        return AdmissionRejected(f"排队超时 ({ticket.lane.model})，预计还需等待 {wait:.0f} 秒", wait)
+
+    # --- 对外接口 ---
+
+    @contextmanager
+    def admit(self, model: str, base_url: str, client: Optional[AdmissionClient] = None, deadline: Deadline = None):
+        """同步调用方 (线程) 使用"""
+        if not self.enabled:
+            _notify_admitted()
+            yield
+            return
+
+        event = threading.Event()
+        ticket = self._enqueue(model, base_url, client or ANONYMOUS, event.set)
+        if not ticket.granted and not event.wait(self._timeout(deadline)):
+            if self._cancel(ticket):
+                raise self._timed_out(ticket)
+        _notify_admitted()
+        try:
+            yield
+        finally:
+            self._release(ticket)
+
+    @asynccontextmanager
+    async def aadmit(self, model: str, base_url: str, client: Optional[AdmissionClient] = None, deadline: Deadline = None):
+        """异步调用方使用 (放行通知可能来自其他线程)"""
+        if not self.enabled:
+            _notify_admitted()
+            yield
+            return
+
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+
+        def grant():
+            loop.call_soon_threadsafe(lambda: granted.done() or granted.set_result(True))
+
+        ticket = self._enqueue(model, base_url, client or ANONYMOUS, grant)
+        if not ticket.granted:
+            try:
+                await asyncio.wait_for(asyncio.shield(granted), self._timeout(deadline))
+            except asyncio.TimeoutError:
+                if self._cancel(ticket):
+                    raise self._timed_out(ticket)
+            except asyncio.CancelledError:
+                # 客户端断开: 已放行则归还名额
+                if not self._cancel(ticket):
+                    self._release(ticket)
+                raise
+        _notify_admitted()
+        try:
+            yield
+        finally:
+            self._release(ticket)
+
+    def snapshot(self) -> List[Dict]:
+        with self._lock:
+            return [lane.to_dict() for lane in self._lanes.values()]
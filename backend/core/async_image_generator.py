@@ -0,0 +1,659 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+异步图片生成引擎
+与 ImageGenerator 共用配置、Key 与请求构建逻辑，网络 I/O 基于 httpx.AsyncClient，
+供 FastAPI 的 async 接口直接 await，不再阻塞事件循环
+"""
+
+import asyncio
+import json
+import os
+import threading
+import time
+from dataclasses import replace
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple, Union
+
+import httpx
+
+from .admission import AdmissionClient, AdmissionRejected, on_admitted
+from .deadline import Deadline
+from .generation_options import GenerationOptions
+from .hedging import AdmittedClock
+from .http_pool import HTTPPool
+from .image_io import DataURIExtractor, DownloadedImage, ImageDownloadError, ImageSink
+from .image_generator import ImageGenerator, get_image_generator
+from .request_body import StreamingJSONBody, contains_streamed
+from .router import STYLE_CHAT, STYLE_IMAGES, Provider
+
+# 响应体攒够这么多字节后整批交给线程写盘 (解码 / 计算摘要 / 写文件不占用事件循环)
+WRITE_BATCH_BYTES = 1024 * 1024
+
+
+class _TrackedStream(httpx.AsyncByteStream):
+    """响应体读完或关闭时通知客户端该请求已结束"""
+
+    def __init__(self, stream: httpx.AsyncByteStream, on_close: Callable[[], None]):
+        self._stream = stream
+        self._on_close = on_close
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self._stream.aclose()
+        finally:
+            on_close, self._on_close = self._on_close, None
+            if on_close:
+                on_close()
+
+
+class TrackedAsyncClient(httpx.AsyncClient):
+    """
+    记录在途请求数与最近一次请求完成时间的 AsyncClient
+    stream=True 的请求在响应关闭后才算结束 (关闭 AsyncClient 会中断其上仍在读取的响应)
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.in_flight = 0
+        self.last_active = time.time()
+
+    def _finished(self):
+        self.in_flight -= 1
+        self.last_active = time.time()
+
+    async def send(self, request: httpx.Request, *, stream: bool = False, **kwargs) -> httpx.Response:
+        self.in_flight += 1
+        try:
+            response = await super().send(request, stream=stream, **kwargs)
+        except BaseException:
+            self._finished()
+            raise
+        if not stream or response.is_closed:
+            self._finished()
+        else:
+            response.stream = _TrackedStream(response.stream, self._finished)
+        return response
+
+
+async def _settle_in_thread(func: Callable, *args):
+    """
+    在线程中完成落盘 (写文件 / 重命名)；任务被取消时仍等线程执行完再抛出 CancelledError，
+    保证取消返回后不会再有文件被写入 (对冲落败一方的临时文件可以放心删除)
+    """
+    future = asyncio.ensure_future(asyncio.to_thread(func, *args))
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        await asyncio.wait({future})
+        if not future.cancelled():
+            future.exception()
+        raise
+
+
+class AsyncHTTPPool(HTTPPool):
+    """HTTPPool 的 httpx.AsyncClient 版本 (同样按 origin 划分)"""
+
+    def _create_client(self, maxsize: int):
+        return TrackedAsyncClient(
+            limits=httpx.Limits(
+                max_connections=None,
+                max_keepalive_connections=maxsize,
+                keepalive_expiry=self.idle_timeout,
+            ),
+            follow_redirects=True,
+        )
+
+    def _close_client(self, client):
+        # 淘汰发生在同步代码路径中，交给事件循环异步关闭
+        try:
+            asyncio.get_running_loop().create_task(client.aclose())
+        except RuntimeError:
+            pass
+
+    async def aprewarm(self, count: int = None) -> int:
+        count = self.prewarm_connections if count is None else count
+        if count <= 0 or not self.system_base_url:
+            return 0
+
+        client = self.client_for(self.system_base_url)
+        results = await asyncio.gather(
+            *[client.head(self.system_base_url, timeout=5) for _ in range(count)],
+            return_exceptions=True,
+        )
+        warmed = sum(1 for r in results if not isinstance(r, Exception))
+        print(f"🔥 连接预热完成: {warmed}/{count} -> {self.system_origin}")
+        return warmed
+
+    async def aclose(self):
+        for client in self._drain_clients():
+            try:
+                await client.aclose()
+            except Exception:
+                pass
+
+
+class AsyncImageGenerator:
+    """ImageGenerator 的异步对应版本"""
+
+    def __init__(self, generator: ImageGenerator = None):
+        self.generator = generator or get_image_generator()
+        self.http_pool = AsyncHTTPPool(self.generator.config.get("http", {}), system_base_url=self.generator.base_url,
+                                       provider_base_urls=self.generator.router.base_urls())
+
+    @property
+    def model(self) -> str:
+        return self.generator.model
+
+    @property
+    def config(self) -> Dict:
+        return self.generator.config
+
+    async def prewarm_connections(self, count: int = None) -> int:
+        return await self.http_pool.aprewarm(count)
+
+    async def aclose(self):
+        await self.http_pool.aclose()
+
+    # --- 请求 ---
+
+    async def _execute_raw_request(self, url: str, headers: Dict, data: Dict, timeout: float = None, stream: bool = False) -> Optional[httpx.Response]:
+        """执行单次请求 (stream=True 时不预先读取响应体)"""
+        try:
+            print(f"🚀 发送请求到: {url}")
+            print(f"   模型: {data.get('model')}")
+
+            client = self.http_pool.client_for(url)
+            # 含参考图的请求体以 chunked 方式流式发送
+            body = {"content": StreamingJSONBody(data).aiter()} if contains_streamed(data) else {"json": data}
+            request = client.build_request(
+                "POST",
+                url,
+                headers=headers,
+                timeout=timeout or self.generator.timeout,
+                **body
+            )
+            return await client.send(request, stream=stream)
+        except Exception as e:
+            print(f"❌ 请求异常: {e}")
+            return None
+
+    async def _make_request(self, endpoint: str, data: Dict, base_url: str = None, api_key: str = None, model: str = None, deadline: Deadline = None, stream: bool = False, provider: Provider = None) -> Union[Dict, httpx.Response, None]:
+        """
+        发送API请求 (支持多Key轮询)，重试等待使用 asyncio.sleep，总耗时受 deadline 约束
+        stream=True 时成功返回未读取的 Response (由调用方读取并关闭)
+        """
+        gen = self.generator
+        deadline = deadline or Deadline()
+        current_base_url = provider.base_url if provider else (base_url or gen.base_url).rstrip("/")
+
+        if provider and provider.model:
+            data["model"] = provider.model
+        elif model:
+            data["model"] = model
+
+        url = f"{current_base_url}{endpoint}"
+        rate_model = data.get("model")
+        keys_to_try = gen._resolve_keys(api_key, model, provider)
+        scheduled = not api_key and any(keys_to_try)
+        if scheduled:
+            keys_to_try = gen.key_rate.order(keys_to_try, rate_model)
+
+        for key_idx, current_key in enumerate(keys_to_try):
+            headers = gen._build_headers(current_key)
+            last_key = key_idx == len(keys_to_try) - 1
+
+            for attempt in range(gen.max_retries + 1):
+                if deadline.expired():
+                    print("⏱️ 已超过请求截止时间，放弃")
+                    return None
+
+                wait = gen._rate_reserve(current_key, rate_model, scheduled, last_key, deadline)
+                if wait is None:
+                    print(f"🚦 Key #{key_idx} 暂无令牌余量，换下一个 Key")
+                    break
+                if wait > 0:
+                    print(f"🚦 等待限速令牌 {wait:.1f}s")
+                    await asyncio.sleep(wait)
+
+                started = gen._key_acquire(current_key, scheduled)
+                try:
+                    response = await self._execute_raw_request(url, headers, data, timeout=deadline.timeout(gen.timeout), stream=stream)
+                except BaseException:
+                    # CancelledError (对冲落败、客户端断开) 不是 Exception，必须在这里归还 Key 占用
+                    gen._key_cancel(current_key, scheduled)
+                    raise
+                gen._key_release(current_key, scheduled, response.status_code if response is not None else None, started)
+                gen._rate_observe(current_key, rate_model, scheduled, response)
+
+                if response is None:
+                    delay = deadline.backoff(attempt, gen.backoff_base, gen.backoff_max)
+                    if delay is None:
+                        print("⏱️ 剩余时间不足以重试，放弃")
+                        return None
+                    await asyncio.sleep(delay)
+                    continue
+
+                if response.status_code == 200:
+                    return response if stream else response.json()
+
+                if stream:
+                    # 错误响应体很小，读完以便连接回到连接池
+                    await response.aread()
+
+                if response.status_code == 429 and last_key and attempt < gen.max_retries:
+                    print("🚦 429 Too Many Requests，等待后重试同一 Key")
+                    continue
+
+                if response.status_code in gen.KEY_SWITCH_STATUSES:
+                    print(f"⚠️ Key #{key_idx} failed with {response.status_code}. Trying next key...")
+                    break
+
+                if response.status_code in gen.SAME_KEY_RETRY_STATUSES:
+                    delay = deadline.backoff(attempt, gen.backoff_base, gen.backoff_max)
+                    if delay is None:
+                        print("⏱️ 剩余时间不足以重试，放弃")
+                        return None
+                    print(f"🔄 正在重试 ({attempt + 1}/{gen.max_retries})...")
+                    await asyncio.sleep(delay)
+                    continue
+
+                print(f"❌ API请求失败: {response.status_code}")
+                print(f"   响应: {response.text}")
+                return None
+
+        print("❌ All keys failed.")
+        return None
+
+    # --- 对外接口 (与 ImageGenerator 同名同参) ---
+
+    async def _read_chat_image(self, response: httpx.Response, save_path: str, extract: Callable[[Optional[Dict]], Optional[str]], deadline: Deadline = None) -> Union[DownloadedImage, str, None]:
+        """流式读取 Chat 响应，内联图片边读边解码落盘 (见 ImageGenerator._read_chat_image)"""
+        gen = self.generator
+        deadline = deadline or Deadline()
+        extractor = DataURIExtractor(save_path, gen.max_download_bytes)
+        try:
+            try:
+                buffer = bytearray()
+                async for chunk in response.aiter_bytes(gen.download_chunk_size):
+                    if deadline.expired():
+                        raise ImageDownloadError("读取响应超过请求截止时间")
+                    buffer += chunk
+                    if len(buffer) >= WRITE_BATCH_BYTES:
+                        data, buffer = bytes(buffer), bytearray()
+                        await _settle_in_thread(extractor.feed, data)
+                if buffer:
+                    await _settle_in_thread(extractor.feed, bytes(buffer))
+            finally:
+                await response.aclose()
+            image = await _settle_in_thread(extractor.finish)
+        except asyncio.CancelledError:
+            # 对冲请求中落败被取消
+            extractor.abort()
+            raise
+        except Exception as e:
+            extractor.abort()
+            print(f"❌ 读取 Chat 响应失败: {e}")
+            return None
+
+        if image:
+            print(f"✅ 内联图片已流式解码保存 ({image.size} bytes)")
+            return image
+
+        try:
+            body = json.loads(bytes(extractor.residual))
+        except ValueError as e:
+            print(f"❌ Chat 响应解析失败: {e}")
+            return None
+        return extract(body)
+
+    async def _generate_image_via_chat(self, prompt: str, options: GenerationOptions, base_url: str = None, api_key: str = None, model: str = None, deadline: Deadline = None, save_path: str = None, provider: Provider = None) -> Union[DownloadedImage, str, None]:
+        data = self.generator._build_chat_image_payload(prompt, options.size, options.quality, model=model)
+        if save_path:
+            response = await self._make_request("/v1/chat/completions", data, base_url=base_url, api_key=api_key, model=model, deadline=deadline, stream=True, provider=provider)
+            return await self._read_chat_image(response, save_path, self.generator._extract_chat_image, deadline) if response is not None else None
+        response = await self._make_request("/v1/chat/completions", data, base_url=base_url, api_key=api_key, model=model, deadline=deadline, provider=provider)
+        return self.generator._extract_chat_image(response)
+
+    async def _call_routed(self, model: str, call: Callable[[Optional[Provider]], Awaitable[Union[DownloadedImage, str, None]]], base_url: str = None, api_key: str = None,
+                           client: AdmissionClient = None, deadline: Deadline = None, styles: tuple = None) -> Union[DownloadedImage, str, None]:
+        """按路由表依次尝试上游，失败时切换到下一个 (见 ImageGenerator._call_routed)"""
+        gen = self.generator
+        deadline = deadline or Deadline()
+        providers = gen._route(model, base_url, api_key, styles)
+        rejected = None
+        for idx, provider in enumerate(providers):
+            if idx and deadline.expired():
+                break
+            try:
+                async with gen.admission.aadmit(model, provider.base_url if provider else (base_url or gen.base_url), client, deadline):
+                    if provider is None:
+                        return await call(None)
+                    gen.router.acquire(provider)
+                    started, result = time.monotonic(), None
+                    try:
+                        result = await call(provider)
+                    except asyncio.CancelledError:
+                        # 被取消的调用 (如对冲落败) 不代表上游出错
+                        gen.router.cancel(provider)
+                        raise
+                    except BaseException:
+                        gen.router.release(provider, False, time.monotonic() - started)
+                        raise
+                    gen.router.release(provider, bool(result), time.monotonic() - started)
+            except AdmissionRejected as e:
+                rejected = e
+                continue
+            if result:
+                return result
+            if idx < len(providers) - 1:
+                print(f"🔀 上游 {provider.name} 未成功，切换到下一个上游")
+        if rejected is not None:
+            raise rejected
+        return None
+
+    async def optimize_prompt(self, raw_prompt: str, subject: str = "general", model: str = None, deadline: Deadline = None, client: AdmissionClient = None) -> str:
+        gen = self.generator
+        cache_key = gen._optimize_cache_key(raw_prompt, subject, model)
+        # SQLite 查询放到线程中
+        cached = await asyncio.to_thread(gen.prompt_cache.get, cache_key)
+        if cached:
+            print(f"⚡ 命中优化缓存: {cached[:50]}...")
+            return cached
+
+        data = gen._build_optimize_payload(raw_prompt, subject, model)
+        async with gen.admission.aadmit(data["model"], gen.base_url, client, deadline):
+            response = await self._make_request("/v1/chat/completions", data, model=data["model"], deadline=deadline)
+
+        if response and "choices" in response and len(response["choices"]) > 0:
+            optimized = gen._clean_optimized_prompt(response["choices"][0]["message"]["content"], raw_prompt)
+            if optimized != raw_prompt:
+                await asyncio.to_thread(gen.prompt_cache.put, cache_key, optimized)
+            return optimized
+
+        return raw_prompt
+
+    async def optimize_prompt_stream(self, raw_prompt: str, subject: str = "general", model: str = None, deadline: Deadline = None, client: AdmissionClient = None) -> AsyncIterator[Tuple[str, str]]:
+        """
+        流式优化提示词 (stream: true)
+        依次产出 ("delta", 片段)，最后产出一次 ("done", 清洗后的最终结果)；
+        最终结果同样经过 markdown 图片剔除与过短回退，客户端应以 done 为准替换已显示的内容
+        """
+        gen = self.generator
+        cache_key = gen._optimize_cache_key(raw_prompt, subject, model)
+        cached = await asyncio.to_thread(gen.prompt_cache.get, cache_key)
+        if cached:
+            print(f"⚡ 命中优化缓存: {cached[:50]}...")
+            yield "done", cached
+            return
+
+        data = gen._build_optimize_payload(raw_prompt, subject, model)
+        data["stream"] = True
+        parts = []
+        async with gen.admission.aadmit(data["model"], gen.base_url, client, deadline):
+            response = await self._make_request("/v1/chat/completions", data, model=data["model"], deadline=deadline, stream=True)
+            if response is None:
+                yield "done", raw_prompt
+                return
+
+            try:
+                if "text/event-stream" not in response.headers.get("Content-Type", ""):
+                    # 部分中转商忽略 stream 参数，直接返回完整 JSON
+                    await response.aread()
+                    body = response.json()
+                    if body and body.get("choices"):
+                        parts.append(body["choices"][0]["message"]["content"] or "")
+                else:
+                    async for line in response.aiter_lines():
+                        if not line.startswith("data:"):
+                            continue
+                        payload = line[5:].strip()
+                        if payload == "[DONE]":
+                            break
+                        try:
+                            chunk = json.loads(payload)
+                        except ValueError:
+                            continue
+                        choices = chunk.get("choices") or []
+                        delta = (choices[0].get("delta") or {}).get("content") if choices else None
+                        if delta:
+                            parts.append(delta)
+                            yield "delta", delta
+            except Exception as e:
+                print(f"❌ 流式优化中断: {e}")
+            finally:
+                await response.aclose()
+
+        if not parts:
+            yield "done", raw_prompt
+            return
+
+        optimized = gen._clean_optimized_prompt("".join(parts), raw_prompt)
+        if optimized != raw_prompt:
+            await asyncio.to_thread(gen.prompt_cache.put, cache_key, optimized)
+        yield "done", optimized
+
+    async def generate_modified_image(self, prompt: str, base_image_paths: list[str], base_url: str = None, api_key: str = None, model: str = None, deadline: Deadline = None, save_path: str = None, client: AdmissionClient = None) -> Union[DownloadedImage, str, None]:
+        if not base_image_paths:
+            return None
+
+        gen = self.generator
+        target_model = model or gen.model
+        try:
+            # 参考图缩放 / 重新编码放到线程中，避免大图阻塞事件循环
+            data = await asyncio.to_thread(gen._build_modify_payload, prompt, base_image_paths, target_model)
+        except Exception as e:
+            print(f"❌ 图片修改失败: {e}")
+            return None
+
+        async def call(provider: Optional[Provider]):
+            try:
+                if save_path:
+                    response = await self._make_request("/v1/chat/completions", data, base_url=base_url, api_key=api_key, model=target_model, deadline=deadline, stream=True, provider=provider)
+                    return await self._read_chat_image(response, save_path, gen._extract_modified_image, deadline) if response is not None else None
+                response = await self._make_request("/v1/chat/completions", data, base_url=base_url, api_key=api_key, model=target_model, deadline=deadline, provider=provider)
+                return gen._extract_modified_image(response)
+            except Exception as e:
+                print(f"❌ 图片修改失败: {e}")
+                return None
+
+        # 排队被拒 (AdmissionRejected) 直接抛给调用方
+        return await self._call_routed(target_model, call, base_url, api_key, client, deadline, styles=(STYLE_CHAT, None))
+
+    async def generate_image(self, prompt: str, size: str = None, quality: str = None, style: str = None, base_url: str = None, api_key: str = None, model: str = None, deadline: Deadline = None, save_path: str = None, client: AdmissionClient = None, options: GenerationOptions = None) -> Union[DownloadedImage, str, None]:
+        gen = self.generator
+        options = gen.resolve_options(options, size, quality, style)
+
+        target_model = model or gen.model
+
+        async def call(provider: Optional[Provider]):
+            if gen._use_chat(target_model, provider):
+                print("🤖 检测到 Gemini 绘图模型，切换到 Chat 接口...")
+                return await self._generate_image_via_chat(prompt, options, base_url=base_url, api_key=api_key, model=target_model, deadline=deadline, save_path=save_path, provider=provider)
+
+            data = gen._build_image_payload(prompt, options.size, target_model)
+            response = await self._make_request("/v1/images/generations", data, base_url=base_url, api_key=api_key, model=target_model, deadline=deadline, provider=provider)
+            return gen._extract_image_url(response)
+
+        return await self._call_routed(target_model, call, base_url, api_key, client, deadline)
+
+    async def download_image(self, image_url: str, save_path: str, deadline: Deadline = None) -> Optional[DownloadedImage]:
+        """下载图片到本地 (支持 URL 和 Base64 Data URI)，流式写入临时文件后原子重命名"""
+        gen = self.generator
+        try:
+            print(f"📥 准备保存图片到: {save_path}")
+            os.makedirs(os.path.dirname(save_path), exist_ok=True)
+
+            if image_url.startswith("data:image"):
+                # 大段 base64 解码放到线程中
+                return await _settle_in_thread(gen._save_data_uri, image_url, save_path)
+
+            deadline = deadline or Deadline()
+            if deadline.expired():
+                print("⏱️ 已超过请求截止时间，跳过下载")
+                return None
+            client = self.http_pool.client_for(image_url)
+            async with client.stream("GET", image_url, timeout=deadline.timeout(60)) as response:
+                if not gen._check_download_headers(response.status_code, response.headers):
+                    return None
+                with ImageSink(save_path, gen.max_download_bytes) as sink:
+                    buffer = bytearray()
+                    async for chunk in response.aiter_bytes(gen.download_chunk_size):
+                        if deadline.expired():
+                            raise ImageDownloadError("下载超过请求截止时间")
+                        buffer += chunk
+                        if len(buffer) >= WRITE_BATCH_BYTES:
+                            data, buffer = bytes(buffer), bytearray()
+                            await _settle_in_thread(sink.write, data)
+                    if buffer:
+                        await _settle_in_thread(sink.write, bytes(buffer))
+                    image = await _settle_in_thread(sink.commit)
+            print(f"✅ 下载成功 ({image.size} bytes)")
+            return image
+        except Exception as e:
+            print(f"❌ 下载异常: {e}")
+            return None
+
+    async def _run_hedged(self, model: str, save_path: str, attempt: Callable[[str, Optional[str], Optional[str]], Awaitable[Optional[DownloadedImage]]],
+                          base_url: str = None, api_key: str = None, deadline: Deadline = None) -> Optional[DownloadedImage]:
+        """
+        执行 attempt(path, base_url, api_key)；原始请求通过准入排队后，超过该模型近期耗时的分位数仍未完成时，
+        向另一个 Key / 备用中转再发一次。可能对冲时两者各写各的临时路径，先成功者移到 save_path，另一个取消并删除
+        """
+        policy = self.generator.hedging
+        deadline = deadline or Deadline()
+        delay = policy.delay_for(model) if not api_key else None
+        base, ext = os.path.splitext(save_path)
+
+        # 耗时样本与对冲计时都从原始请求通过准入时开始 (排队时发出的对冲只会排进同一个队列)
+        clock = AdmittedClock()
+        admitted = asyncio.Event()
+
+        def mark_admitted():
+            clock()
+            admitted.set()
+
+        primary_path = f"{base}.primary{ext}" if delay is not None else save_path
+        with on_admitted(mark_admitted):
+            primary = asyncio.create_task(attempt(primary_path, base_url, api_key))
+        tasks = {primary: primary_path}
+        winner, image, elapsed = None, None, 0.0
+        try:
+            if delay is not None:
+                waiter = asyncio.create_task(admitted.wait())
+                try:
+                    await asyncio.wait({primary, waiter}, return_when=asyncio.FIRST_COMPLETED)
+                finally:
+                    waiter.cancel()
+                if not primary.done():
+                    await asyncio.wait({primary}, timeout=delay)
+                remaining = deadline.remaining()
+                if not primary.done() and (remaining is None or remaining > delay) and policy.try_hedge(model):
+                    hedge_path = f"{base}.hedge{ext}"
+                    print(f"🪁 生成超过 {delay:.1f}s 未完成，发出对冲请求 ({model})")
+                    tasks[asyncio.create_task(attempt(hedge_path, policy.base_url or base_url, policy.api_key))] = hedge_path
+
+            pending = set(tasks)
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                # 同时完成时优先采用原始请求
+                for task in tasks:
+                    if task in done and not task.cancelled() and task.exception() is None and task.result():
+                        winner, image, elapsed = task, task.result(), clock.elapsed()
+                        break
+        finally:
+            losers = [task for task in tasks if task is not winner and not task.done()]
+            for task in losers:
+                task.cancel()
+            await asyncio.gather(*losers, return_exceptions=True)
+
+        # 落败一方 (已完成或被取消) 的临时文件；落盘在取消前已等待完成，不会之后再写入
+        for task, path in tasks.items():
+            if task is not winner and path != save_path:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+        if image is None:
+            # 原始请求的异常 (如排队被拒) 照常抛给调用方
+            if not primary.cancelled() and primary.exception() is not None:
+                raise primary.exception()
+            return None
+        if image.path != save_path:
+            os.replace(image.path, save_path)
+            image = replace(image, path=save_path)
+        if winner is not primary:
+            policy.hedge_won(model)
+            print("🪁 对冲请求胜出")
+        policy.record(model, elapsed)
+        return image
+
+    async def generate_to_file(self, prompt: str, save_path: str, base_url: str = None, api_key: str = None, model: str = None, deadline: Deadline = None, client: AdmissionClient = None, options: GenerationOptions = None) -> Optional[DownloadedImage]:
+        async def attempt(path: str, url: Optional[str], key: Optional[str]) -> Optional[DownloadedImage]:
+            result = await self.generate_image(prompt, base_url=url, api_key=key, model=model, deadline=deadline, save_path=path, client=client, options=options)
+            if result and not isinstance(result, DownloadedImage):
+                result = await self.download_image(result, path, deadline=deadline)
+            return result or None
+
+        return await self._run_hedged(model or self.generator.model, save_path, attempt, base_url, api_key, deadline)
+
+    async def modify_to_file(self, prompt: str, base_image_paths: list[str], save_path: str, base_url: str = None, api_key: str = None, model: str = None, deadline: Deadline = None, client: AdmissionClient = None) -> Optional[DownloadedImage]:
+        async def attempt(path: str, url: Optional[str], key: Optional[str]) -> Optional[DownloadedImage]:
+            result = await self.generate_modified_image(prompt, base_image_paths, base_url=url, api_key=key, model=model, deadline=deadline, save_path=path, client=client)
+            if result and not isinstance(result, DownloadedImage):
+                result = await self.download_image(result, path, deadline=deadline)
+            return result or None
+
+        return await self._run_hedged(model or self.generator.model, save_path, attempt, base_url, api_key, deadline)
+
+    async def generate_images(self, prompt: str, n: int, base_url: str = None, api_key: str = None, model: str = None, deadline: Deadline = None, client: AdmissionClient = None, options: GenerationOptions = None) -> List[str]:
+        gen = self.generator
+        options = gen.resolve_options(options)
+        target_model = model or gen.model
+
+        async def call(provider: Optional[Provider]):
+            if gen._use_chat(target_model, provider):
+                return []
+            data = gen._build_image_payload(prompt, options.size, target_model, n=n)
+            response = await self._make_request("/v1/images/generations", data, base_url=base_url, api_key=api_key, model=target_model, deadline=deadline, provider=provider)
+            return gen._extract_image_urls(response)
+
+        return await self._call_routed(target_model, call, base_url, api_key, client, deadline, styles=(STYLE_IMAGES, None)) or []
+
+    async def generate_variants_to_files(self, prompt: str, save_paths: List[str], base_url: str = None, api_key: str = None, model: str = None, deadline: Deadline = None, client: AdmissionClient = None, options: GenerationOptions = None) -> List[Optional[DownloadedImage]]:
+        """见 ImageGenerator.generate_variants_to_files"""
+        gen = self.generator
+        target_model = model or gen.model
+        n = len(save_paths)
+        urls = []
+        if n > 1 and gen._supports_multi_n(target_model):
+            urls = await self.generate_images(prompt, n, base_url=base_url, api_key=api_key, model=target_model, deadline=deadline, client=client, options=options)
+            gen._note_multi_n(target_model, n, len(urls))
+
+        async def fill(idx: int) -> Optional[DownloadedImage]:
+            if idx < len(urls):
+                return await self.download_image(urls[idx], save_paths[idx], deadline=deadline)
+            return await self.generate_to_file(prompt, save_paths[idx], base_url=base_url, api_key=api_key, model=target_model, deadline=deadline, client=client, options=options)
+
+        return list(await asyncio.gather(*(fill(idx) for idx in range(n))))
+
+    async def generate_and_download(self, prompt: str, filename: str, folder: str = "generated_images", base_url: str = None, api_key: str = None, model: str = None, deadline: Deadline = None, options: GenerationOptions = None) -> Optional[str]:
+        image = await self.generate_to_file(prompt, os.path.join(folder, filename), base_url=base_url, api_key=api_key, model=model, deadline=deadline, options=options)
+        return image.path if image else None
+
+
+# 单例辅助函数
+_async_generator_instance: Optional[AsyncImageGenerator] = None
+_async_generator_lock = threading.Lock()
+
+def get_async_image_generator() -> AsyncImageGenerator:
+    global _async_generator_instance
+    if _async_generator_instance is None:
+        with _async_generator_lock:
+            if _async_generator_instance is None:
+                _async_generator_instance = AsyncImageGenerator()
+    return _async_generator_instance
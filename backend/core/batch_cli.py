@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+无交互的批量生成命令行 (适合 cron / systemd)
+从 CSV 或 JSONL 文件读取提示词，按需逐行展开组合 (任务列表不驻留内存)，
+并发生成并把每个结果逐行写入 JSONL 清单；支持断点续跑
+
+用法 (在 backend 目录下):
+  python -m core.batch_cli prompts.csv [more.jsonl ...] --output-dir out/ \\
+      [--systems systems.csv] [--concurrency 8] [--model MODEL] [--size 1024x1024] \\
+      [--manifest out/manifest.jsonl] [--batch-id NAME] [--no-resume]
+
+提示词文件每行 (CSV 以表头为字段名) 字段:
+  prompt (必填)、id、filename、model、system (该行专用的系统提示词，替换 --systems 列表)
+系统提示词文件字段: key、prompt；提供时每个系统提示词与每行提示词组合
+id 或 filename 重复时报错退出
+"""
+
+import argparse
+import csv
+import json
+import os
+import re
+import sys
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from .batch_executor import BatchExecutor, BatchProgress, TaskResult
+from .batch_image_generator import GenerationTask
+from .batch_journal import FAILED, SUCCEEDED, BatchJournal, prompt_hash
+from .generation_options import GenerationOptions
+from .image_generator import get_image_generator
+
+
+def iter_rows(path: str) -> Iterator[Tuple[int, Dict]]:
+    """逐行读取 CSV / JSONL，产出 (行号, 字段)；空行与无法解析的行跳过"""
+    is_csv = path.lower().endswith(".csv")
+    with open(path, "r", encoding="utf-8-sig", newline="" if is_csv else None) as f:
+        if is_csv:
+            for line_no, row in enumerate(csv.DictReader(f), start=2):
+                yield line_no, {k.strip(): (v or "").strip() for k, v in row.items() if k}
+            return
+        for line_no, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                print(f"⚠️ {path}:{line_no} 不是有效的 JSON，已跳过")
+                continue
+            yield line_no, row if isinstance(row, dict) else {"prompt": str(row)}
+
+
+def load_systems(path: Optional[str]) -> List[Tuple[str, str]]:
+    """系统提示词 (数量很少，整体读入)"""
+    if not path:
+        return [("", "")]
+    systems = [(str(row.get("key") or f"s{line_no}"), str(row.get("prompt") or "")) for line_no, row in iter_rows(path)]
+    return systems or [("", "")]
+
+
+def _safe_name(value: str) -> str:
+    return re.sub(r"[^\w.-]+", "_", value).strip("_")[:120] or "task"
+
+
+def source_names(paths: List[str]) -> List[str]:
+    """各输入文件在任务 id 中使用的名字: 文件名 (含扩展名)；不同目录下的同名文件加序号区分"""
+    names = [_safe_name(os.path.basename(path)) for path in paths]
+    return [f"{name}_{idx + 1}" if names.count(name) > 1 else name for idx, name in enumerate(names)]
+
+
+def _row_task(source: str, line_no: int, row: Dict, sys_key: str = "") -> Optional[Tuple[str, str, str]]:
+    """一行提示词对应的 (任务 id, 文件名, 提示词)；没有提示词时返回 None"""
+    prompt = str(row.get("prompt") or "").strip()
+    if not prompt:
+        return None
+    task_id = str(row.get("id") or f"{source}_{line_no}")
+    if sys_key:
+        task_id = f"{sys_key}_{task_id}"
+    filename = row.get("filename") or f"{_safe_name(task_id)}.png"
+    if sys_key and row.get("filename"):
+        filename = f"{_safe_name(sys_key)}_{filename}"
+    return task_id, filename, prompt
+
+
+def iter_tasks(paths: List[str], systems: List[Tuple[str, str]], output_dir: str) -> Iterator[GenerationTask]:
+    """
+    惰性展开 系统提示词 × 提示词行；每个系统提示词重新流式读取一遍提示词文件
+    任务 id 默认为 文件名_行号 (如 unit3.csv_12，加系统提示词键名)，同一文件重新运行时保持不变
+    行内给出 system 时替换整个系统提示词列表: 该行只生成一次，id 与文件名不加系统提示词前缀
+    """
+    sources = source_names(paths)
+    for pass_idx, (sys_key, sys_prompt) in enumerate(systems):
+        for path, source in zip(paths, sources):
+            for line_no, row in iter_rows(path):
+                own_system = str(row.get("system") or "")
+                if own_system and pass_idx:
+                    continue
+                task = _row_task(source, line_no, row, "" if own_system else sys_key)
+                if task is None:
+                    continue
+                task_id, filename, prompt = task
+                yield GenerationTask(
+                    id=task_id,
+                    system_prompt=own_system or sys_prompt,
+                    requirement_prompt=prompt,
+                    filename=filename,
+                    folder=output_dir,
+                    model=row.get("model") or None
+                )
+
+
+def find_duplicates(paths: List[str]) -> List[str]:
+    """
+    流式检查重复的任务 id 与输出文件名 (重复时断点记录与输出文件会互相覆盖)
+    只在内存中保留 id 与文件名集合
+    """
+    seen_ids, seen_files, duplicates = set(), set(), []
+    for path, source in zip(paths, source_names(paths)):
+        for line_no, row in iter_rows(path):
+            task = _row_task(source, line_no, row)
+            if task is None:
+                continue
+            task_id, filename, _ = task
+            if task_id in seen_ids:
+                duplicates.append(f"{path}:{line_no} id 重复: {task_id}")
+            if filename in seen_files:
+                duplicates.append(f"{path}:{line_no} filename 重复: {filename}")
+            seen_ids.add(task_id)
+            seen_files.add(filename)
+    return duplicates
+
+
+def count_tasks(paths: List[str], systems: List[Tuple[str, str]]) -> int:
+    """预先流式数一遍行数，用于进度与剩余时间估计 (行内给出 system 的行只计一次)"""
+    shared, own = 0, 0
+    for path in paths:
+        for _, row in iter_rows(path):
+            if not str(row.get("prompt") or "").strip():
+                continue
+            if row.get("system"):
+                own += 1
+            else:
+                shared += 1
+    return shared * len(systems) + own
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="从 CSV / JSONL 文件批量生成图片 (无交互)")
+    parser.add_argument("inputs", nargs="+", help="提示词文件 (.csv 或 .jsonl)")
+    parser.add_argument("--systems", help="系统提示词文件 (.csv 或 .jsonl，字段 key / prompt)")
+    parser.add_argument("--output-dir", required=True, help="图片输出目录")
+    parser.add_argument("--manifest", help="结果清单 (JSONL，默认 <output-dir>/manifest.jsonl)")
+    parser.add_argument("--concurrency", type=int, help="每个模型的并发数 (默认 config.json -> batch.concurrency)")
+    parser.add_argument("--model", help="默认模型 (提示词行可单独指定 model)")
+    parser.add_argument("--size", help="图片尺寸，如 1024x1024")
+    parser.add_argument("--quality", help="画质")
+    parser.add_argument("--style", help="风格")
+    parser.add_argument("--batch-id", help="断点日志名 (默认按输入文件与模型生成)")
+    parser.add_argument("--no-resume", action="store_true", help="忽略断点日志，全部重新生成")
+    parser.add_argument("--no-count", action="store_true", help="不预先统计任务数 (不显示剩余时间)")
+    return parser.parse_args(argv)
+
+
+def run(args: argparse.Namespace) -> int:
+    for path in args.inputs + ([args.systems] if args.systems else []):
+        if not os.path.exists(path):
+            print(f"❌ 文件不存在: {path}")
+            return 2
+
+    duplicates = find_duplicates(args.inputs)
+    if duplicates:
+        for line in duplicates[:20]:
+            print(f"❌ {line}")
+        if len(duplicates) > 20:
+            print(f"   … 共 {len(duplicates)} 处重复")
+        print("请为这些行指定不同的 id / filename")
+        return 2
+
+    generator = get_image_generator()
+    batch_cfg = dict(generator.config.get("batch", {}))
+    if args.concurrency:
+        batch_cfg["concurrency"] = args.concurrency
+    executor = BatchExecutor(generator, batch_cfg)
+    options = GenerationOptions(size=args.size, quality=args.quality, style=args.style)
+    model = args.model or generator.model
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    manifest_path = args.manifest or os.path.join(args.output_dir, "manifest.jsonl")
+    systems = load_systems(args.systems)
+    total = None if args.no_count else count_tasks(args.inputs, systems)
+    progress = BatchProgress(total)
+
+    run_id = args.batch_id or BatchJournal.make_run_id(
+        [os.path.abspath(p) for p in args.inputs], os.path.abspath(args.systems) if args.systems else None,
+        os.path.abspath(args.output_dir), model
+    )
+    journal_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data", "batch_journals")
+    journal = BatchJournal.for_run(journal_dir, run_id)
+
+    def hash_of(task: GenerationTask) -> str:
+        return prompt_hash(task.get_full_prompt(), task.model or model, options)
+
+    print(f"🚀 批量 {run_id}: {total if total is not None else '?'} 个任务，并发 {executor.concurrency_for(model)}，输出 {args.output_dir}")
+    # 同步连接池 (批量线程使用) 按 http.prewarm_connections 预先建立连接
+    generator.prewarm_connections()
+    started = time.time()
+    with open(manifest_path, "a", encoding="utf-8") as manifest:
+        def write(entry: Dict):
+            manifest.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            manifest.flush()
+
+        def on_skip(task: GenerationTask, entry: Dict):
+            progress.task_skipped()
+            write({"task_id": task.id, "success": True, "skipped": True, "file_path": entry.get("output_path"), "sha256": entry.get("sha256")})
+
+        tasks = iter_tasks(args.inputs, systems, args.output_dir)
+        if not args.no_resume:
+            tasks = journal.pending(tasks, hash_of, on_skip)
+
+        # 结果只按完成顺序写出，不在内存中保留任务列表
+        prompts: Dict[str, Tuple[str, str]] = {}
+
+        def remember(source: Iterator[GenerationTask]) -> Iterator[GenerationTask]:
+            for task in source:
+                prompts[task.id] = (task.get_full_prompt(), hash_of(task))
+                yield task
+
+        try:
+            for result in executor.execute(remember(tasks), total=total, model=model, options=options, progress=progress):
+                prompt, task_hash = prompts.pop(result.task_id, ("", ""))
+                _record(journal, write, result, prompt, task_hash)
+        except KeyboardInterrupt:
+            print("\n⏹️ 已中断，重新运行同一命令可从断点继续")
+            return 130
+        finally:
+            journal.close()
+
+    snapshot = progress.snapshot()
+    print(f"\n批量生成完成！总耗时 {time.time() - started:.1f}秒，成功 {snapshot['succeeded']}，失败 {snapshot['failed']}，跳过 {snapshot['skipped']}")
+    print(f"   结果清单: {manifest_path}")
+    return 1 if snapshot["failed"] else 0
+
+
+def _record(journal: BatchJournal, write, result: TaskResult, prompt: str, task_hash: str):
+    journal.record(
+        result.task_id,
+        task_hash,
+        SUCCEEDED if result.success else FAILED,
+        output_path=result.file_path,
+        sha256=result.image.sha256 if result.image else None,
+        error=result.error
+    )
+    write({
+        "task_id": result.task_id,
+        "prompt": prompt,
+        "model": result.model,
+        "success": result.success,
+        "file_path": result.file_path,
+        "sha256": result.image.sha256 if result.image else None,
+        "bytes": result.image.size if result.image else None,
+        "error": result.error,
+        "elapsed": result.elapsed,
+    })
+
+
+def main(argv: Optional[List[str]] = None):
+    sys.exit(run(parse_args(argv)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+批量生成执行器
+按模型限制并发，多个任务同时调用上游；Key 调度、限速、准入排队与路由沿用 ImageGenerator，
+批量总耗时取决于上游可用的承载能力而不是任务数。
+任务以迭代器方式按需取出 (同时在途的任务数有上限)，结果按完成顺序逐个产出
+"""
+
+import collections
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, Iterator, Optional
+
+from .admission import AdmissionClient, AdmissionRejected
+from .generation_options import GenerationOptions
+from .image_generator import ImageGenerator
+from .image_io import DownloadedImage
+
+
+@dataclass
+class TaskResult:
+    """单个批量任务的执行结果"""
+    task_id: str
+    success: bool
+    file_path: Optional[str] = None
+    error: Optional[str] = None
+    elapsed: float = 0.0
+    image: Optional[DownloadedImage] = None
+    model: Optional[str] = None
+
+
+class BatchProgress:
+    """
+    批量进度: 完成数、在途数、吞吐量与预计剩余时间
+    吞吐量按最近 window 个任务的完成时间计算 (并发执行时比 "完成数 / 总耗时" 更能反映当前速度)
+    """
+
+    def __init__(self, total: Optional[int] = None, window: int = 20):
+        self.total = total
+        self.started_at = time.time()
+        self.done = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.skipped = 0
+        self.in_flight = 0
+        self._finished_at = collections.deque(maxlen=max(2, window))
+        self._lock = threading.Lock()
+
+    def task_started(self):
+        with self._lock:
+            self.in_flight += 1
+
+    def task_finished(self, success: bool):
+        with self._lock:
+            self.in_flight = max(0, self.in_flight - 1)
+            self.done += 1
+            if success:
+                self.succeeded += 1
+            else:
+                self.failed += 1
+            self._finished_at.append(time.time())
+
+    def task_skipped(self):
+        """已完成 (如断点续跑) 而跳过的任务，不计入吞吐量"""
+        with self._lock:
+            self.skipped += 1
+
+    def throughput(self) -> Optional[float]:
+        """每分钟完成的任务数"""
+        with self._lock:
+            return self._throughput(time.time())
+
+    def _throughput(self, now: float) -> Optional[float]:
+        # 窗口未满时 (刚开始、并发任务几乎同时完成) 用整体平均，避免估计值剧烈波动
+        if len(self._finished_at) == self._finished_at.maxlen and self._finished_at[-1] > self._finished_at[0]:
+            return (len(self._finished_at) - 1) / (self._finished_at[-1] - self._finished_at[0]) * 60
+        if self.done and now > self.started_at:
+            return self.done / (now - self.started_at) * 60
+        return None
+
+    def snapshot(self) -> Dict:
+        now = time.time()
+        with self._lock:
+            rate = self._throughput(now)
+            remaining = self.total - self.done - self.skipped if self.total is not None else None
+            eta = remaining / rate * 60 if rate and remaining is not None else None
+            return {
+                "total": self.total,
+                "done": self.done,
+                "succeeded": self.succeeded,
+                "failed": self.failed,
+                "skipped": self.skipped,
+                "in_flight": self.in_flight,
+                "elapsed": round(now - self.started_at, 1),
+                "throughput_per_min": round(rate, 2) if rate else None,
+                "eta_seconds": round(eta) if eta is not None else None,
+            }
+
+
+class BatchExecutor:
+    """
+    config.json -> batch:
+      - concurrency: 每个模型同时执行的任务数 (默认 4)
+      - models: 按模型覆盖并发数，如 {"gemini-3-pro-image-preview": 2}
+      - requeue_attempts: 上游排队被拒时等待 Retry-After 后重新排队的次数
+      - admission_weight: 批量任务在上游公平排队中的权重 (默认 0.5，优先保证在线请求)
+    批量任务之间不再固定休眠，上游限速由 Key 调度器与限速器处理
+    """
+
+    def __init__(self, generator: ImageGenerator, cfg: Optional[Dict] = None):
+        cfg = cfg or {}
+        self.generator = generator
+        self.concurrency = max(1, int(cfg.get("concurrency", 4)))
+        self.model_concurrency = {m: max(1, int(n)) for m, n in (cfg.get("models", {}) or {}).items()}
+        self.requeue_attempts = int(cfg.get("requeue_attempts", 3))
+        self.client = AdmissionClient("batch", float(cfg.get("admission_weight", 0.5)))
+
+        self._lock = threading.Lock()
+        self._semaphores: Dict[str, threading.Semaphore] = {}
+
+    def concurrency_for(self, model: str) -> int:
+        return self.model_concurrency.get(model, self.concurrency)
+
+    def _semaphore(self, model: str) -> threading.Semaphore:
+        with self._lock:
+            semaphore = self._semaphores.get(model)
+            if semaphore is None:
+                semaphore = self._semaphores[model] = threading.Semaphore(self.concurrency_for(model))
+            return semaphore
+
+    def run_task(self, task, model: Optional[str] = None, options: Optional[GenerationOptions] = None,
+                 progress: Optional[BatchProgress] = None) -> TaskResult:
+        """执行单个任务 (在所属模型的并发额度内)"""
+        target_model = getattr(task, "model", None) or model or self.generator.model
+        save_path = os.path.join(task.folder, task.filename)
+        with self._semaphore(target_model):
+            if progress:
+                progress.task_started()
+            started = time.time()
+            image, error = None, None
+            for attempt in range(self.requeue_attempts + 1):
+                try:
+                    image = self.generator.generate_to_file(
+                        task.get_full_prompt(),
+                        save_path,
+                        model=target_model,
+                        deadline=self.generator.deadline_for("generate"),
+                        client=self.client,
+                        options=options
+                    )
+                    error = None if image else "图片生成失败"
+                    break
+                except AdmissionRejected as e:
+                    error = str(e)
+                    if attempt < self.requeue_attempts:
+                        print(f"⏳ 任务 {task.id} 排队被拒，{e.retry_after:.0f}s 后重新排队")
+                        time.sleep(max(1.0, e.retry_after))
+                except Exception as e:
+                    error = f"任务执行异常: {e}"
+                    break
+            result = TaskResult(
+                task_id=task.id,
+                success=image is not None,
+                file_path=image.path if image else None,
+                error=error,
+                elapsed=round(time.time() - started, 1),
+                image=image,
+                model=target_model
+            )
+            if progress:
+                progress.task_finished(result.success)
+            return result
+
+    def execute(self, tasks: Iterable, total: Optional[int] = None, model: Optional[str] = None,
+                options: Optional[GenerationOptions] = None,
+                on_progress: Optional[Callable[[TaskResult, Dict], None]] = None,
+                progress: Optional[BatchProgress] = None) -> Iterator[TaskResult]:
+        """
+        并发执行 tasks，按完成顺序产出 TaskResult
+        tasks 可以是惰性的迭代器: 同时取出的任务数不超过线程数的两倍
+        on_progress(result, snapshot): 每个任务完成时调用
+        """
+        progress = progress or BatchProgress(total)
+        workers = self.concurrency_for(model or self.generator.model)
+        workers = max([workers] + list(self.model_concurrency.values()))
+        iterator = iter(tasks)
+        pending = set()
+        exhausted = False
+
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="batch") as pool:
+            try:
+                while True:
+                    while not exhausted and len(pending) < workers * 2:
+                        task = next(iterator, None)
+                        if task is None:
+                            exhausted = True
+                            break
+                        pending.add(pool.submit(self.run_task, task, model, options, progress))
+                    if not pending:
+                        break
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        result = future.result()
+                        snapshot = progress.snapshot()
+                        self._report(result, snapshot)
+                        if on_progress:
+                            on_progress(result, snapshot)
+                        yield result
+            finally:
+                # 调用方提前结束迭代时不再启动排队中的任务
+                for future in pending:
+                    future.cancel()
+
+    @staticmethod
+    def _report(result: TaskResult, snapshot: Dict):
+        total = snapshot["total"]
+        position = f"{snapshot['done'] + snapshot['skipped']}/{total}" if total is not None else str(snapshot["done"])
+        rate = f"{snapshot['throughput_per_min']}/min" if snapshot["throughput_per_min"] else "-"
+        eta = f"{snapshot['eta_seconds']}s" if snapshot["eta_seconds"] is not None else "-"
+        status = f"成功: {result.file_path}" if result.success else f"失败: {result.error}"
+        print(f"   [{position}] {result.task_id} {status} ({result.elapsed}s, 在途 {snapshot['in_flight']}, 吞吐 {rate}, 剩余约 {eta})")
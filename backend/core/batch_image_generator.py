@@ -5,11 +5,14 @@
 支持系统提示词和需求提示词的组合生成
 """
 
+import hashlib
 import json
 import os
 import time
-from typing import Dict, List, Any, Optional
+from typing import Callable, Dict, Iterator, List, Any, Optional
 from dataclasses import dataclass
+from .batch_executor import BatchExecutor, BatchProgress, TaskResult
+from .batch_journal import FAILED, SUCCEEDED, BatchJournal, prompt_hash
 from .image_generator import get_image_generator
 
 @dataclass
@@ -20,6 +23,7 @@ class GenerationTask:
     requirement_prompt: str
     filename: str
     folder: str = "batch_images"
+    model: Optional[str] = None  # 为空时使用批量的默认模型
 
     def get_full_prompt(self) -> str:
         """获取完整的提示词"""
@@ -40,7 +44,10 @@ class BatchImageGenerator:
             config_path = os.path.join(base_dir, "..", "data", "batch_config.json")
             
         self.config_path = config_path
+        # 断点日志目录 (每个批量运行一个 JSONL 文件)
+        self.journal_dir = os.path.join(os.path.dirname(config_path), "batch_journals")
         self.generator = get_image_generator()
+        self.executor = BatchExecutor(self.generator, self.generator.config.get("batch", {}))
         self.system_prompts = {}
         self.requirement_prompts = []
         self.generation_history = []
@@ -138,101 +145,142 @@ class BatchImageGenerator:
             print(f"  {i+1}. {prompt}")
 
     def generate_batch(self, system_key: str = None, requirement_indices: List[int] = None,
-                      custom_combinations: List[Dict] = None) -> Dict[str, Any]:
+                      custom_combinations: List[Dict] = None, model: str = None,
+                      on_progress: Callable[[TaskResult, Dict], None] = None,
+                      batch_id: str = None, resume: bool = True) -> Dict[str, Any]:
         """
-        批量生成图片
+        批量生成图片 (按模型限制并发，见 config.json -> batch)
 
         Args:
             system_key: 系统提示词键名，None表示使用所有系统提示词
             requirement_indices: 需求提示词索引列表，None表示使用所有需求提示词
             custom_combinations: 自定义组合列表 [{"system_key": "xxx", "requirement_index": 0}, ...]
+            model: 使用的模型，None表示默认模型
+            on_progress: 每个任务完成时调用 on_progress(result, 进度快照)
+            batch_id: 断点日志名，None表示按任务列表与模型自动生成 (同一批量重新运行时相同)
+            resume: 是否跳过断点日志中已完成且输出文件校验通过的任务
 
         Returns:
             Dict: 生成结果
         """
         print("\n开始批量生成图片...")
 
-        # 生成任务列表
-        tasks = self._create_tasks(system_key, requirement_indices, custom_combinations)
+        # 先流式数一遍任务 (同时得到断点日志名)，任务列表不驻留内存
+        model_name = model or self.generator.model
+        total = 0
+        ids_digest = hashlib.sha256()
+        for task in self.iter_tasks(system_key, requirement_indices, custom_combinations):
+            total += 1
+            ids_digest.update(task.id.encode("utf-8") + b"\n")
 
-        if not tasks:
+        if not total:
             print("没有找到匹配的生成任务")
             return {"success": False, "message": "没有找到匹配的生成任务"}
 
-        print(f"共 {len(tasks)} 个生成任务")
+        print(f"共 {total} 个生成任务 (并发 {self.executor.concurrency_for(model_name)})")
 
         # 执行批量生成
         results = {
             "success": True,
-            "total_tasks": len(tasks),
+            "total_tasks": total,
             "successful": 0,
             "failed": 0,
+            "skipped": 0,
             "files": {},
             "errors": []
         }
 
         start_time = time.time()
-
-        for i, task in enumerate(tasks):
-            print(f"\n任务 {i+1}/{len(tasks)}: {task.id}")
-            print(f"   系统提示: {task.system_prompt[:50]}...")
-            print(f"   需求提示: {task.requirement_prompt[:50]}...")
-
-            try:
-                # 生成图片
-                file_path = self.generator.generate_and_download(
-                    task.get_full_prompt(),
-                    task.filename,
-                    task.folder
-                )
-
-                if file_path:
-                    results["files"][task.id] = file_path
-                    results["successful"] += 1
-                    print(f"   成功: {file_path}")
-
-                    # 记录到历史
-                    self.generation_history.append({
-                        "id": task.id,
-                        "system_prompt": task.system_prompt,
-                        "requirement_prompt": task.requirement_prompt,
-                        "file_path": file_path,
-                        "timestamp": time.strftime("%Y-%m-%d %H:%M:%S")
-                    })
-                else:
-                    results["failed"] += 1
-                    error_msg = f"图片生成失败: {task.id}"
-                    results["errors"].append(error_msg)
-                    print(f"   失败: {error_msg}")
-
-                # 添加延迟避免API限制
-                if i < len(tasks) - 1:
-                    time.sleep(2)
-
-            except Exception as e:
-                results["failed"] += 1
-                error_msg = f"任务执行异常: {task.id} - {str(e)}"
-                results["errors"].append(error_msg)
-                print(f"   异常: {error_msg}")
+        progress = BatchProgress(total)
+        run_id = batch_id or BatchJournal.make_run_id(ids_digest.hexdigest(), model_name)
+        journal = BatchJournal.for_run(self.journal_dir, run_id)
+        results["batch_id"] = run_id
+
+        def hash_of(task: GenerationTask) -> str:
+            return prompt_hash(task.get_full_prompt(), model_name)
+
+        # 断点续跑: 已完成且输出文件校验通过的任务直接计为成功
+        def on_skip(task: GenerationTask, entry: Dict):
+            results["files"][task.id] = entry["output_path"]
+            results["successful"] += 1
+            results["skipped"] += 1
+            progress.task_skipped()
+
+        tasks = self.iter_tasks(system_key, requirement_indices, custom_combinations)
+        if resume:
+            tasks = journal.pending(tasks, hash_of, on_skip)
+
+        # 只保留在途任务 (task_id -> [任务, 提示词摘要, 同 id 在途数])，完成后移除
+        running: Dict[str, list] = {}
+
+        def remember(source: Iterator[GenerationTask]) -> Iterator[GenerationTask]:
+            for task in source:
+                entry = running.setdefault(task.id, [task, hash_of(task), 0])
+                entry[2] += 1
+                yield task
+
+        executed = 0
+        try:
+            for result in self.executor.execute(remember(tasks), total=total, model=model,
+                                                on_progress=on_progress, progress=progress):
+                entry = running[result.task_id]
+                entry[2] -= 1
+                if not entry[2]:
+                    del running[result.task_id]
+                self._record_result(journal, entry[0], entry[1], result, results)
+                executed += 1
+        finally:
+            journal.close()
 
         # 保存历史记录
         self.save_config()
 
         end_time = time.time()
         duration = end_time - start_time
+        results["duration"] = round(duration, 1)
+        results["throughput_per_min"] = round(executed / duration * 60, 2) if duration > 0 and executed else None
 
         print(f"\n批量生成完成！")
         print(f"   总耗时: {duration:.1f}秒")
         print(f"   成功: {results['successful']}/{results['total_tasks']}")
         print(f"   失败: {results['failed']}")
+        if results["skipped"]:
+            print(f"   断点跳过: {results['skipped']}")
+        if results["throughput_per_min"]:
+            print(f"   吞吐: {results['throughput_per_min']} 张/分钟")
 
         return results
 
-    def _create_tasks(self, system_key: str = None, requirement_indices: List[int] = None,
-                     custom_combinations: List[Dict] = None) -> List[GenerationTask]:
-        """创建生成任务列表"""
-        tasks = []
+    def _record_result(self, journal: BatchJournal, task: GenerationTask, task_hash: str,
+                       result: TaskResult, results: Dict[str, Any]):
+        """把单个任务结果写入断点日志、汇总与历史"""
+        journal.record(
+            task.id,
+            task_hash,
+            SUCCEEDED if result.success else FAILED,
+            output_path=result.file_path,
+            sha256=result.image.sha256 if result.image else None,
+            error=result.error
+        )
+        if result.success:
+            results["files"][task.id] = result.file_path
+            results["successful"] += 1
+
+            # 记录到历史
+            self.generation_history.append({
+                "id": task.id,
+                "system_prompt": task.system_prompt,
+                "requirement_prompt": task.requirement_prompt,
+                "file_path": result.file_path,
+                "timestamp": time.strftime("%Y-%m-%d %H:%M:%S")
+            })
+        else:
+            results["failed"] += 1
+            results["errors"].append(f"{result.error}: {task.id}")
 
+    def iter_tasks(self, system_key: str = None, requirement_indices: List[int] = None,
+                   custom_combinations: List[Dict] = None) -> Iterator[GenerationTask]:
+        """按需逐个产出生成任务 (不预先展开整个笛卡尔积)"""
         if custom_combinations:
             # 使用自定义组合
             for combo in custom_combinations:
@@ -241,14 +289,12 @@ class BatchImageGenerator:
 
                 if (sys_key in self.system_prompts and
                     0 <= req_index < len(self.requirement_prompts)):
-
-                    task = GenerationTask(
+                    yield GenerationTask(
                         id=f"{sys_key}_{req_index}",
                         system_prompt=self.system_prompts[sys_key],
                         requirement_prompt=self.requirement_prompts[req_index],
                         filename=f"{sys_key}_{req_index}.png"
                     )
-                    tasks.append(task)
         else:
             # 使用系统提示词和需求提示词的组合
             if system_key:
@@ -264,15 +310,12 @@ class BatchImageGenerator:
             # 生成笛卡尔积
             for sys_key in system_keys:
                 for req_index in req_indices:
-                    task = GenerationTask(
+                    yield GenerationTask(
                         id=f"{sys_key}_{req_index}",
                         system_prompt=self.system_prompts[sys_key],
                         requirement_prompt=self.requirement_prompts[req_index],
                         filename=f"{sys_key}_{req_index}.png"
                     )
-                    tasks.append(task)
-
-        return tasks
 
     def show_history(self, limit: int = 10):
         """显示生成历史"""
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+批量生成断点日志
+每个批量运行一个只追加的 JSONL 文件，每个任务结束时写入一行
+(任务 id、提示词摘要、输出路径、图片 sha256、状态)；
+中断后重新运行同一批量时跳过已完成且输出文件校验通过的任务，只重跑失败或缺失的任务
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Callable, Dict, Iterable, Iterator, Optional, Tuple
+
+from .image_io import describe_image
+
+# 任务状态
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+
+def prompt_hash(prompt: str, model: Optional[str] = None, options=None) -> str:
+    """提示词与生成参数的摘要: 改动提示词或模型后同 id 的任务会重新生成"""
+    parts = [prompt, model or ""]
+    if options is not None:
+        parts += [options.size or "", options.quality or "", options.style or ""]
+    return hashlib.sha256("\x1f".join(parts).encode("utf-8")).hexdigest()[:16]
+
+
+class BatchJournal:
+    """
+    data/batch_journals/<run_id>.jsonl
+    同一任务有多行时以最后一行为准；读取时忽略写到一半的最后一行 (进程被杀)
+    内存中只保留启动时已成功完成的任务 (task_id -> (提示词摘要, 输出路径, sha256))，
+    失败记录与本次运行新写入的记录只落盘，不驻留内存
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._completed: Dict[str, Tuple[str, Optional[str], Optional[str]]] = {}
+        self._load()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._file = open(path, "a", encoding="utf-8")
+        if self._torn_tail():
+            # 上次写到一半的行单独成行，不影响之后追加的记录
+            self._file.write("\n")
+            self._file.flush()
+
+    def _torn_tail(self) -> bool:
+        if os.path.getsize(self.path) == 0:
+            return False
+        with open(self.path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) != b"\n"
+
+    @classmethod
+    def for_run(cls, journal_dir: str, run_id: str) -> "BatchJournal":
+        return cls(os.path.join(journal_dir, f"{run_id}.jsonl"))
+
+    @staticmethod
+    def make_run_id(*parts) -> str:
+        return hashlib.sha256(json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")).hexdigest()[:16]
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        failed = set()
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                task_id = entry.get("task_id")
+                if not task_id:
+                    continue
+                if entry.get("status") == SUCCEEDED:
+                    self._completed[task_id] = (entry.get("prompt_hash"), entry.get("output_path"), entry.get("sha256"))
+                    failed.discard(task_id)
+                else:
+                    self._completed.pop(task_id, None)
+                    failed.add(task_id)
+        if self._completed or failed:
+            print(f"📒 读取断点日志 {os.path.basename(self.path)}: {len(self._completed)} 个已完成，{len(failed)} 个失败")
+
+    def completed(self, task_id: str, task_prompt_hash: str, output_path: str) -> Optional[Dict]:
+        """
+        任务已成功完成时返回日志记录: 提示词摘要一致，且输出文件存在、sha256 与记录一致
+        (会读取输出文件重新计算摘要)
+        """
+        with self._lock:
+            done = self._completed.get(task_id)
+        if not done or done[0] != task_prompt_hash:
+            return None
+        path = done[1] or output_path
+        if not os.path.exists(path):
+            return None
+        if done[2]:
+            try:
+                if describe_image(path).sha256 != done[2]:
+                    print(f"⚠️ 输出文件与断点记录不一致，重新生成: {path}")
+                    return None
+            except OSError:
+                return None
+        return {"task_id": task_id, "prompt_hash": done[0], "status": SUCCEEDED, "output_path": path, "sha256": done[2]}
+
+    def pending(self, tasks: Iterable, hash_of: Callable[[object], str],
+                on_skip: Optional[Callable[[object, Dict], None]] = None) -> Iterator:
+        """惰性过滤任务: 产出需要执行的任务，已完成的任务交给 on_skip(task, entry)"""
+        for task in tasks:
+            entry = self.completed(task.id, hash_of(task), os.path.join(task.folder, task.filename))
+            if entry is None:
+                yield task
+            elif on_skip:
+                on_skip(task, entry)
+
+    def record(self, task_id: str, task_prompt_hash: str, status: str, output_path: Optional[str] = None,
+               sha256: Optional[str] = None, error: Optional[str] = None):
+        """追加一行并立即落盘 (任务已在本次运行中执行，不再需要保留它的完成记录)"""
+        entry = {
+            "task_id": task_id,
+            "prompt_hash": task_prompt_hash,
+            "status": status,
+            "output_path": output_path,
+            "sha256": sha256,
+            "error": error,
+            "timestamp": time.time(),
+        }
+        line = json.dumps(entry, ensure_ascii=False) + "\n"
+        with self._lock:
+            self._completed.pop(task_id, None)
+            self._file.write(line)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
@@ -60,6 +60,37 @@ class DBManager:
                     timestamp REAL
                 )
             """)
+
+            # Generation Jobs (异步任务队列，重启后继续执行)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    user_id INTEGER,
+                    kind TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    stage TEXT,
+                    request TEXT,
+                    context TEXT,
+                    result TEXT,
+                    error TEXT,
+                    created_at REAL,
+                    updated_at REAL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, created_at)")
+
+            # Generation Result Cache (相同请求复用已生成的图片，指向 GENERATED_DIR 中的文件)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS result_cache (
+                    key TEXT PRIMARY KEY,
+                    filename TEXT NOT NULL,
+                    bytes INTEGER,
+                    sha256 TEXT,
+                    created_at REAL,
+                    last_hit REAL,
+                    hits INTEGER DEFAULT 0
+                )
+            """)
             
             conn.commit()
 
@@ -103,6 +134,16 @@ class DBManager:
             conn.execute("UPDATE users SET quota_used = quota_used + ? WHERE id = ?", (increment, user_id))
             conn.commit()
 
+    def reserve_quota(self, user_id, amount) -> bool:
+        """原子地预留额度: 剩余额度足够时一次性增加 quota_used，返回是否成功"""
+        with self._get_conn() as conn:
+            cursor = conn.execute(
+                "UPDATE users SET quota_used = quota_used + ? WHERE id = ? AND quota_used + ? <= quota_limit",
+                (amount, user_id, amount)
+            )
+            conn.commit()
+            return cursor.rowcount == 1
+
     def check_and_reset_quota(self, user_id):
         """Check if weekly reset is needed"""
         user = self.get_user_by_id(user_id)
@@ -194,3 +235,108 @@ class DBManager:
             if row:
                 return dict(row)
             return None
+
+    # --- Job Management ---
+    @staticmethod
+    def _job_from_row(row) -> Dict:
+        job = dict(row)
+        for field in ("request", "context", "result"):
+            job[field] = json.loads(job[field]) if job[field] else None
+        return job
+
+    def create_job(self, job_id, kind, user_id, request, context=None):
+        now = time.time()
+        with self._get_conn() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, user_id, kind, status, stage, request, context, created_at, updated_at) VALUES (?, ?, ?, 'queued', 'queued', ?, ?, ?, ?)",
+                (job_id, user_id, kind, json.dumps(request, ensure_ascii=False), json.dumps(context or {}), now, now)
+            )
+            conn.commit()
+
+    def update_job(self, job_id, status=None, stage=None, result=None, error=None):
+        fields, params = ["updated_at = ?"], [time.time()]
+        if status is not None:
+            fields.append("status = ?")
+            params.append(status)
+        if stage is not None:
+            fields.append("stage = ?")
+            params.append(stage)
+        if result is not None:
+            fields.append("result = ?")
+            params.append(json.dumps(result, ensure_ascii=False))
+        if error is not None:
+            fields.append("error = ?")
+            params.append(error)
+        params.append(job_id)
+        with self._get_conn() as conn:
+            conn.execute(f"UPDATE jobs SET {', '.join(fields)} WHERE id = ?", params)
+            conn.commit()
+
+    def get_job(self, job_id) -> Optional[Dict]:
+        with self._get_conn() as conn:
+            conn.row_factory = sqlite3.Row
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            return self._job_from_row(row) if row else None
+
+    def get_unfinished_jobs(self) -> List[Dict]:
+        """排队中或执行中的任务 (按提交顺序)，用于重启后恢复"""
+        with self._get_conn() as conn:
+            conn.row_factory = sqlite3.Row
+            rows = conn.execute(
+                "SELECT * FROM jobs WHERE status IN ('queued', 'running') ORDER BY created_at"
+            ).fetchall()
+            return [self._job_from_row(row) for row in rows]
+
+    def delete_finished_jobs(self, kinds, before) -> int:
+        """删除 updated_at 早于 before 的已结束任务 (限定任务类型)，返回删除条数"""
+        kinds = list(kinds)
+        if not kinds:
+            return 0
+        placeholders = ", ".join("?" for _ in kinds)
+        with self._get_conn() as conn:
+            deleted = conn.execute(
+                f"DELETE FROM jobs WHERE status IN ('succeeded', 'failed') AND updated_at < ? AND kind IN ({placeholders})",
+                [before] + kinds
+            ).rowcount
+            conn.commit()
+            return deleted
+
+    # --- Result Cache ---
+    def get_cached_result(self, key, max_age=None) -> Optional[Dict]:
+        now = time.time()
+        with self._get_conn() as conn:
+            conn.row_factory = sqlite3.Row
+            row = conn.execute("SELECT * FROM result_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if max_age and now - row["created_at"] > max_age:
+                conn.execute("DELETE FROM result_cache WHERE key = ?", (key,))
+                conn.commit()
+                return None
+            conn.execute("UPDATE result_cache SET hits = hits + 1, last_hit = ? WHERE key = ?", (now, key))
+            conn.commit()
+            return dict(row)
+
+    def put_cached_result(self, key, filename, size=None, sha256=None):
+        now = time.time()
+        with self._get_conn() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO result_cache (key, filename, bytes, sha256, created_at, last_hit, hits) VALUES (?, ?, ?, ?, ?, ?, 0)",
+                (key, filename, size, sha256, now, now)
+            )
+            conn.commit()
+
+    def delete_cached_result(self, key):
+        with self._get_conn() as conn:
+            conn.execute("DELETE FROM result_cache WHERE key = ?", (key,))
+            conn.commit()
+
+    def purge_result_cache(self) -> int:
+        with self._get_conn() as conn:
+            deleted = conn.execute("DELETE FROM result_cache").rowcount
+            conn.commit()
+            return deleted
+
+    def count_cached_results(self) -> int:
+        with self._get_conn() as conn:
+            return conn.execute("SELECT COUNT(*) FROM result_cache").fetchone()[0]
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+请求截止时间 (Deadline)
+一次用户请求的总耗时预算，贯穿 _make_request / _execute_raw_request / download_image，
+每次重试的超时与退避都不超过剩余预算
+"""
+
+import random
+import time
+from typing import Dict, Optional
+
+# 各接口默认预算 (秒)，可在 config.json -> api.deadlines 中覆盖
+DEFAULT_DEADLINES = {
+    "generate": 180,
+    "modify": 180,
+    "optimize": 45,
+}
+
+# 剩余时间不足该值时不再发起新的尝试
+MIN_ATTEMPT_SECONDS = 1.0
+
+
+class Deadline:
+    """单次请求的截止时间，budget 为 None 表示不限"""
+
+    def __init__(self, budget: Optional[float] = None):
+        self.budget = budget
+        self.expires_at = time.monotonic() + budget if budget else None
+
+    @classmethod
+    def for_endpoint(cls, config: Dict, endpoint: str) -> "Deadline":
+        deadlines = ((config or {}).get("api", {}) or {}).get("deadlines", {}) or {}
+        return cls(deadlines.get(endpoint, DEFAULT_DEADLINES.get(endpoint)))
+
+    def remaining(self) -> Optional[float]:
+        if self.expires_at is None:
+            return None
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        remaining = self.remaining()
+        return remaining is not None and remaining < MIN_ATTEMPT_SECONDS
+
+    def timeout(self, cap: float) -> float:
+        """单次尝试的超时: 不超过 cap，也不超过剩余预算"""
+        remaining = self.remaining()
+        if remaining is None:
+            return cap
+        return max(0.0, min(cap, remaining))
+
+    def backoff(self, attempt: int, base: float = 0.5, cap: float = 8.0) -> Optional[float]:
+        """
+        指数退避 + 全抖动 (full jitter)
+        Returns: 应等待的秒数；等待后已不足以再发起一次尝试时返回 None
+        """
+        delay = random.uniform(0, min(cap, base * (2 ** attempt)))
+        remaining = self.remaining()
+        if remaining is not None and remaining - delay < MIN_ATTEMPT_SECONDS:
+            return None
+        return delay
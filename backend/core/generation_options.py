@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+单次生成的参数 (尺寸 / 画质 / 风格)
+每个请求构造自己的不可变 GenerationOptions 并沿调用链传递，
+共享的 config["image"] 只作为默认值读取，不再被请求改写，多个生成可以安全地并行执行
+"""
+
+from dataclasses import dataclass, replace
+from typing import Dict, Optional
+
+
+@dataclass(frozen=True)
+class GenerationOptions:
+    """为 None 的字段使用 config.json -> image 中的默认值"""
+    size: Optional[str] = None
+    quality: Optional[str] = None
+    style: Optional[str] = None
+
+    @classmethod
+    def from_config(cls, config: Dict) -> "GenerationOptions":
+        image_cfg = (config or {}).get("image", {}) or {}
+        return cls(size=image_cfg.get("size"), quality=image_cfg.get("quality"), style=image_cfg.get("style"))
+
+    def with_defaults(self, defaults: "GenerationOptions") -> "GenerationOptions":
+        """返回用 defaults 补齐空字段后的新对象"""
+        return replace(
+            self,
+            size=self.size if self.size is not None else defaults.size,
+            quality=self.quality if self.quality is not None else defaults.quality,
+            style=self.style if self.style is not None else defaults.style,
+        )
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+对冲请求 (hedged requests)
+中转的耗时长尾明显 (中位数 15 秒，少数 60~90 秒)。按模型统计最近的生成耗时分布，
+一次生成超过该分布的某个分位数仍未完成时，换一个 Key (或备用 base_url) 再发一次，
+先成功的结果胜出，另一个取消；额外调用受预算限制 (最多为正常请求数的一定比例)
+"""
+
+import bisect
+import threading
+import time
+from typing import Dict, List, Optional
+
+# 直方图桶上界 (秒)，按约 1.25 倍递增，覆盖 0.5 秒 ~ 10 分钟
+BUCKET_BOUNDS = [round(0.5 * 1.25 ** i, 2) for i in range(33)]
+
+
+class LatencyHistogram:
+    """单个模型的耗时直方图；样本数达到 decay_every 时整体减半，使分布跟随近期情况"""
+
+    def __init__(self, decay_every: int = 200):
+        self.counts = [0.0] * (len(BUCKET_BOUNDS) + 1)
+        self.total = 0.0
+        self.samples = 0
+        self.decay_every = decay_every
+
+    def record(self, seconds: float):
+        self.counts[bisect.bisect_left(BUCKET_BOUNDS, seconds)] += 1
+        self.total += 1
+        self.samples += 1
+        if self.decay_every and self.samples % self.decay_every == 0:
+            self.counts = [c / 2 for c in self.counts]
+            self.total /= 2
+
+    def percentile(self, q: float) -> Optional[float]:
+        """q 分位数所在桶的上界"""
+        if self.total <= 0:
+            return None
+        target = self.total * q
+        running = 0.0
+        for idx, count in enumerate(self.counts):
+            running += count
+            if running >= target:
+                return BUCKET_BOUNDS[idx] if idx < len(BUCKET_BOUNDS) else BUCKET_BOUNDS[-1]
+        return BUCKET_BOUNDS[-1]
+
+
+class AdmittedClock:
+    """
+    生成耗时的起点: 首次通过准入排队的时刻 (配合 admission.on_admitted 使用)；
+    从未经过准入 (如直连 BYOK) 时为创建时刻
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.admitted = False
+
+    def __call__(self):
+        if not self.admitted:
+            self.admitted = True
+            self.started = time.monotonic()
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+
+class HedgePolicy:
+    """
+    config.json -> hedging:
+      - enabled: 是否启用 (默认 false)
+      - percentile: 超过该模型近期耗时的哪个分位数后发出对冲请求 (默认 0.9)
+      - min_samples: 样本数不足时不对冲
+      - min_delay: 对冲等待的下限 (秒)
+      - budget: 对冲请求数占正常请求数的比例上限 (默认 0.1)
+      - models: 只对这些模型对冲 (为空表示全部)
+      - base_url / api_key: 对冲请求改发到的备用中转 (不配置时用同一 base_url，由 Key 调度器换 Key)
+    自带 Key (BYOK) 的请求不对冲
+    """
+
+    # 预算令牌上限: 允许的短时突发对冲数
+    MAX_TOKENS = 10.0
+
+    def __init__(self, cfg: Optional[Dict] = None):
+        cfg = cfg or {}
+        self.enabled = bool(cfg.get("enabled", False))
+        self.percentile = float(cfg.get("percentile", 0.9))
+        self.min_samples = int(cfg.get("min_samples", 20))
+        self.min_delay = float(cfg.get("min_delay", 5))
+        self.budget = float(cfg.get("budget", 0.1))
+        self.models = set(cfg.get("models", []) or [])
+        self.base_url = (cfg.get("base_url") or "").rstrip("/") or None
+        self.api_key = cfg.get("api_key") or None
+
+        self._lock = threading.Lock()
+        self._histograms: Dict[str, LatencyHistogram] = {}
+        self._tokens = 1.0
+        self._stats: Dict[str, Dict[str, int]] = {}
+
+    def _model_stats(self, model: str) -> Dict[str, int]:
+        stats = self._stats.get(model)
+        if stats is None:
+            stats = self._stats[model] = {"requests": 0, "hedged": 0, "hedge_wins": 0, "over_budget": 0}
+        return stats
+
+    def record(self, model: str, seconds: float):
+        """记录一次成功生成的耗时"""
+        with self._lock:
+            histogram = self._histograms.get(model or "")
+            if histogram is None:
+                histogram = self._histograms[model or ""] = LatencyHistogram()
+            histogram.record(seconds)
+
+    def delay_for(self, model: str) -> Optional[float]:
+        """
+        登记一次请求并返回等待多少秒后发出对冲请求；不对冲时返回 None
+        每次请求为预算积累 budget 个令牌，对冲一次消耗 1 个
+        """
+        if not self.enabled or (self.models and model not in self.models):
+            return None
+        with self._lock:
+            self._model_stats(model)["requests"] += 1
+            self._tokens = min(self.MAX_TOKENS, self._tokens + self.budget)
+            histogram = self._histograms.get(model or "")
+            if histogram is None or histogram.total < self.min_samples:
+                return None
+            return max(self.min_delay, histogram.percentile(self.percentile))
+
+    def try_hedge(self, model: str) -> bool:
+        """预算允许时占用一个令牌"""
+        with self._lock:
+            stats = self._model_stats(model)
+            if self._tokens < 1:
+                stats["over_budget"] += 1
+                return False
+            self._tokens -= 1
+            stats["hedged"] += 1
+            return True
+
+    def hedge_won(self, model: str):
+        with self._lock:
+            self._model_stats(model)["hedge_wins"] += 1
+
+    def snapshot(self) -> List[Dict]:
+        with self._lock:
+            result = []
+            for model in sorted(set(self._histograms) | set(self._stats)):
+                histogram = self._histograms.get(model)
+                entry = {"model": model, "samples": round(histogram.total, 1) if histogram else 0}
+                for q in (0.5, 0.9, 0.99):
+                    entry[f"p{int(q * 100)}"] = histogram.percentile(q) if histogram else None
+                entry.update(self._stats.get(model, {}))
+                result.append(entry)
+            return result
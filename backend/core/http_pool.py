@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+上游 HTTP 连接池
+按 base URL (scheme://host:port) 复用 keep-alive 连接，避免每次请求都重新握手 TCP+TLS
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+def origin_of(url: str) -> str:
+    """提取 URL 的 origin (scheme://netloc)，作为连接池的键"""
+    parts = urlsplit(url or "")
+    return f"{parts.scheme.lower()}://{parts.netloc.lower()}"
+
+
+class TrackedSession(requests.Session):
+    """
+    记录在途请求数与最近一次请求完成时间的 Session，连接池据此判断是否空闲
+    stream=True 的响应在收到响应头时即视为完成: 关闭 Session 只会关闭空闲连接，
+    仍在读取响应体的连接归还时会被直接丢弃，不受影响
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.in_flight = 0
+        self.last_active = time.time()
+        self._activity_lock = threading.Lock()
+
+    def send(self, request, **kwargs):
+        with self._activity_lock:
+            self.in_flight += 1
+        try:
+            return super().send(request, **kwargs)
+        finally:
+            with self._activity_lock:
+                self.in_flight -= 1
+                self.last_active = time.time()
+
+
+class HTTPPool:
+    """
+    按 origin 划分的连接池集合
+
+    - 系统 base_url 独占一个常驻连接池 (pool_maxsize)
+    - 路由表中的上游 (provider_base_urls) 同样使用 pool_maxsize 的连接池，且不参与 LRU 淘汰
+    - 其他 origin (BYOK 的 x-model-base-url、图片 CDN) 使用容量较小的连接池，
+      总数受 byok_max_pools 限制，按 LRU 淘汰
+    - 没有在途请求、且距最近一次请求完成超过 idle_timeout 的连接池会被关闭重建，
+      避免复用已被中转商断开的连接；仍有在途请求的连接池不会被关闭
+    - 超出数量上限而被淘汰、但仍有在途请求的连接池先移出池子，等请求结束后再关闭
+    """
+
+    def __init__(self, http_cfg: Optional[Dict] = None, system_base_url: str = "", provider_base_urls: Optional[List[str]] = None):
+        http_cfg = http_cfg or {}
+        self.pool_maxsize = int(http_cfg.get("pool_maxsize", 32))
+        self.byok_pool_maxsize = int(http_cfg.get("byok_pool_maxsize", 4))
+        self.byok_max_pools = int(http_cfg.get("byok_max_pools", 16))
+        self.idle_timeout = float(http_cfg.get("idle_timeout", 60))
+        self.prewarm_connections = int(http_cfg.get("prewarm_connections", 0))
+
+        self.system_origin = origin_of(system_base_url) if system_base_url else ""
+        self.system_base_url = system_base_url
+        self.provider_origins = {origin_of(u) for u in (provider_base_urls or [])} - {self.system_origin}
+
+        self._lock = threading.Lock()
+        self._system_client = None
+        self._system_last_used = 0.0
+        self._other_clients: "OrderedDict[str, list]" = OrderedDict()  # origin -> [client, last_used]
+        self._retiring: list = []  # 已淘汰、等待在途请求结束后关闭的客户端
+
+    # --- 子类可覆盖: 客户端的创建与释放 ---
+    def _create_client(self, maxsize: int):
+        session = TrackedSession()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=maxsize, max_retries=0)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def _close_client(self, client):
+        try:
+            client.close()
+        except Exception:
+            pass
+
+    @staticmethod
+    def _busy(client) -> bool:
+        return getattr(client, "in_flight", 0) > 0
+
+    def _idle(self, client, last_used: float, now: float) -> bool:
+        """没有在途请求，且距最近一次借出 / 请求完成都已超过 idle_timeout"""
+        if self._busy(client):
+            return False
+        return now - max(last_used, getattr(client, "last_active", 0.0)) > self.idle_timeout
+
+    def _retire(self, client, stale: list):
+        """空闲的客户端立即关闭，仍有在途请求的延后到请求结束"""
+        (self._retiring if self._busy(client) else stale).append(client)
+
+    # --- 获取客户端 ---
+    def client_for(self, url: str):
+        """返回负责该 URL 所在 origin 的客户端 (requests.Session)"""
+        origin = origin_of(url)
+        now = time.time()
+        stale = []
+
+        with self._lock:
+            if self._retiring:
+                stale += [c for c in self._retiring if not self._busy(c)]
+                self._retiring = [c for c in self._retiring if self._busy(c)]
+
+            if origin == self.system_origin:
+                if self._system_client is not None and self._idle(self._system_client, self._system_last_used, now):
+                    stale.append(self._system_client)
+                    self._system_client = None
+                if self._system_client is None:
+                    self._system_client = self._create_client(self.pool_maxsize)
+                self._system_last_used = now
+                client = self._system_client
+            else:
+                entry = self._other_clients.pop(origin, None)
+                if entry is not None and self._idle(entry[0], entry[1], now):
+                    stale.append(entry[0])
+                    entry = None
+                if entry is None:
+                    maxsize = self.pool_maxsize if origin in self.provider_origins else self.byok_pool_maxsize
+                    entry = [self._create_client(maxsize), now]
+                entry[1] = now
+                self._other_clients[origin] = entry
+                client = entry[0]
+
+                # 淘汰空闲过久或超出数量上限的连接池
+                for key in list(self._other_clients.keys()):
+                    if key == origin:
+                        continue
+                    if self._idle(*self._other_clients[key], now):
+                        stale.append(self._other_clients.pop(key)[0])
+                others = [key for key in self._other_clients if key not in self.provider_origins]
+                while len(others) > self.byok_max_pools:
+                    self._retire(self._other_clients.pop(others.pop(0))[0], stale)
+
+        for old in stale:
+            self._close_client(old)
+        return client
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "system_origin": self.system_origin,
+                "system_pool_open": self._system_client is not None,
+                "other_pools": list(self._other_clients.keys()),
+                "retiring_pools": len(self._retiring),
+            }
+
+    # --- 预热 ---
+    def prewarm(self, count: int = None) -> int:
+        """
+        向系统 base_url 预先建立若干条 keep-alive 连接
+        Returns: 成功建立的连接数
+        """
+        count = self.prewarm_connections if count is None else count
+        if count <= 0 or not self.system_base_url:
+            return 0
+
+        session = self.client_for(self.system_base_url)
+
+        def _touch(_):
+            try:
+                session.head(self.system_base_url, timeout=5)
+                return True
+            except Exception:
+                return False
+
+        with ThreadPoolExecutor(max_workers=min(count, self.pool_maxsize)) as executor:
+            warmed = sum(1 for ok in executor.map(_touch, range(count)) if ok)
+        print(f"🔥 连接预热完成: {warmed}/{count} -> {self.system_origin}")
+        return warmed
+
+    def _drain_clients(self) -> list:
+        """取出全部客户端并清空池 (由调用方负责关闭)"""
+        with self._lock:
+            clients = [c for c in [self._system_client] if c is not None]
+            clients += [entry[0] for entry in self._other_clients.values()]
+            clients += self._retiring
+            self._system_client = None
+            self._other_clients.clear()
+            self._retiring = []
+        return clients
+
+    def close(self):
+        for client in self._drain_clients():
+            self._close_client(client)
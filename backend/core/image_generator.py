@@ -7,12 +7,26 @@ Nano Banana (Gemini) 图片生成器
 
 import json
 import requests
+import threading
 import time
-from typing import Dict, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Union
 import os
-import base64
 import re
 
+from .http_pool import HTTPPool
+from .admission import AdmissionClient, AdmissionController, AdmissionRejected, on_admitted
+from .key_scheduler import KeyScheduler
+from .key_rate import KeyRateLimiter
+from .prompt_cache import PromptCache
+from .reference_cache import ReferenceCache
+from .request_body import StreamingJSONBody, contains_streamed
+from .deadline import MIN_ATTEMPT_SECONDS, Deadline
+from .generation_options import GenerationOptions
+from .hedging import AdmittedClock, HedgePolicy
+from .router import STYLE_CHAT, STYLE_IMAGES, Provider, ProviderRouter
+from .image_io import DEFAULT_CHUNK_SIZE, DEFAULT_MAX_BYTES, DataURIExtractor, DownloadedImage, ImageDownloadError, ImageSink, is_acceptable_content_type, save_data_uri
+
 class ImageGenerator:
     """基于 HTTP 请求的通用图片生成器"""
 
@@ -42,6 +56,8 @@ class ImageGenerator:
         auth_cfg = self.config.get("auth", {}) or {}
         # 确保 image 节点存在，避免下游 KeyError
         self.config.setdefault("image", {})
+        # 生成参数默认值 (请求级参数见 GenerationOptions，不改写共享的 config)
+        self.image_defaults = GenerationOptions.from_config(self.config)
 
         # 加载配置（以 config 文件为主）
         self.base_url = api_cfg.get("base_url", "").rstrip("/")
@@ -69,100 +85,251 @@ class ImageGenerator:
         
         self.timeout = api_cfg.get("timeout", 120)
         self.max_retries = api_cfg.get("max_retries", 3)
+        # 重试退避 (指数 + 抖动)
+        self.backoff_base = float(api_cfg.get("backoff_base", 0.5))
+        self.backoff_max = float(api_cfg.get("backoff_max", 8))
+
+        # 图片下载 (流式落盘)
+        download_cfg = self.config.get("download", {}) or {}
+        self.max_download_bytes = int(download_cfg.get("max_mb", DEFAULT_MAX_BYTES // (1024 * 1024))) * 1024 * 1024
+        self.download_chunk_size = int(download_cfg.get("chunk_size", DEFAULT_CHUNK_SIZE))
+
+        # 多中转路由表 (按模型配置多个上游，按实时延迟与错误率选择)
+        self.router = ProviderRouter(self.config.get("routes", {}), self.config.get("routing", {}), default_keys=self.api_keys)
+
+        # 连接池 (重新加载配置时关闭旧池)
+        old_pool = getattr(self, "http_pool", None)
+        self.http_pool = HTTPPool(self.config.get("http", {}), system_base_url=self.base_url, provider_base_urls=self.router.base_urls())
+        if old_pool is not None:
+            old_pool.close()
+
+        # 系统 Key 调度 / 熔断
+        self.key_scheduler = KeyScheduler(self.config.get("key_scheduler", {}))
+        self.key_scheduler.register(self.api_keys + self.special_keys + self.router.api_keys())
+
+        # 按 Key 限速 (令牌桶，遵守上游 Retry-After)
+        self.key_rate = KeyRateLimiter(self.config.get("key_rate", {}))
+
+        # 参考图预处理缓存 (缩放 + 重新编码)
+        self.reference_cache = ReferenceCache(self.config.get("reference", {}))
+
+        # Magic Optimize 结果缓存
+        self.prompt_cache = PromptCache(cfg=self.config.get("optimize_cache", {}))
+
+        # 上游准入控制 (按模型 + origin 限制并发，用户间公平排队)
+        self.admission = AdmissionController(self.config.get("admission", {}))
+
+        # 对冲请求 (按模型耗时分布触发)
+        self.hedging = HedgePolicy(self.config.get("hedging", {}))
+
+        # 已知不支持一次返回多张 (n > 1) 的模型，多张时直接并发单张调用
+        self.single_n_models = set(self.config.get("image", {}).get("single_n_models", []) or [])
+
+    def resolve_options(self, options: GenerationOptions = None, size: str = None, quality: str = None, style: str = None) -> GenerationOptions:
+        """合并单次生成参数: 显式参数 > options > config["image"] 默认值"""
+        explicit = GenerationOptions(size=size, quality=quality, style=style)
+        return explicit.with_defaults(options or GenerationOptions()).with_defaults(self.image_defaults)
+
+    def deadline_for(self, endpoint: str) -> Deadline:
+        """按接口 (generate / modify / optimize) 创建请求截止时间 (api.deadlines)"""
+        return Deadline.for_endpoint(self.config, endpoint)
+
+    def prewarm_connections(self, count: int = None) -> int:
+        """启动时预先建立到系统 base_url 的连接 (http.prewarm_connections)"""
+        return self.http_pool.prewarm(count)
 
-    def _execute_raw_request(self, url: str, headers: Dict, data: Dict, retry_count: int = 0) -> Optional[requests.Response]:
-        """执行单次请求，处理网络层面的重试"""
+    # 换 Key 可恢复的错误 (401 Auth, 429 Rate, 402 Payment, 500/503 Provider Error)
+    KEY_SWITCH_STATUSES = (401, 403, 429, 402, 500, 503)
+    # 同一 Key 重试可恢复的瞬时错误
+    SAME_KEY_RETRY_STATUSES = (502, 504)
+
+    def _resolve_keys(self, api_key: str = None, model: str = None, provider: Provider = None) -> list:
+        """确定本次请求要尝试的 Key 列表 (系统 Key 由调度器排序)"""
+        # If explicit api_key provided (BYOK), use only that.
+        # Otherwise, use system keys (primary + backups).
+        if api_key:
+            return [api_key]
+
+        # 路由表中的上游使用各自的 Key 池
+        if provider is not None:
+            return self.key_scheduler.plan(list(provider.api_keys)) if provider.api_keys else [""]
+
+        # Check for model-specific keys override (System keys only)
+        if model and model in self.special_models and self.special_keys:
+            print(f"🔑 使用专用Key池 (针对模型: {model})")
+            return self.key_scheduler.plan(list(self.special_keys))
+
+        return self.key_scheduler.plan(list(self.api_keys)) if self.api_keys else [""]
+
+    def _key_acquire(self, key: str, scheduled: bool) -> float:
+        """请求发出前登记 Key 占用，返回开始时间"""
+        if scheduled:
+            self.key_scheduler.acquire(key)
+        return time.time()
+
+    def _key_release(self, key: str, scheduled: bool, status: Optional[int], started: float):
+        """请求结束后回报 Key 的结果 (BYOK Key 不参与调度)"""
+        if scheduled:
+            self.key_scheduler.release(key, status, time.time() - started)
+
+    def _key_cancel(self, key: str, scheduled: bool):
+        """请求被取消或中断: 归还占用，不计入 Key 的成功 / 失败"""
+        if scheduled:
+            self.key_scheduler.cancel(key)
+
+    def _rate_reserve(self, key: str, model: str, scheduled: bool, last_key: bool, deadline: Deadline) -> Optional[float]:
+        """
+        发出请求前预约该 Key 的令牌，返回需要等待的秒数；
+        还有其他 Key 时最多等 key_rate.max_wait，最后一个 Key 只受截止时间约束；返回 None 表示应换 Key
+        """
+        max_wait = None if last_key else self.key_rate.max_wait
+        remaining = deadline.remaining()
+        if remaining is not None:
+            budget = max(0.0, remaining - MIN_ATTEMPT_SECONDS)
+            max_wait = budget if max_wait is None else min(max_wait, budget)
+        return self.key_rate.reserve(key, model, max_wait, configured=scheduled)
+
+    def _rate_observe(self, key: str, model: str, scheduled: bool, response):
+        """把上游的限流信息 (429 / Retry-After / x-ratelimit-*) 回报给限速器"""
+        if response is not None:
+            self.key_rate.observe(key, model, response.status_code, response.headers, configured=scheduled)
+
+    @staticmethod
+    def _build_headers(api_key: str) -> Dict:
+        return {
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json"
+        }
+
+    def _execute_raw_request(self, url: str, headers: Dict, data: Dict, retry_count: int = 0, timeout: float = None, stream: bool = False) -> Optional[requests.Response]:
+        """执行单次请求，处理网络层面的重试 (stream=True 时不预先读取响应体)"""
         try:
             print(f"🚀 发送请求到: {url}")
             print(f"   模型: {data.get('model')}")
-            
-            response = requests.post(
+
+            # 含参考图的请求体以 chunked 方式流式发送
+            body = {"data": StreamingJSONBody(data)} if contains_streamed(data) else {"json": data}
+            response = self.http_pool.client_for(url).post(
                 url,
                 headers=headers,
-                json=data,
-                timeout=self.timeout
+                timeout=timeout or self.timeout,
+                stream=stream,
+                **body
             )
             return response
         except Exception as e:
             print(f"❌ 请求异常: {e}")
             return None
 
-    def _make_request(self, endpoint: str, data: Dict, retry_count: int = 0, base_url: str = None, api_key: str = None, model: str = None) -> Optional[Dict]:
-        """发送API请求 (支持多Key轮询)"""
-        current_base_url = (base_url or self.base_url).rstrip("/")
-        
+    def _make_request(self, endpoint: str, data: Dict, retry_count: int = 0, base_url: str = None, api_key: str = None, model: str = None, deadline: Deadline = None, stream: bool = False, provider: Provider = None) -> Union[Dict, requests.Response, None]:
+        """
+        发送API请求 (支持多Key轮询，总耗时受 deadline 约束)
+        stream=True 时成功返回未读取的 Response (由调用方读取并关闭)，否则返回解析后的 JSON
+        provider: 路由表选出的上游 (决定 base_url、Key 池与上游模型名)
+        """
+        deadline = deadline or Deadline()
+        current_base_url = provider.base_url if provider else (base_url or self.base_url).rstrip("/")
+
         # Override model in data if provided
-        if model:
+        if provider and provider.model:
+            data["model"] = provider.model
+        elif model:
             data["model"] = model
-            
+
         url = f"{current_base_url}{endpoint}"
-        
-        # Determine keys to try
-        # If explicit api_key provided (BYOK), use only that.
-        # Otherwise, use system keys (primary + backups).
-        keys_to_try = [api_key] if api_key else (self.api_keys if self.api_keys else [""])
+        rate_model = data.get("model")
+        keys_to_try = self._resolve_keys(api_key, model, provider)
+        scheduled = not api_key and any(keys_to_try)
+        if scheduled:
+            # 有令牌余量的 Key 优先
+            keys_to_try = self.key_rate.order(keys_to_try, rate_model)
 
-        # Check for model-specific keys override (System keys only)
-        if not api_key and model and model in self.special_models and self.special_keys:
-             print(f"🔑 使用专用Key池 (针对模型: {model})")
-             keys_to_try = self.special_keys
-        
-        last_error = None
-        
         for key_idx, current_key in enumerate(keys_to_try):
-            headers = {
-                "Authorization": f"Bearer {current_key}",
-                "Content-Type": "application/json"
-            }
-            
-            # Internal Retry Loop for a specific key (for 502/Timeout etc, not 401/403)
-            # Actually, _execute_raw_request handles the call. We handle logical retries here?
-            # Let's keep simple: Try Key -> If 401/429/500 -> Try Next Key.
-            # If 502/504 -> Retry same key a few times?
-            
-            # Let's combine: Loop over Keys. Inside, retry connection errors?
-            # Simplified: Just try each key once. If network fails, maybe retry same key?
-            
-            # We will use a simple retry for network flakes on the *same* key
+            headers = self._build_headers(current_key)
+            last_key = key_idx == len(keys_to_try) - 1
+
+            # Loop over Keys. Inside, retry network flakes / 502 / 504 on the *same* key
             for attempt in range(self.max_retries + 1):
-                response = self._execute_raw_request(url, headers, data)
-                
+                if deadline.expired():
+                    print("⏱️ 已超过请求截止时间，放弃")
+                    return None
+
+                wait = self._rate_reserve(current_key, rate_model, scheduled, last_key, deadline)
+                if wait is None:
+                    print(f"🚦 Key #{key_idx} 暂无令牌余量，换下一个 Key")
+                    break
+                if wait > 0:
+                    print(f"🚦 等待限速令牌 {wait:.1f}s")
+                    time.sleep(wait)
+
+                started = self._key_acquire(current_key, scheduled)
+                try:
+                    response = self._execute_raw_request(url, headers, data, timeout=deadline.timeout(self.timeout), stream=stream)
+                except BaseException:
+                    # 中断 (KeyboardInterrupt 等) 时也要归还 Key 占用
+                    self._key_cancel(current_key, scheduled)
+                    raise
+                self._key_release(current_key, scheduled, response.status_code if response is not None else None, started)
+                self._rate_observe(current_key, rate_model, scheduled, response)
+
                 if response is None:
                     # Network error, retry same key
-                    time.sleep(1)
+                    delay = deadline.backoff(attempt, self.backoff_base, self.backoff_max)
+                    if delay is None:
+                        print("⏱️ 剩余时间不足以重试，放弃")
+                        return None
+                    time.sleep(delay)
                     continue
-                
+
                 if response.status_code == 200:
-                    return response.json()
-                
-                # If error is recoverable by switching keys (401 Auth, 429 Rate, 402 Payment, 500/503 Provider Error)
-                if response.status_code in [401, 403, 429, 402, 500, 503]:
+                    return response if stream else response.json()
+
+                if stream:
+                    # 错误响应体很小，读完以便连接回到连接池
+                    response.content
+
+                if response.status_code == 429 and last_key and attempt < self.max_retries:
+                    # 没有其他 Key 可换: 下一轮预约令牌时按 Retry-After 等待后重试
+                    print("🚦 429 Too Many Requests，等待后重试同一 Key")
+                    continue
+
+                if response.status_code in self.KEY_SWITCH_STATUSES:
                     print(f"⚠️ Key #{key_idx} failed with {response.status_code}. Trying next key...")
                     # Break inner loop (retries) to go to next key
-                    break 
-                
-                # If error is likely transient (502, 504), retry same key
-                if response.status_code in [502, 504]:
+                    break
+
+                if response.status_code in self.SAME_KEY_RETRY_STATUSES:
+                     delay = deadline.backoff(attempt, self.backoff_base, self.backoff_max)
+                     if delay is None:
+                         print("⏱️ 剩余时间不足以重试，放弃")
+                         return None
                      print(f"🔄 正在重试 ({attempt + 1}/{self.max_retries})...")
-                     time.sleep(2)
+                     time.sleep(delay)
                      continue
-                
+
                 # Other errors (400 Bad Request) -> Don't switch keys, likely request issue
                 print(f"❌ API请求失败: {response.status_code}")
                 print(f"   响应: {response.text}")
                 return None
-            
+
             # If we broke out of inner loop, it means this key failed. Continue to next key.
-            
+
         print("❌ All keys failed.")
         return None
 
-    def _generate_image_via_chat(self, prompt: str, size: str = None, quality: str = None, base_url: str = None, api_key: str = None, model: str = None) -> Optional[str]:
-        """通过 Chat API 生成图片 (针对 Gemini 等模型)"""
-        
+    # --- 请求构建 / 响应解析 (同步与异步引擎共用) ---
+
+    @staticmethod
+    def _uses_chat_endpoint(target_model: str) -> bool:
+        """该模型是否需要走 Chat 接口出图"""
+        return "gemini-3-pro-image-preview" in (target_model or "")
+
+    def _build_chat_image_payload(self, prompt: str, size: str = None, quality: str = None, model: str = None) -> Dict:
+        """构建 Chat 出图请求 (针对 Gemini 等模型)"""
+
         # 针对 Gemini 的 Prompt 增强: 注入画幅比例指令
         final_prompt = prompt
-        
+
         # 1. 画幅处理
         if size:
             if size == "1792x1024":
@@ -171,7 +338,7 @@ class ImageGenerator:
                 final_prompt += " --ar 9:16"
             elif size == "1024x1024":
                 final_prompt += " --ar 1:1"
-        
+
         # 2. 画质/分辨率处理 (通过提示词增强)
         # 虽然物理分辨率受限，但通过指令可以显著提升细节密度
         if quality:
@@ -182,16 +349,17 @@ class ImageGenerator:
 
         print(f"🎨 Chat生成提示词: {final_prompt}")
 
-        data = {
+        return {
             "model": model or self.model,
             "messages": [
                 {"role": "user", "content": final_prompt}
             ],
             "n": 1
         }
-        
-        response = self._make_request("/v1/chat/completions", data, base_url=base_url, api_key=api_key, model=model)
-        
+
+    @staticmethod
+    def _extract_chat_image(response: Optional[Dict]) -> Optional[str]:
+        """从 Chat 响应中提取图片 URL / Data URI"""
         if response and "choices" in response and len(response["choices"]) > 0:
             content = response["choices"][0]["message"]["content"]
             # 尝试提取 markdown 图片链接或直接返回内容
@@ -202,16 +370,40 @@ class ImageGenerator:
             return content # 如果没找到markdown格式，直接返回内容尝试
         return None
 
-    def optimize_prompt(self, raw_prompt: str, subject: str = "general", model: str = None) -> str:
-        """
-        使用 LLM 优化提示词 (融入结构化思维)
-        :param model: 目标绘图模型 (Target Image Model)，用于定制提示词风格。
-                      实际推理仍然使用 self.model (System LLM)。
-        """
+    # 优化指令模板的版本号，修改 _build_optimize_payload 中的模板后递增，使旧的缓存结果失效
+    OPTIMIZE_PROMPT_VERSION = 1
+
+    STYLE_INSTRUCTIONS = {
+        "jimeng": "Target Model: Jimeng/Dream. Style preference: High artistic quality, dreamy lighting, Chinese aesthetic friendly, precise tags.",
+        "dalle": "Target Model: DALL-E 3. Style preference: Natural language descriptions, very literal interpretation, detailed visual adjectives.",
+        "gemini": "Target Model: Gemini Image. Style preference: Structured, logical, high dynamic range, prompt adherence.",
+    }
+
+    @staticmethod
+    def _style_bucket(target_model: str) -> str:
+        """目标绘图模型对应的风格分组 (决定优化时注入的风格指令)"""
+        t_lower = (target_model or "").lower()
+        if "jimeng" in t_lower:
+            return "jimeng"
+        if "gpt" in t_lower or "dall" in t_lower:
+            return "dalle"
+        if "gemini" in t_lower:
+            return "gemini"
+        return "default"
+
+    def _optimize_cache_key(self, raw_prompt: str, subject: str = "general", model: str = None) -> str:
+        """优化结果缓存键: 归一化提示词 + 学科 + 风格分组 + 推理模型 + 模板版本"""
+        return PromptCache.make_key(
+            PromptCache.normalize(raw_prompt), subject, self._style_bucket(model or self.model),
+            self.model, self.OPTIMIZE_PROMPT_VERSION
+        )
+
+    def _build_optimize_payload(self, raw_prompt: str, subject: str = "general", model: str = None) -> Dict:
+        """构建提示词优化请求 (融入结构化思维)"""
         # 1. 确定 LLM 和 目标风格
         llm_model = self.model # 始终使用系统配置的 LLM (Brain) 进行思考
         target_model = model or self.model # 用户选择的绘图模型
-        
+
         # 2. 定义学科特定的负面约束
         subject_constraints = {
             "math": "no distorted numbers, no curved rulers, no incorrect formulas",
@@ -227,26 +419,18 @@ class ImageGenerator:
             "humanities_psych": "accurate maps, historical accuracy, biological details, empathy, facial expressions, social scenes",
             "textbook": "no blurry details, no photographic noise, no dark background, no complex background"
         }
-        
+
         neg_constraint = subject_constraints.get(subject, "no distorted text, no blurry details")
 
         # 3. 定制化风格指令 (根据目标模型)
-        style_instruction = ""
-        if target_model:
-            t_lower = target_model.lower()
-            if "jimeng" in t_lower:
-                style_instruction = "Target Model: Jimeng/Dream. Style preference: High artistic quality, dreamy lighting, Chinese aesthetic friendly, precise tags."
-            elif "gpt" in t_lower or "dall" in t_lower:
-                style_instruction = "Target Model: DALL-E 3. Style preference: Natural language descriptions, very literal interpretation, detailed visual adjectives."
-            elif "gemini" in t_lower:
-                style_instruction = "Target Model: Gemini Image. Style preference: Structured, logical, high dynamic range, prompt adherence."
+        style_instruction = self.STYLE_INSTRUCTIONS.get(self._style_bucket(target_model), "")
 
         # 4. 高级 System Prompt
-        
+
         # 针对“教材绘图”的特殊处理
         if subject == "textbook":
             style_keywords = "modern 2.5D vector illustration, soft gradient shading, clean lines, high-quality educational textbook art, vibrant multi-color accents, white background"
-            
+
             system_instruction = f"""
 You are a Prompt Engineering Expert. Your task is to WRITE A TEXT DESCRIPTION.
 DO NOT GENERATE AN IMAGE.
@@ -276,127 +460,92 @@ Constraint: {neg_constraint}.
 Output ONLY the text description.
 """
             user_content = f"Create an educational infographic prompt for: {raw_prompt}. Subject context: {subject}"
-        
+
+        print(f"✨ 正在优化提示词 (Target: {target_model}): {raw_prompt}")
+
         # 注意: 这里使用 llm_model (self.model) 发起请求，而不是传入的 model (可能只是 image model)
-        data = {
-            "model": llm_model, 
+        return {
+            "model": llm_model,
             "messages": [
                 {"role": "system", "content": system_instruction},
                 {"role": "user", "content": user_content}
             ],
             "temperature": 0.7
         }
-        
-        print(f"✨ 正在优化提示词 (Target: {target_model}): {raw_prompt}")
-        response = self._make_request("/v1/chat/completions", data, model=llm_model)
-        
-        if response and "choices" in response and len(response["choices"]) > 0:
-            content = response["choices"][0]["message"]["content"].strip()
-            
-            # 移除 markdown 图片链接
-            content = re.sub(r'!\[.*?\]\(.*?\)', '', content)
-            content = re.sub(r'\[Image\]', '', content, flags=re.IGNORECASE)
-            content = content.strip()
-            
-            if not content or len(content) < 5:
-                print("⚠️ 优化结果无效，回退")
-                return raw_prompt
 
-            print(f"✨ 优化完成: {content[:50]}...")
-            return content
-        
-        return raw_prompt
+    @staticmethod
+    def _clean_optimized_prompt(content: str, raw_prompt: str) -> str:
+        """清洗 LLM 输出，无效时回退到原始提示词"""
+        content = (content or "").strip()
+
+        # 移除 markdown 图片链接
+        content = re.sub(r'!\[.*?\]\(.*?\)', '', content)
+        content = re.sub(r'\[Image\]', '', content, flags=re.IGNORECASE)
+        content = content.strip()
+
+        if not content or len(content) < 5:
+            print("⚠️ 优化结果无效，回退")
+            return raw_prompt
+
+        print(f"✨ 优化完成: {content[:50]}...")
+        return content
+
+    def _build_modify_payload(self, prompt: str, base_image_paths: list[str], model: str = None) -> Dict:
+        """构建多模态修改请求 (OpenAI Vision 格式)"""
+        content_list = [
+            {
+                "type": "text",
+                "text": f"{prompt} (Return the modified image URL only)"
+            }
+        ]
+
+        for img_path in base_image_paths:
+            if not os.path.exists(img_path):
+                print(f"⚠️ 跳过不存在的图片: {img_path}")
+                continue
+
+            # 缩放并编码 (按路径 + mtime + 模型缓存，反复修改同一张图时不再重复处理)
+            # base64 不在此处展开，发送时由 StreamingJSONBody 分块写出
+            content_list.append({
+                "type": "image_url",
+                "image_url": {
+                    "url": self.reference_cache.get(img_path, model or self.model)
+                }
+            })
 
-    def generate_modified_image(self, prompt: str, base_image_paths: list[str], base_url: str = None, api_key: str = None, model: str = None) -> Optional[str]:
-        """
-        基于原图(多图)进行修改 (Image-to-Image / Vision)
-        """
-        if not base_image_paths:
-            return None
+        print(f"🎨 正在修改图片 ({len(base_image_paths)} refs), 提示词: {prompt}")
 
-        try:
-            content_list = [
+        return {
+            "model": model or self.model,
+            "messages": [
                 {
-                    "type": "text",
-                    "text": f"{prompt} (Return the modified image URL only)"
+                    "role": "user",
+                    "content": content_list
                 }
-            ]
-
-            for img_path in base_image_paths:
-                if not os.path.exists(img_path):
-                    print(f"⚠️ 跳过不存在的图片: {img_path}")
-                    continue
-                    
-                # 确定MIME类型
-                mime_type = "image/png"
-                if img_path.lower().endswith(".jpg") or img_path.lower().endswith(".jpeg"):
-                    mime_type = "image/jpeg"
-                
-                # 读取并编码
-                with open(img_path, "rb") as image_file:
-                    encoded_string = base64.b64encode(image_file.read()).decode('utf-8')
-                
-                content_list.append({
-                    "type": "image_url",
-                    "image_url": {
-                        "url": f"data:{mime_type};base64,{encoded_string}"
-                    }
-                })
-
-            print(f"🎨 正在修改图片 ({len(base_image_paths)} refs), 提示词: {prompt}")
-
-            # 2. 构建多模态请求 (OpenAI Vision 格式)
-            data = {
-                "model": model or self.model,
-                "messages": [
-                    {
-                        "role": "user",
-                        "content": content_list
-                    }
-                ],
-                "n": 1
-            }
+            ],
+            "n": 1
+        }
 
-            response = self._make_request("/v1/chat/completions", data, base_url=base_url, api_key=api_key, model=model)
-
-            if response and "choices" in response and len(response["choices"]) > 0:
-                content = response["choices"][0]["message"]["content"]
-                # 尝试提取 markdown 图片链接
-                match = re.search(r'!\[.*?\]\((.*?)\)', content)
-                if match:
-                    return match.group(1)
-                # 假如直接返回了URL文本
-                if content.startswith("http"):
-                    return content
+    @staticmethod
+    def _extract_modified_image(response: Optional[Dict]) -> Optional[str]:
+        if response and "choices" in response and len(response["choices"]) > 0:
+            content = response["choices"][0]["message"]["content"]
+            # 尝试提取 markdown 图片链接
+            match = re.search(r'!\[.*?\]\((.*?)\)', content)
+            if match:
+                return match.group(1)
+            # 假如直接返回了URL文本
+            if content.startswith("http"):
                 return content
-            return None
-
-        except Exception as e:
-            print(f"❌ 图片修改失败: {e}")
-            return None
-
-    def generate_image(self, prompt: str, size: str = None, quality: str = None, style: str = None, base_url: str = None, api_key: str = None, model: str = None) -> Optional[str]:
-        """
-        生成图片
-        Returns: 图片 URL 或 Base64 Data URI
-        """
-        # 使用默认参数
-        if size is None: size = self.config["image"].get("size")
-        if quality is None: quality = self.config["image"].get("quality")
-        if style is None: style = self.config["image"].get("style")
-        
-        target_model = model or self.model
-
-        # 针对 Gemini-3-pro-image-preview 模型的特殊处理
-        if "gemini-3-pro-image-preview" in target_model:
-            print(f"🤖 检测到 Gemini 绘图模型，切换到 Chat 接口...")
-            return self._generate_image_via_chat(prompt, size, quality, base_url=base_url, api_key=api_key, model=target_model)
+            return content
+        return None
 
-        # 构建请求数据 (OpenAI 兼容格式)
+    def _build_image_payload(self, prompt: str, size: str, target_model: str, n: int = 1) -> Dict:
+        """构建 /v1/images/generations 请求数据 (OpenAI 兼容格式)"""
         data = {
             "model": target_model,
             "prompt": prompt,
-            "n": 1,
+            "n": n,
             "size": size,
             "response_format": "url"
         }
@@ -407,64 +556,333 @@ Output ONLY the text description.
                 "watermark": False,
                 "prompt_extend": True
             })
+        return data
 
-        # 大多数中转商使用标准的 OpenAI 图片接口
-        response = self._make_request("/v1/images/generations", data, base_url=base_url, api_key=api_key, model=target_model)
-
+    @staticmethod
+    def _extract_image_url(response: Optional[Dict]) -> Optional[str]:
         if response and "data" in response and len(response["data"]) > 0:
             image_url = response["data"][0]["url"]
             print(f"✅ 图片生成成功URL: {image_url[:50]}...")
             return image_url
-        else:
-            print("❌ 未获取到图片数据")
+        print("❌ 未获取到图片数据")
+        return None
+
+    @staticmethod
+    def _extract_image_urls(response: Optional[Dict]) -> List[str]:
+        """n > 1 时的全部图片 (URL 或 b64_json 转成的 Data URI)"""
+        urls = []
+        for item in (response or {}).get("data", []) or []:
+            if item.get("url"):
+                urls.append(item["url"])
+            elif item.get("b64_json"):
+                urls.append(f"data:image/png;base64,{item['b64_json']}")
+        print(f"✅ 一次返回 {len(urls)} 张图片" if urls else "❌ 未获取到图片数据")
+        return urls
+
+    def _supports_multi_n(self, target_model: str) -> bool:
+        """Chat 出图与已知不支持 n > 1 的模型只能逐张生成"""
+        return not self._uses_chat_endpoint(target_model) and target_model not in self.single_n_models
+
+    def _note_multi_n(self, target_model: str, requested: int, returned: int):
+        """上游返回的张数不足时记下该模型，之后直接并发单张调用"""
+        if returned < requested and target_model not in self.single_n_models:
+            self.single_n_models.add(target_model)
+            print(f"ℹ️ 模型 {target_model} 不支持一次生成多张 (请求 {requested} 张，返回 {returned} 张)，改为逐张生成")
+
+    # --- 对外接口 ---
+
+    def _read_chat_image(self, response: requests.Response, save_path: str, extract: Callable[[Optional[Dict]], Optional[str]], deadline: Deadline = None) -> Union[DownloadedImage, str, None]:
+        """
+        流式读取 Chat 响应: 内联的 base64 图片边读边解码写入 save_path，不在内存中拼出完整响应；
+        没有内联图片时，用剩余的 (很小的) 响应内容按 extract 原逻辑解析出 URL
+        """
+        deadline = deadline or Deadline()
+        extractor = DataURIExtractor(save_path, self.max_download_bytes)
+        try:
+            with response:
+                for chunk in response.iter_content(chunk_size=self.download_chunk_size):
+                    if deadline.expired():
+                        raise ImageDownloadError("读取响应超过请求截止时间")
+                    extractor.feed(chunk)
+            image = extractor.finish()
+        except Exception as e:
+            extractor.abort()
+            print(f"❌ 读取 Chat 响应失败: {e}")
+            return None
+
+        if image:
+            print(f"✅ 内联图片已流式解码保存 ({image.size} bytes)")
+            return image
+
+        try:
+            body = json.loads(bytes(extractor.residual))
+        except ValueError as e:
+            print(f"❌ Chat 响应解析失败: {e}")
+            return None
+        return extract(body)
+
+    def _generate_image_via_chat(self, prompt: str, options: GenerationOptions, base_url: str = None, api_key: str = None, model: str = None, deadline: Deadline = None, save_path: str = None, provider: Provider = None) -> Union[DownloadedImage, str, None]:
+        """通过 Chat API 生成图片 (针对 Gemini 等模型)"""
+        data = self._build_chat_image_payload(prompt, options.size, options.quality, model=model)
+        if save_path:
+            response = self._make_request("/v1/chat/completions", data, base_url=base_url, api_key=api_key, model=model, deadline=deadline, stream=True, provider=provider)
+            return self._read_chat_image(response, save_path, self._extract_chat_image, deadline) if response is not None else None
+        response = self._make_request("/v1/chat/completions", data, base_url=base_url, api_key=api_key, model=model, deadline=deadline, provider=provider)
+        return self._extract_chat_image(response)
+
+    def _use_chat(self, target_model: str, provider: Provider = None) -> bool:
+        """路由表中的上游可指定接口类型，否则按模型名判断"""
+        if provider is not None and provider.style:
+            return provider.style == STYLE_CHAT
+        return self._uses_chat_endpoint(target_model)
+
+    def _route(self, model: str, base_url: str = None, api_key: str = None, styles: tuple = None) -> list:
+        """本次请求依次尝试的上游；不经过路由表时返回 [None] (使用 base_url / 系统 Key)"""
+        if api_key or base_url or not self.router.has_route(model):
+            return [None]
+        return self.router.plan(model, styles) or [None]
+
+    def _call_routed(self, model: str, call: Callable[[Optional[Provider]], Union[DownloadedImage, str, None]], base_url: str = None, api_key: str = None,
+                     client: AdmissionClient = None, deadline: Deadline = None, styles: tuple = None) -> Union[DownloadedImage, str, None]:
+        """
+        按路由表依次尝试上游 (每个上游单独排队)，失败时切换到下一个；
+        call(provider) 执行一次调用；全部上游都排队被拒时抛出 AdmissionRejected
+        """
+        deadline = deadline or Deadline()
+        providers = self._route(model, base_url, api_key, styles)
+        rejected = None
+        for idx, provider in enumerate(providers):
+            if idx and deadline.expired():
+                break
+            try:
+                with self.admission.admit(model, provider.base_url if provider else (base_url or self.base_url), client, deadline):
+                    if provider is None:
+                        return call(None)
+                    self.router.acquire(provider)
+                    started, result = time.monotonic(), None
+                    try:
+                        result = call(provider)
+                    finally:
+                        self.router.release(provider, bool(result), time.monotonic() - started)
+            except AdmissionRejected as e:
+                rejected = e
+                continue
+            if result:
+                return result
+            if idx < len(providers) - 1:
+                print(f"🔀 上游 {provider.name} 未成功，切换到下一个上游")
+        if rejected is not None:
+            raise rejected
+        return None
+
+    def optimize_prompt(self, raw_prompt: str, subject: str = "general", model: str = None, deadline: Deadline = None, client: AdmissionClient = None) -> str:
+        """
+        使用 LLM 优化提示词 (融入结构化思维)
+        :param model: 目标绘图模型 (Target Image Model)，用于定制提示词风格。
+                      实际推理仍然使用 self.model (System LLM)。
+        """
+        cache_key = self._optimize_cache_key(raw_prompt, subject, model)
+        cached = self.prompt_cache.get(cache_key)
+        if cached:
+            print(f"⚡ 命中优化缓存: {cached[:50]}...")
+            return cached
+
+        data = self._build_optimize_payload(raw_prompt, subject, model)
+        with self.admission.admit(data["model"], self.base_url, client, deadline):
+            response = self._make_request("/v1/chat/completions", data, model=data["model"], deadline=deadline)
+
+        if response and "choices" in response and len(response["choices"]) > 0:
+            optimized = self._clean_optimized_prompt(response["choices"][0]["message"]["content"], raw_prompt)
+            # 回退为原文时不缓存
+            if optimized != raw_prompt:
+                self.prompt_cache.put(cache_key, optimized)
+            return optimized
+
+        return raw_prompt
+
+    def generate_modified_image(self, prompt: str, base_image_paths: list[str], base_url: str = None, api_key: str = None, model: str = None, deadline: Deadline = None, save_path: str = None, client: AdmissionClient = None) -> Union[DownloadedImage, str, None]:
+        """
+        基于原图(多图)进行修改 (Image-to-Image / Vision)
+        传入 save_path 时内联图片直接流式写入该路径并返回 DownloadedImage
+        """
+        if not base_image_paths:
+            return None
+
+        target_model = model or self.model
+        try:
+            data = self._build_modify_payload(prompt, base_image_paths, model=target_model)
+        except Exception as e:
+            print(f"❌ 图片修改失败: {e}")
+            return None
+
+        def call(provider: Optional[Provider]):
+            try:
+                if save_path:
+                    response = self._make_request("/v1/chat/completions", data, base_url=base_url, api_key=api_key, model=target_model, deadline=deadline, stream=True, provider=provider)
+                    return self._read_chat_image(response, save_path, self._extract_modified_image, deadline) if response is not None else None
+                response = self._make_request("/v1/chat/completions", data, base_url=base_url, api_key=api_key, model=target_model, deadline=deadline, provider=provider)
+                return self._extract_modified_image(response)
+            except Exception as e:
+                print(f"❌ 图片修改失败: {e}")
+                return None
+
+        # 图生图只能走 Chat 接口；排队被拒 (AdmissionRejected) 直接抛给调用方
+        return self._call_routed(target_model, call, base_url, api_key, client, deadline, styles=(STYLE_CHAT, None))
+
+    def generate_image(self, prompt: str, size: str = None, quality: str = None, style: str = None, base_url: str = None, api_key: str = None, model: str = None, deadline: Deadline = None, save_path: str = None, client: AdmissionClient = None, options: GenerationOptions = None) -> Union[DownloadedImage, str, None]:
+        """
+        生成图片
+        :param options: 本次请求的尺寸 / 画质 / 风格 (size / quality / style 显式传入时优先)
+        Returns: 图片 URL 或 Base64 Data URI；
+                 传入 save_path 且走 Chat 接口时，内联图片直接落盘并返回 DownloadedImage
+        """
+        options = self.resolve_options(options, size, quality, style)
+
+        target_model = model or self.model
+
+        def call(provider: Optional[Provider]):
+            # 针对 Gemini-3-pro-image-preview 模型的特殊处理
+            if self._use_chat(target_model, provider):
+                print(f"🤖 检测到 Gemini 绘图模型，切换到 Chat 接口...")
+                return self._generate_image_via_chat(prompt, options, base_url=base_url, api_key=api_key, model=target_model, deadline=deadline, save_path=save_path, provider=provider)
+
+            # 大多数中转商使用标准的 OpenAI 图片接口
+            data = self._build_image_payload(prompt, options.size, target_model)
+            response = self._make_request("/v1/images/generations", data, base_url=base_url, api_key=api_key, model=target_model, deadline=deadline, provider=provider)
+            return self._extract_image_url(response)
+
+        return self._call_routed(target_model, call, base_url, api_key, client, deadline)
+
+    def _save_data_uri(self, image_url: str, save_path: str) -> Optional[DownloadedImage]:
+        """处理 Base64 Data URI (分块解码，原子落盘)"""
+        try:
+            image = save_data_uri(image_url, save_path, self.max_download_bytes, self.download_chunk_size)
+            print(f"✅ Base64图片解码并保存成功 ({image.size} bytes)")
+            return image
+        except Exception as e:
+            print(f"❌ Base64解码失败: {e}")
             return None
 
-    def download_image(self, image_url: str, save_path: str) -> bool:
-        """下载图片到本地 (支持 URL 和 Base64 Data URI)"""
+    def _check_download_headers(self, status_code: int, headers) -> bool:
+        """在读取响应体之前校验状态码、Content-Type 与 Content-Length"""
+        if status_code != 200:
+            print(f"❌ 下载失败: {status_code}")
+            return False
+        content_type = headers.get("Content-Type", "")
+        if not is_acceptable_content_type(content_type):
+            print(f"❌ 下载内容不是图片: {content_type}")
+            return False
+        length = headers.get("Content-Length")
+        if length and length.isdigit() and int(length) > self.max_download_bytes:
+            print(f"❌ 图片过大: {length} bytes")
+            return False
+        return True
+
+    def download_image(self, image_url: str, save_path: str, deadline: Deadline = None) -> Optional[DownloadedImage]:
+        """
+        下载图片到本地 (支持 URL 和 Base64 Data URI)
+        流式写入临时文件后原子重命名；返回的 DownloadedImage 带有大小与 sha256，失败返回 None
+        """
         try:
             print(f"📥 准备保存图片到: {save_path}")
             os.makedirs(os.path.dirname(save_path), exist_ok=True)
 
-            # 处理 Base64 Data URI
             if image_url.startswith("data:image"):
-                try:
-                    # 格式: data:image/png;base64,.....
-                    header, encoded = image_url.split(",", 1)
-                    data = base64.b64decode(encoded)
-                    with open(save_path, 'wb') as f:
-                        f.write(data)
-                    print(f"✅ Base64图片解码并保存成功")
-                    return True
-                except Exception as e:
-                    print(f"❌ Base64解码失败: {e}")
-                    return False
+                return self._save_data_uri(image_url, save_path)
 
             # 处理普通 URL
             # 有些 URL 需要代理，有些不需要，这里直接请求
-            response = requests.get(image_url, timeout=60)
-
-            if response.status_code == 200:
-                with open(save_path, 'wb') as f:
-                    f.write(response.content)
-                print(f"✅ 下载成功")
-                return True
-            else:
-                print(f"❌ 下载失败: {response.status_code}")
-                return False
+            deadline = deadline or Deadline()
+            if deadline.expired():
+                print("⏱️ 已超过请求截止时间，跳过下载")
+                return None
+
+            client = self.http_pool.client_for(image_url)
+            with client.get(image_url, timeout=deadline.timeout(60), stream=True) as response:
+                if not self._check_download_headers(response.status_code, response.headers):
+                    return None
+                with ImageSink(save_path, self.max_download_bytes) as sink:
+                    for chunk in response.iter_content(chunk_size=self.download_chunk_size):
+                        if deadline.expired():
+                            raise ImageDownloadError("下载超过请求截止时间")
+                        sink.write(chunk)
+                    image = sink.commit()
+            print(f"✅ 下载成功 ({image.size} bytes)")
+            return image
         except Exception as e:
             print(f"❌ 下载异常: {e}")
-            return False
+            return None
 
-    def generate_and_download(self, prompt: str, filename: str, folder: str = "generated_images", base_url: str = None, api_key: str = None, model: str = None) -> Optional[str]:
-        """生成并下载"""
-        image_url = self.generate_image(prompt, base_url=base_url, api_key=api_key, model=model)
-        
-        if image_url:
-            save_path = os.path.join(folder, filename)
-            if self.download_image(image_url, save_path):
-                return save_path
-        return None
+    def generate_to_file(self, prompt: str, save_path: str, base_url: str = None, api_key: str = None, model: str = None, deadline: Deadline = None, client: AdmissionClient = None, options: GenerationOptions = None) -> Optional[DownloadedImage]:
+        """生成并保存到 save_path (生成与下载共用同一个 deadline)"""
+        clock = AdmittedClock()
+        with on_admitted(clock):
+            result = self.generate_image(prompt, base_url=base_url, api_key=api_key, model=model, deadline=deadline, save_path=save_path, client=client, options=options)
+        if result and not isinstance(result, DownloadedImage):
+            result = self.download_image(result, save_path, deadline=deadline)
+        if result:
+            # 同步调用方 (批量) 不对冲，只为对冲策略提供耗时样本 (从通过准入排队时计起)
+            self.hedging.record(model or self.model, clock.elapsed())
+        return result or None
+
+    def modify_to_file(self, prompt: str, base_image_paths: list[str], save_path: str, base_url: str = None, api_key: str = None, model: str = None, deadline: Deadline = None, client: AdmissionClient = None) -> Optional[DownloadedImage]:
+        """基于参考图生成并保存到 save_path"""
+        clock = AdmittedClock()
+        with on_admitted(clock):
+            result = self.generate_modified_image(prompt, base_image_paths, base_url=base_url, api_key=api_key, model=model, deadline=deadline, save_path=save_path, client=client)
+        if result and not isinstance(result, DownloadedImage):
+            result = self.download_image(result, save_path, deadline=deadline)
+        if result:
+            self.hedging.record(model or self.model, clock.elapsed())
+        return result or None
+
+    def generate_images(self, prompt: str, n: int, base_url: str = None, api_key: str = None, model: str = None, deadline: Deadline = None, client: AdmissionClient = None, options: GenerationOptions = None) -> List[str]:
+        """一次 /v1/images/generations 调用生成 n 张，返回图片 URL 列表 (可能少于 n 张)"""
+        options = self.resolve_options(options)
+        target_model = model or self.model
+
+        def call(provider: Optional[Provider]):
+            if self._use_chat(target_model, provider):
+                return []
+            data = self._build_image_payload(prompt, options.size, target_model, n=n)
+            response = self._make_request("/v1/images/generations", data, base_url=base_url, api_key=api_key, model=target_model, deadline=deadline, provider=provider)
+            return self._extract_image_urls(response)
+
+        return self._call_routed(target_model, call, base_url, api_key, client, deadline, styles=(STYLE_IMAGES, None)) or []
+
+    def generate_variants_to_files(self, prompt: str, save_paths: List[str], base_url: str = None, api_key: str = None, model: str = None, deadline: Deadline = None, client: AdmissionClient = None, options: GenerationOptions = None) -> List[Optional[DownloadedImage]]:
+        """
+        生成 len(save_paths) 张候选图: 支持 n > 1 的上游一次调用生成全部，
+        其余 (或返回不足的部分) 并发逐张生成；所有图片并行下载
+        """
+        target_model = model or self.model
+        n = len(save_paths)
+        urls = []
+        if n > 1 and self._supports_multi_n(target_model):
+            urls = self.generate_images(prompt, n, base_url=base_url, api_key=api_key, model=target_model, deadline=deadline, client=client, options=options)
+            self._note_multi_n(target_model, n, len(urls))
+
+        def fill(idx: int) -> Optional[DownloadedImage]:
+            if idx < len(urls):
+                return self.download_image(urls[idx], save_paths[idx], deadline=deadline)
+            return self.generate_to_file(prompt, save_paths[idx], base_url=base_url, api_key=api_key, model=target_model, deadline=deadline, client=client, options=options)
+
+        with ThreadPoolExecutor(max_workers=max(1, n)) as executor:
+            return list(executor.map(fill, range(n)))
+
+    def generate_and_download(self, prompt: str, filename: str, folder: str = "generated_images", base_url: str = None, api_key: str = None, model: str = None, deadline: Deadline = None, options: GenerationOptions = None) -> Optional[str]:
+        """生成并下载，返回本地路径"""
+        image = self.generate_to_file(prompt, os.path.join(folder, filename), base_url=base_url, api_key=api_key, model=model, deadline=deadline, options=options)
+        return image.path if image else None
+
+# 单例辅助函数 (进程内共享配置与连接池)
+_generator_instance: Optional[ImageGenerator] = None
+_generator_lock = threading.Lock()
 
-# 单例辅助函数
 def get_image_generator() -> ImageGenerator:
-    return ImageGenerator()
+    global _generator_instance
+    if _generator_instance is None:
+        with _generator_lock:
+            if _generator_instance is None:
+                _generator_instance = ImageGenerator()
+    return _generator_instance
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+图片落盘工具
+流式写入同目录临时文件，边写边校验魔数、限制大小、计算摘要，完成后原子重命名，
+中途失败不会在 GENERATED_DIR 留下半截图片
+"""
+
+import base64
+import hashlib
+import os
+import re
+import tempfile
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+DEFAULT_MAX_BYTES = 40 * 1024 * 1024
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+# 常见图片格式的文件头
+IMAGE_SIGNATURES = [
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+]
+SNIFF_BYTES = 12
+
+
+class ImageDownloadError(Exception):
+    """图片内容不合法 (非图片 / 超出大小上限等)"""
+
+
+@dataclass
+class DownloadedImage:
+    """已落盘的图片及其在写入过程中计算出的信息"""
+    path: str
+    size: int
+    sha256: str
+    mime: str
+
+
+def sniff_image_type(head: bytes) -> Optional[str]:
+    """根据文件头判断图片类型"""
+    for signature, mime in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return mime
+    if len(head) >= 12 and head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+
+def describe_image(path: str, chunk_size: int = DEFAULT_CHUNK_SIZE) -> DownloadedImage:
+    """为已落盘的图片补算大小、sha256 与类型 (如重启后恢复的文件)"""
+    h = hashlib.sha256()
+    size = 0
+    head = b""
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            if not head:
+                head = chunk[:SNIFF_BYTES]
+            h.update(chunk)
+            size += len(chunk)
+    return DownloadedImage(path, size, h.hexdigest(), sniff_image_type(head) or "image/png")
+
+
+def is_acceptable_content_type(content_type: Optional[str]) -> bool:
+    """上游声明的 Content-Type 是否可能是图片 (未声明时交给魔数校验)"""
+    if not content_type:
+        return True
+    ctype = content_type.split(";")[0].strip().lower()
+    return ctype.startswith("image/") or ctype in ("application/octet-stream", "binary/octet-stream")
+
+
+class ImageSink:
+    """
+    图片写入器
+    用法:
+        with ImageSink(save_path) as sink:
+            for chunk in ...: sink.write(chunk)
+            result = sink.commit()
+    未 commit 就退出 (含异常) 时自动删除临时文件
+    """
+
+    def __init__(self, save_path: str, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.save_path = save_path
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.mime: Optional[str] = None
+        self._head = b""
+        self._hash = hashlib.sha256()
+        self._committed = False
+
+        directory = os.path.dirname(save_path) or "."
+        os.makedirs(directory, exist_ok=True)
+        fd, self.tmp_path = tempfile.mkstemp(dir=directory, prefix=".", suffix=".part")
+        self._file = os.fdopen(fd, "wb")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if not self._committed:
+            self.abort()
+        return False
+
+    def write(self, chunk: bytes):
+        if not chunk:
+            return
+        self.size += len(chunk)
+        if self.size > self.max_bytes:
+            raise ImageDownloadError(f"图片超过大小上限 ({self.max_bytes // (1024 * 1024)}MB)")
+
+        # 尽早校验文件头，非图片内容立即中止
+        if self.mime is None:
+            self._head += chunk[:SNIFF_BYTES - len(self._head)]
+            if len(self._head) >= SNIFF_BYTES:
+                self._check_head()
+
+        self._hash.update(chunk)
+        self._file.write(chunk)
+
+    def _check_head(self):
+        self.mime = sniff_image_type(self._head)
+        if self.mime is None:
+            raise ImageDownloadError(f"内容不是有效的图片 (文件头: {self._head[:8]!r})")
+
+    def commit(self) -> DownloadedImage:
+        """校验并原子替换到目标路径"""
+        if self.mime is None:
+            self._check_head()
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        os.replace(self.tmp_path, self.save_path)
+        self._committed = True
+        return DownloadedImage(self.save_path, self.size, self._hash.hexdigest(), self.mime)
+
+    def abort(self):
+        try:
+            self._file.close()
+        except Exception:
+            pass
+        try:
+            os.remove(self.tmp_path)
+        except FileNotFoundError:
+            pass
+
+
+class Base64StreamDecoder:
+    """
+    增量 base64 解码器
+    按 4 字符对齐解码，不足一组的留到下一块；兼容 JSON 中转义的 "\\/"
+    """
+
+    def __init__(self, write: Callable[[bytes], None]):
+        self._write = write
+        self._pending = b""
+
+    def feed(self, data: bytes):
+        data = self._pending + data
+        # 块末尾的反斜杠可能是 "\/" 的一半，留到下一块处理
+        keep = b""
+        if data.endswith(b"\\"):
+            data, keep = data[:-1], b"\\"
+        data = data.replace(b"\\/", b"/").translate(None, b" \r\n\t")
+
+        usable = len(data) - len(data) % 4
+        if usable:
+            self._write(base64.b64decode(data[:usable]))
+        self._pending = data[usable:] + keep
+
+    def close(self):
+        rest = self._pending.rstrip(b"\\")
+        self._pending = b""
+        if rest:
+            self._write(base64.b64decode(rest + b"=" * (-len(rest) % 4)))
+
+
+def save_data_uri(data_uri: str, save_path: str, max_bytes: int = DEFAULT_MAX_BYTES,
+                  chunk_size: int = DEFAULT_CHUNK_SIZE) -> DownloadedImage:
+    """分块解码 data:image/...;base64, 并原子落盘，不再整体复制一份解码结果"""
+    # 格式: data:image/png;base64,.....
+    _, sep, encoded = data_uri.partition(",")
+    if not sep:
+        raise ImageDownloadError("Data URI 格式错误")
+
+    # 按 4 的倍数切片，保证每片都能独立解码
+    step = max(4, chunk_size - chunk_size % 4)
+    with ImageSink(save_path, max_bytes) as sink:
+        decoder = Base64StreamDecoder(sink.write)
+        for start in range(0, len(encoded), step):
+            decoder.feed(encoded[start:start + step].encode("ascii"))
+        decoder.close()
+        return sink.commit()
+
+
+class DataURIExtractor:
+    """
+    从 Chat 响应的字节流中增量提取第一张内联图片 (data:image/...;base64,...)
+    base64 部分边读边解码写入 ImageSink，不在内存中保留；
+    其余响应内容 (通常只有几百字节) 保存在 residual 中，没有内联图片时用于按原逻辑解析 URL
+    """
+
+    # JSON 编码时 "/" 可能被转义为 "\/"
+    MARKER = re.compile(rb"data:image\\?/")
+    MARKER_MAX_LEN = len(b"data:image\\/")
+    # base64 字符之外的字节 (或非 "\/" 的转义) 表示图片数据结束
+    PAYLOAD_END = re.compile(rb"[^A-Za-z0-9+/=\\]|\\(?!/)")
+    MAX_HEADER = 64
+
+    def __init__(self, save_path: str, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.save_path = save_path
+        self.max_bytes = max_bytes
+        self.residual = bytearray()
+        self.image: Optional[DownloadedImage] = None
+        self._state = "scan"
+        self._buffer = b""
+        self._sink: Optional[ImageSink] = None
+        self._decoder: Optional[Base64StreamDecoder] = None
+
+    def feed(self, chunk: bytes):
+        data = self._buffer + chunk
+        self._buffer = b""
+
+        while data:
+            if self._state == "scan":
+                match = self.MARKER.search(data)
+                if match is None:
+                    # 末尾可能是被切断的标记，留到下一块
+                    keep = self.MARKER_MAX_LEN - 1
+                    self.residual += data[:-keep]
+                    self._buffer = data[-keep:]
+                    return
+                idx = match.start()
+                self.residual += data[:idx]
+                data = data[idx:]
+                self._state = "header"
+
+            elif self._state == "header":
+                idx = data.find(b",")
+                if idx < 0:
+                    if len(data) > self.MAX_HEADER:
+                        # 不是合法的 Data URI 头，当作普通文本
+                        self.residual += data
+                        self._state = "scan"
+                        return
+                    self._buffer = data
+                    return
+                header = data[:idx]
+                if not header.endswith(b";base64"):
+                    self.residual += data[:idx + 1]
+                    data = data[idx + 1:]
+                    self._state = "scan"
+                    continue
+                self._sink = ImageSink(self.save_path, self.max_bytes)
+                self._decoder = Base64StreamDecoder(self._sink.write)
+                data = data[idx + 1:]
+                self._state = "payload"
+
+            elif self._state == "payload":
+                # 块末尾的单个反斜杠需要看到下一个字节才能判断
+                if data.endswith(b"\\"):
+                    data, self._buffer = data[:-1], b"\\"
+                match = self.PAYLOAD_END.search(data)
+                if match is None:
+                    self._decoder.feed(data)
+                    return
+                self._decoder.feed(data[:match.start()])
+                self._decoder.close()
+                self.image = self._sink.commit()
+                self.residual += data[match.start():]
+                self._state = "done"
+                return
+
+            else:
+                self.residual += data
+                return
+
+    def finish(self) -> Optional[DownloadedImage]:
+        """响应读取完毕后调用；图片数据被截断时抛出 ImageDownloadError"""
+        if self._state == "payload":
+            self.abort()
+            raise ImageDownloadError("内联图片数据不完整")
+        self.residual += self._buffer
+        self._buffer = b""
+        return self.image
+
+    def abort(self):
+        if self._sink is not None and self.image is None:
+            self._sink.abort()
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+异步生成任务队列
+提交后立即返回 job_id，由固定数量的 worker 执行生成流水线；
+任务状态写入 app.db (jobs 表)，服务重启后未完成的任务重新排队，
+客户端通过 SSE 或长轮询跟踪各阶段进度
+"""
+
+import asyncio
+import time
+import uuid
+from typing import AsyncIterator, Awaitable, Callable, Dict, Optional
+
+from .db_manager import DBManager
+
+# 任务状态
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+TERMINAL_STATUSES = (SUCCEEDED, FAILED)
+
+
+class JobError(Exception):
+    """任务失败，message 会作为 error 返回给客户端"""
+
+
+# handler(job, progress) -> result；progress(stage) 更新当前阶段
+Handler = Callable[[Dict, Callable[[str], Awaitable[None]]], Awaitable[Dict]]
+
+
+class JobQueue:
+    """
+    config.json -> jobs:
+      - workers: 并发执行的任务数 (按上游承载能力设置)
+      - retention: 已结束的任务在 jobs 表中保留的秒数 (默认 7 天，0 表示不清理)
+      - sweep_interval: 清理过期任务的间隔秒数 (默认 1 小时)
+
+    同一个 app.db 可以供多个队列使用 (如生成任务与后台落盘)，
+    每个队列只恢复自己注册过的任务类型
+
+    自带 Key (BYOK) 等敏感信息只保存在内存 (secrets)，不落库；
+    重启后需要这些信息的任务无法继续，直接标记为失败
+    """
+
+    def __init__(self, db: DBManager, cfg: Optional[Dict] = None, name: str = "任务队列"):
+        cfg = cfg or {}
+        self.db = db
+        self.name = name
+        self.workers = max(1, int(cfg.get("workers", 4)))
+        self.retention = float(cfg.get("retention", 7 * 24 * 3600))
+        self.sweep_interval = max(60.0, float(cfg.get("sweep_interval", 3600)))
+
+        self._handlers: Dict[str, Handler] = {}
+        self._secrets: Dict[str, Dict] = {}
+        self._events: Dict[str, asyncio.Event] = {}
+        self._watchers: Dict[str, int] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks = []
+
+    def register(self, kind: str, handler: Handler):
+        self._handlers[kind] = handler
+
+    # --- 生命周期 ---
+
+    async def start(self):
+        self._queue = asyncio.Queue()
+        await self._recover()
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        if self.retention > 0:
+            self._tasks.append(asyncio.create_task(self._sweeper()))
+        print(f"🧵 {self.name}已启动 ({self.workers} workers)")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _recover(self):
+        """重新排队上次未完成的任务 (执行中的任务从头开始)"""
+        jobs = [job for job in await asyncio.to_thread(self.db.get_unfinished_jobs) if job["kind"] in self._handlers]
+        requeued = 0
+        for job in jobs:
+            if (job["context"] or {}).get("needs_secrets"):
+                await asyncio.to_thread(self.db.update_job, job["id"], FAILED, "failed", None, "服务重启，自带 Key 的任务需要重新提交")
+                continue
+            if job["status"] == RUNNING:
+                await asyncio.to_thread(self.db.update_job, job["id"], QUEUED, "queued")
+            self._queue.put_nowait(job["id"])
+            requeued += 1
+        if jobs:
+            print(f"♻️ {self.name}恢复未完成任务: {requeued} 个重新排队，{len(jobs) - requeued} 个标记失败")
+
+    # --- 提交与查询 ---
+
+    async def submit(self, kind: str, request: Dict, user_id: Optional[int] = None,
+                     context: Optional[Dict] = None, secrets: Optional[Dict] = None) -> Dict:
+        if kind not in self._handlers:
+            raise ValueError(f"Unknown job kind: {kind}")
+        job_id = uuid.uuid4().hex
+        context = dict(context or {})
+        if secrets:
+            context["needs_secrets"] = True
+            self._secrets[job_id] = secrets
+        await asyncio.to_thread(self.db.create_job, job_id, kind, user_id, request, context)
+        self._queue.put_nowait(job_id)
+        return await self.get(job_id)
+
+    async def get(self, job_id: str) -> Optional[Dict]:
+        job = await asyncio.to_thread(self.db.get_job, job_id)
+        if job is not None:
+            job.pop("context", None)
+        return job
+
+    async def watch(self, job_id: str, since: float = 0, timeout: float = 15) -> AsyncIterator[Optional[Dict]]:
+        """
+        每次任务状态变化时产出最新状态，直到任务结束；
+        timeout 秒内无变化时产出 None (调用方可据此发送心跳)
+        """
+        self._watchers[job_id] = self._watchers.get(job_id, 0) + 1
+        try:
+            while True:
+                # 先登记等待事件再读取状态，避免错过两者之间发生的更新
+                event = self._events.setdefault(job_id, asyncio.Event())
+                job = await self.get(job_id)
+                if job is None:
+                    return
+                if job["updated_at"] > since:
+                    since = job["updated_at"]
+                    yield job
+                    if job["status"] in TERMINAL_STATUSES:
+                        return
+                    continue
+                try:
+                    await asyncio.wait_for(event.wait(), timeout)
+                except asyncio.TimeoutError:
+                    yield None
+        finally:
+            # 最后一个等待方离开 (含客户端中途断开) 时释放等待事件
+            self._watchers[job_id] -= 1
+            if not self._watchers[job_id]:
+                del self._watchers[job_id]
+                self._events.pop(job_id, None)
+
+    async def wait(self, job_id: str, since: float = 0, timeout: float = 25) -> Optional[Dict]:
+        """长轮询: 返回 updated_at 晚于 since 的状态，超时则返回当前状态"""
+        async for job in self.watch(job_id, since=since, timeout=timeout):
+            if job is not None:
+                return job
+            break
+        return await self.get(job_id)
+
+    # --- 执行 ---
+
+    async def _sweeper(self):
+        """定期删除超过保留期的已结束任务 (只处理本队列注册的任务类型)"""
+        while True:
+            try:
+                deleted = await asyncio.to_thread(self.db.delete_finished_jobs, list(self._handlers), time.time() - self.retention)
+                if deleted:
+                    print(f"🧹 {self.name}清理过期任务 {deleted} 个")
+            except Exception as e:
+                print(f"⚠️ {self.name}清理过期任务失败: {e}")
+            await asyncio.sleep(self.sweep_interval)
+
+    def _notify(self, job_id: str):
+        event = self._events.pop(job_id, None)
+        if event is not None:
+            event.set()
+
+    async def _update(self, job_id: str, status: str = None, stage: str = None, result: Dict = None, error: str = None):
+        await asyncio.to_thread(self.db.update_job, job_id, status, stage, result, error)
+        self._notify(job_id)
+
+    async def _worker(self, index: int):
+        while True:
+            job_id = await self._queue.get()
+            try:
+                await self._run(job_id)
+            except Exception as e:
+                print(f"❌ Worker #{index} 执行任务 {job_id} 异常: {e}")
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job_id: str):
+        job = await asyncio.to_thread(self.db.get_job, job_id)
+        if job is None or job["status"] in TERMINAL_STATUSES:
+            return
+
+        job["secrets"] = self._secrets.get(job_id, {})
+        handler = self._handlers[job["kind"]]
+
+        async def progress(stage: str):
+            await self._update(job_id, stage=stage)
+
+        started = time.time()
+        await self._update(job_id, RUNNING, "started")
+        try:
+            result = await handler(job, progress)
+        except Exception as e:
+            await self._update(job_id, FAILED, "failed", error=str(e) or type(e).__name__)
+            print(f"❌ 任务 {job_id} 失败 ({time.time() - started:.1f}s): {e}")
+        else:
+            await self._update(job_id, SUCCEEDED, "done", result=result)
+            print(f"✅ 任务 {job_id} 完成 ({time.time() - started:.1f}s)")
+        finally:
+            self._secrets.pop(job_id, None)
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+按 Key 的客户端限速
+每个 (Key, 模型) 一个 GCRA 令牌桶: 速率来自配置，并根据上游返回的
+Retry-After / x-ratelimit-* 响应头自适应调整；请求发出前预约令牌，
+短暂等待或换到还有余量的 Key，把突发流量摊平，减少 429 与无效的往返
+"""
+
+import email.utils
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from .key_scheduler import mask_key
+
+# 未给出 Retry-After 的 429 的默认封禁秒数
+DEFAULT_PENALTY = 2.0
+# Retry-After 的上限，防止异常值把 Key 长时间锁死
+MAX_RETRY_AFTER = 600.0
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Retry-After: 秒数或 HTTP 日期"""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when is None:
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+
+def parse_duration(value: Optional[str]) -> Optional[float]:
+    """x-ratelimit-reset-* 的时长: "1s" / "6m0s" / "250ms" / 纯秒数"""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    parts = _DURATION_PART.findall(value)
+    if not parts:
+        return None
+    return sum(float(num) * _DURATION_UNITS[unit] for num, unit in parts)
+
+
+class _Bucket:
+    """GCRA: tat 为理论到达时间，interval 为令牌间隔，tolerance 允许的突发量"""
+
+    def __init__(self, key: str, model: str, rpm: float, burst: int):
+        self.key = key
+        self.model = model
+        self.configured_rpm = rpm
+        self.learned_rpm: Optional[float] = None
+        self.burst = max(1, burst)
+        self.tat = 0.0
+        self.blocked_until = 0.0
+        self.throttled = 0
+        self.waited = 0.0
+
+    @property
+    def rpm(self) -> float:
+        """生效速率: 配置与上游告知的限额取较小者 (0 表示不限)"""
+        rates = [r for r in (self.configured_rpm, self.learned_rpm) if r]
+        return min(rates) if rates else 0.0
+
+    def ready_in(self, now: float) -> float:
+        wait = max(0.0, self.blocked_until - now)
+        rpm = self.rpm
+        if rpm:
+            interval = 60.0 / rpm
+            wait = max(wait, self.tat - interval * (self.burst - 1) - now)
+        return wait
+
+    def take(self, now: float, wait: float):
+        rpm = self.rpm
+        if rpm:
+            self.tat = max(self.tat, now) + 60.0 / rpm
+        self.waited += wait
+
+    def to_dict(self, now: float) -> Dict:
+        return {
+            "key": mask_key(self.key),
+            "model": self.model,
+            "rpm": round(self.rpm, 2) if self.rpm else None,
+            "learned_rpm": self.learned_rpm,
+            "burst": self.burst,
+            "ready_in": round(self.ready_in(now), 2),
+            "throttled": self.throttled,
+            "waited": round(self.waited, 1),
+        }
+
+
+class KeyRateLimiter:
+    """
+    config.json -> key_rate:
+      - enabled: 是否启用 (默认 true)
+      - rpm: 每个系统 Key 每个模型的默认每分钟请求数 (0 表示只按上游响应头限速)
+      - burst: 允许的突发请求数
+      - models: 按模型覆盖 rpm / burst，如 {"gemini-3-pro-image-preview": {"rpm": 10}}
+      - max_wait: 还有其他 Key 可用时，在当前 Key 上最多等待的秒数，超过则换 Key
+    自带 Key (BYOK) 不使用配置速率，只遵守上游返回的 Retry-After 与限额
+    """
+
+    MAX_BUCKETS = 1024
+
+    def __init__(self, cfg: Optional[Dict] = None):
+        cfg = cfg or {}
+        self.enabled = bool(cfg.get("enabled", True))
+        self.rpm = float(cfg.get("rpm", 0))
+        self.burst = int(cfg.get("burst", 1))
+        self.model_limits = cfg.get("models", {}) or {}
+        self.max_wait = float(cfg.get("max_wait", 5))
+
+        self._lock = threading.Lock()
+        self._buckets: "OrderedDict[tuple, _Bucket]" = OrderedDict()
+
+    def _bucket(self, key: str, model: str, configured: bool) -> _Bucket:
+        # BYOK Key 只保存摘要
+        ident = key if configured else "byok:" + hashlib.sha256(key.encode("utf-8")).hexdigest()[:12]
+        bucket_key = (ident, model or "")
+        bucket = self._buckets.get(bucket_key)
+        if bucket is None:
+            limits = self.model_limits.get(model or "", {}) or {}
+            rpm = float(limits.get("rpm", self.rpm)) if configured else 0.0
+            burst = int(limits.get("burst", self.burst))
+            bucket = self._buckets[bucket_key] = _Bucket(key if configured else ident, model or "", rpm, burst)
+            while len(self._buckets) > self.MAX_BUCKETS:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(bucket_key)
+        return bucket
+
+    def ready_in(self, key: str, model: str, configured: bool = True) -> float:
+        """该 Key 还需多久才有令牌 (0 表示立即可用)"""
+        if not self.enabled or not key:
+            return 0.0
+        with self._lock:
+            return self._bucket(key, model, configured).ready_in(time.monotonic())
+
+    def order(self, keys: List[str], model: str) -> List[str]:
+        """有余量的 Key 排在前面 (稳定排序，保留调度器给出的顺序)"""
+        if not self.enabled or len(keys) <= 1:
+            return keys
+        now = time.monotonic()
+        with self._lock:
+            waits = {key: self._bucket(key, model, True).ready_in(now) if key else 0.0 for key in keys}
+        return sorted(keys, key=lambda key: waits[key])
+
+    def reserve(self, key: str, model: str, max_wait: Optional[float], configured: bool = True) -> Optional[float]:
+        """
+        预约一个令牌
+        Returns: 发出请求前需要等待的秒数；等待时间超过 max_wait 时不预约并返回 None
+        """
+        if not self.enabled or not key:
+            return 0.0
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._bucket(key, model, configured)
+            wait = bucket.ready_in(now)
+            if max_wait is not None and wait > max_wait:
+                return None
+            bucket.take(now, wait)
+            return wait
+
+    def observe(self, key: str, model: str, status: Optional[int], headers, configured: bool = True):
+        """根据上游响应更新限速状态 (429 / Retry-After / x-ratelimit-* 响应头)"""
+        if not self.enabled or not key or headers is None:
+            return
+
+        retry_after = parse_retry_after(headers.get("retry-after"))
+        retry_after_ms = headers.get("retry-after-ms")
+        if retry_after_ms:
+            try:
+                retry_after = max(0.0, float(retry_after_ms) / 1000)
+            except ValueError:
+                pass
+
+        limit = headers.get("x-ratelimit-limit-requests")
+        remaining = headers.get("x-ratelimit-remaining-requests")
+        reset = parse_duration(headers.get("x-ratelimit-reset-requests"))
+
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._bucket(key, model, configured)
+
+            if limit:
+                try:
+                    # 各家中转通常按分钟给出请求限额
+                    bucket.learned_rpm = float(limit) or None
+                except ValueError:
+                    pass
+
+            block = None
+            if status == 429:
+                bucket.throttled += 1
+                block = retry_after if retry_after is not None else (reset if reset is not None else DEFAULT_PENALTY)
+            elif remaining is not None and reset is not None:
+                try:
+                    if int(float(remaining)) <= 0:
+                        block = reset
+                except ValueError:
+                    pass
+            elif status == 503 and retry_after is not None:
+                block = retry_after
+
+            if block is not None:
+                block = min(block, MAX_RETRY_AFTER)
+                bucket.blocked_until = max(bucket.blocked_until, now + block)
+                if status == 429:
+                    print(f"🚦 Key {mask_key(key)} 被限流，{block:.1f}s 后再使用")
+
+    def snapshot(self) -> List[Dict]:
+        now = time.monotonic()
+        with self._lock:
+            return [bucket.to_dict(now) for bucket in self._buckets.values()]
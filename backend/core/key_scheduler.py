@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+系统 Key 调度器
+在 api_keys / special_keys 之间分摊负载，按 Key 统计成功率与延迟，
+连续失败的 Key 熔断一段时间 (open)，冷却后放行一次探测请求 (half-open)
+"""
+
+import threading
+import time
+from typing import Dict, List, Optional
+
+
+def mask_key(key: str) -> str:
+    """脱敏显示 Key"""
+    if not key:
+        return "(empty)"
+    if len(key) <= 10:
+        return key[:2] + "…"
+    return f"{key[:6]}…{key[-4:]}"
+
+
+class KeyState:
+    """单个 Key 的健康状态"""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, key: str):
+        self.key = key
+        self.state = self.CLOSED
+        self.in_flight = 0
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.latency_ewma: Optional[float] = None
+        self.last_status: Optional[int] = None
+        self.last_used = 0.0
+        self.opened_at = 0.0
+        self.cooldown = 0.0
+        self.probe_started = 0.0
+
+    @property
+    def success_rate(self) -> Optional[float]:
+        total = self.successes + self.failures
+        return self.successes / total if total else None
+
+    def probe_due(self, now: float, probe_timeout: float) -> bool:
+        """可以放行探测请求: 熔断冷却已结束，或上一个探测请求超过 probe_timeout 仍无结论"""
+        if self.state == self.OPEN:
+            return self.cooldown_left(now) <= 0
+        return self.state == self.HALF_OPEN and now - self.probe_started > probe_timeout
+
+    def cooldown_left(self, now: float) -> float:
+        if self.state != self.OPEN:
+            return 0.0
+        return max(0.0, self.opened_at + self.cooldown - now)
+
+    def to_dict(self, now: float) -> Dict:
+        rate = self.success_rate
+        return {
+            "key": mask_key(self.key),
+            "state": self.state,
+            "in_flight": self.in_flight,
+            "successes": self.successes,
+            "failures": self.failures,
+            "consecutive_failures": self.consecutive_failures,
+            "success_rate": round(rate, 3) if rate is not None else None,
+            "latency_ewma": round(self.latency_ewma, 3) if self.latency_ewma is not None else None,
+            "last_status": self.last_status,
+            "cooldown_left": round(self.cooldown_left(now), 1),
+        }
+
+
+class KeyScheduler:
+    """
+    Key 调度与熔断
+
+    strategy:
+      - least_in_flight: 优先选择并发最少的 Key，并发相同时轮询
+      - round_robin: 纯轮询
+    """
+
+    # 这些状态码说明 Key 本身不可用 (鉴权失败 / 欠费)，直接熔断
+    FATAL_STATUSES = (401, 402, 403)
+    # 这些状态码 (含网络错误 None) 计入连续失败
+    FAILURE_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, cfg: Optional[Dict] = None):
+        cfg = cfg or {}
+        self.strategy = cfg.get("strategy", "least_in_flight")
+        self.failure_threshold = int(cfg.get("failure_threshold", 3))
+        self.cooldown = float(cfg.get("cooldown", 30))
+        self.max_cooldown = float(cfg.get("max_cooldown", 600))
+        self.ewma_alpha = float(cfg.get("ewma_alpha", 0.3))
+        self.probe_timeout = float(cfg.get("probe_timeout", 120))
+
+        self._lock = threading.Lock()
+        self._states: Dict[str, KeyState] = {}
+        self._rr_offset = 0
+
+    def _state(self, key: str) -> KeyState:
+        state = self._states.get(key)
+        if state is None:
+            state = self._states[key] = KeyState(key)
+        return state
+
+    def register(self, keys: List[str]):
+        """预先登记 Key，使管理员在首次请求前也能看到它们"""
+        with self._lock:
+            for key in keys:
+                if key:
+                    self._state(key)
+
+    def plan(self, keys: List[str]) -> List[str]:
+        """
+        给出本次请求尝试 Key 的顺序
+        健康的 Key 在前；冷却结束的熔断 Key 作为探测放在其后；仍在冷却的 Key 被跳过。
+        若全部 Key 都在冷却，按最早解除熔断的顺序返回，保证请求仍有机会发出。
+        """
+        if len(keys) <= 1:
+            return list(keys)
+
+        now = time.time()
+        with self._lock:
+            self._rr_offset = (self._rr_offset + 1) % len(keys)
+            offset = self._rr_offset
+
+            def rotation(idx: int) -> int:
+                return (idx - offset) % len(keys)
+
+            healthy, probes, cooling = [], [], []
+            for idx, key in enumerate(keys):
+                state = self._state(key)
+                if state.state == KeyState.CLOSED:
+                    healthy.append((idx, state))
+                elif state.probe_due(now, self.probe_timeout):
+                    probes.append((idx, state))
+                else:
+                    # OPEN 冷却中，或 HALF_OPEN 已有探测请求在途 (未超时)
+                    cooling.append((idx, state))
+
+            if self.strategy == "round_robin":
+                healthy.sort(key=lambda item: rotation(item[0]))
+            else:
+                healthy.sort(key=lambda item: (item[1].in_flight, rotation(item[0])))
+
+            ordered = [s.key for _, s in healthy] + [s.key for _, s in probes]
+            if not ordered:
+                cooling.sort(key=lambda item: item[1].cooldown_left(now))
+                ordered = [s.key for _, s in cooling]
+            return ordered
+
+    def acquire(self, key: str):
+        """请求发出前调用"""
+        now = time.time()
+        with self._lock:
+            state = self._state(key)
+            state.in_flight += 1
+            state.last_used = now
+            if state.probe_due(now, self.probe_timeout):
+                if state.state == KeyState.HALF_OPEN:
+                    print(f"🩺 Key {mask_key(key)} 探测请求超过 {self.probe_timeout:.0f}s 无结论，重新探测")
+                else:
+                    print(f"🩺 Key {mask_key(key)} 冷却结束，放行探测请求")
+                state.state = KeyState.HALF_OPEN
+                state.probe_started = now
+
+    def release(self, key: str, status: Optional[int], latency: float):
+        """
+        请求结束后调用
+        :param status: HTTP 状态码，网络异常时为 None
+        """
+        now = time.time()
+        with self._lock:
+            state = self._state(key)
+            state.in_flight = max(0, state.in_flight - 1)
+            state.last_status = status
+
+            if status == 200:
+                state.successes += 1
+                state.consecutive_failures = 0
+                if state.latency_ewma is None:
+                    state.latency_ewma = latency
+                else:
+                    state.latency_ewma += self.ewma_alpha * (latency - state.latency_ewma)
+                if state.state != KeyState.CLOSED:
+                    print(f"✅ Key {mask_key(key)} 恢复可用")
+                state.state = KeyState.CLOSED
+                state.cooldown = 0.0
+                return
+
+            if status is not None and status not in self.FATAL_STATUSES and status not in self.FAILURE_STATUSES:
+                # 4xx 请求错误与 Key 健康无关；但上游已正常应答，探测请求据此结束熔断
+                if state.state == KeyState.HALF_OPEN:
+                    print(f"✅ Key {mask_key(key)} 恢复可用 (status={status})")
+                    state.state = KeyState.CLOSED
+                    state.cooldown = 0.0
+                    state.consecutive_failures = 0
+                return
+
+            state.failures += 1
+            state.consecutive_failures += 1
+
+            should_open = (
+                status in self.FATAL_STATUSES
+                or state.state == KeyState.HALF_OPEN
+                or state.consecutive_failures >= self.failure_threshold
+            )
+            if should_open:
+                # 反复熔断时冷却时间指数增长
+                state.cooldown = min(self.max_cooldown, state.cooldown * 2 if state.cooldown else self.cooldown)
+                state.state = KeyState.OPEN
+                state.opened_at = now
+                print(f"⛔ Key {mask_key(key)} 熔断 {state.cooldown:.0f}s (status={status})")
+
+    def cancel(self, key: str):
+        """
+        请求被取消 (对冲落败、客户端断开) 时调用: 只归还占用，不计成功或失败；
+        被取消的探测请求不算结论，恢复为冷却已结束的熔断状态，下一个请求重新探测
+        """
+        with self._lock:
+            state = self._state(key)
+            state.in_flight = max(0, state.in_flight - 1)
+            if state.state == KeyState.HALF_OPEN:
+                state.state = KeyState.OPEN
+
+    def snapshot(self) -> List[Dict]:
+        """供管理员查看的各 Key 状态"""
+        now = time.time()
+        with self._lock:
+            return [state.to_dict(now) for state in self._states.values()]
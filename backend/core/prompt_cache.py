@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Magic Optimize 结果缓存
+同一个班级的学生经常对同一个简短提示词 ("猫"、"photosynthesis") 做优化，
+命中缓存时直接返回，不再调用 LLM。SQLite 持久化 (重启不丢失)，前面加一层进程内 LRU
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import closing
+from typing import Dict, Optional
+
+
+class PromptCache:
+    """
+    config.json -> optimize_cache:
+      - enabled: 是否启用 (默认 true)
+      - ttl: 缓存有效期 (秒，默认 7 天)
+      - max_entries: SQLite 中最多保留的条目数，超出时淘汰最久未命中的
+      - memory_entries: 进程内 LRU 条目数
+    """
+
+    def __init__(self, db_path: str = None, cfg: Optional[Dict] = None):
+        if db_path is None:
+            base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+            self.db_path = os.path.join(base_dir, "data", "prompt_cache.db")
+        else:
+            self.db_path = db_path
+
+        cfg = cfg or {}
+        self.enabled = bool(cfg.get("enabled", True))
+        self.ttl = float(cfg.get("ttl", 7 * 24 * 3600))
+        self.max_entries = int(cfg.get("max_entries", 5000))
+        self.memory_entries = int(cfg.get("memory_entries", 256))
+
+        self._lock = threading.Lock()
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (value, created_at)
+        self.memory_hits = 0
+        self.db_hits = 0
+        self.misses = 0
+
+        self._init_db()
+
+    def _get_conn(self):
+        return sqlite3.connect(self.db_path)
+
+    def _init_db(self):
+        """初始化数据库表"""
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        with closing(self._get_conn()) as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS optimize_cache (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_hit REAL NOT NULL,
+                    hits INTEGER DEFAULT 0
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_optimize_last_hit ON optimize_cache (last_hit)")
+            conn.commit()
+
+    @staticmethod
+    def normalize(prompt: str) -> str:
+        """忽略大小写与多余空白"""
+        return " ".join((prompt or "").split()).casefold()
+
+    @staticmethod
+    def make_key(*parts) -> str:
+        return hashlib.sha256(json.dumps(parts, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        if not self.enabled:
+            return None
+
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if now - entry[1] < self.ttl:
+                    self._memory.move_to_end(key)
+                    self.memory_hits += 1
+                    return entry[0]
+                del self._memory[key]
+
+        with closing(self._get_conn()) as conn:
+            row = conn.execute(
+                "SELECT value, created_at FROM optimize_cache WHERE key = ? AND created_at > ?",
+                (key, now - self.ttl)
+            ).fetchone()
+            if row:
+                conn.execute("UPDATE optimize_cache SET hits = hits + 1, last_hit = ? WHERE key = ?", (now, key))
+                conn.commit()
+
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.db_hits += 1
+            self._remember(key, row[0], row[1])
+        return row[0]
+
+    def put(self, key: str, value: str):
+        if not self.enabled:
+            return
+
+        now = time.time()
+        with closing(self._get_conn()) as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO optimize_cache (key, value, created_at, last_hit, hits) VALUES (?, ?, ?, ?, 0)",
+                (key, value, now, now)
+            )
+            # 过期条目与超出上限的最久未命中条目
+            conn.execute("DELETE FROM optimize_cache WHERE created_at <= ?", (now - self.ttl,))
+            overflow = conn.execute("SELECT COUNT(*) FROM optimize_cache").fetchone()[0] - self.max_entries
+            if overflow > 0:
+                conn.execute(
+                    "DELETE FROM optimize_cache WHERE key IN (SELECT key FROM optimize_cache ORDER BY last_hit ASC LIMIT ?)",
+                    (overflow,)
+                )
+            conn.commit()
+
+        with self._lock:
+            self._remember(key, value, now)
+
+    def _remember(self, key: str, value: str, created_at: float):
+        self._memory[key] = (value, created_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def purge(self) -> int:
+        """清空缓存，返回删除的条目数"""
+        with closing(self._get_conn()) as conn:
+            deleted = conn.execute("DELETE FROM optimize_cache").rowcount
+            conn.commit()
+        with self._lock:
+            self._memory.clear()
+        print(f"🧹 已清空提示词优化缓存 ({deleted} 条)")
+        return deleted
+
+    def stats(self) -> Dict:
+        with closing(self._get_conn()) as conn:
+            entries = conn.execute("SELECT COUNT(*) FROM optimize_cache").fetchone()[0]
+        with self._lock:
+            lookups = self.memory_hits + self.db_hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "entries": entries,
+                "memory_entries": len(self._memory),
+                "memory_hits": self.memory_hits,
+                "db_hits": self.db_hits,
+                "misses": self.misses,
+                "hit_rate": round((self.memory_hits + self.db_hits) / lookups, 3) if lookups else None,
+            }
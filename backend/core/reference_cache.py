@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+参考图预处理缓存
+图生图请求需要把参考图以 base64 Data URI 内嵌到请求 JSON 中。
+同一张上传图 / 生成图经常被反复修改，这里把 "缩放到最长边 + 重新编码" 的结果
+按 (路径, mtime, 文件大小, 处理参数) 缓存在进程内 LRU 中，只做一次；
+缓存的是编码后的二进制，base64 在发送请求体时分块生成 (见 request_body.py)
+"""
+
+import io
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from PIL import Image
+
+from .request_body import StreamedDataURI
+
+# 重新编码格式 -> (PIL 格式名, MIME)
+FORMATS = {
+    "jpeg": ("JPEG", "image/jpeg"),
+    "png": ("PNG", "image/png"),
+    "webp": ("WEBP", "image/webp"),
+}
+
+
+def _guess_mime(path: str) -> str:
+    lower = path.lower()
+    if lower.endswith((".jpg", ".jpeg")):
+        return "image/jpeg"
+    if lower.endswith(".webp"):
+        return "image/webp"
+    return "image/png"
+
+
+class ReferenceCache:
+    """
+    参考图 LRU 缓存
+
+    config.json -> reference:
+      - max_edge: 最长边像素，超过则等比缩小 (0 表示不缩放)
+      - format: auto (有透明通道用 png，否则 jpeg) / jpeg / png / webp / original (不重新编码)
+      - quality: jpeg / webp 质量
+      - max_entries / max_mb: 缓存条目数与总大小上限
+      - models: 按模型覆盖以上处理参数，如 {"gemini-3-pro-image-preview": {"max_edge": 2048}}
+    """
+
+    def __init__(self, cfg: Optional[Dict] = None):
+        cfg = cfg or {}
+        self.max_edge = int(cfg.get("max_edge", 1536))
+        self.format = str(cfg.get("format", "auto")).lower()
+        self.quality = int(cfg.get("quality", 90))
+        self.max_entries = int(cfg.get("max_entries", 64))
+        self.max_bytes = int(cfg.get("max_mb", 256)) * 1024 * 1024
+        self.model_overrides = cfg.get("models", {}) or {}
+
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Tuple, StreamedDataURI]" = OrderedDict()
+        self._total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _profile(self, model: str = None) -> Tuple[int, str, int]:
+        """该模型使用的处理参数；参数相同的模型共享缓存条目"""
+        override = self.model_overrides.get(model or "", {}) or {}
+        return (
+            int(override.get("max_edge", self.max_edge)),
+            str(override.get("format", self.format)).lower(),
+            int(override.get("quality", self.quality)),
+        )
+
+    def get(self, path: str, model: str = None) -> StreamedDataURI:
+        """返回处理后的参考图 (命中缓存时不再解码文件)；无需处理的原图只记录路径，发送时直接从磁盘读取"""
+        st = os.stat(path)
+        key = (os.path.realpath(path), st.st_mtime_ns, st.st_size) + self._profile(model)
+
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return cached
+            self.misses += 1
+
+        # 解码 / 缩放放在锁外，不阻塞其他请求的命中
+        prepared = self._prepare(path, *key[3:])
+
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = prepared
+                self._total_bytes += self._weight(prepared)
+            self._evict()
+        return prepared
+
+    @staticmethod
+    def _weight(prepared: StreamedDataURI) -> int:
+        return len(prepared.data) if prepared.data is not None else 0
+
+    def _evict(self):
+        while self._entries and (len(self._entries) > self.max_entries or self._total_bytes > self.max_bytes):
+            _, evicted = self._entries.popitem(last=False)
+            self._total_bytes -= self._weight(evicted)
+
+    def _prepare(self, path: str, max_edge: int, fmt: str, quality: int) -> StreamedDataURI:
+        original = StreamedDataURI(_guess_mime(path), path=path)
+        if fmt == "original":
+            return original
+
+        raw_size = os.path.getsize(path)
+        try:
+            with Image.open(path) as img:
+                img.load()
+                original_size = img.size
+                has_alpha = img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info)
+
+                if fmt == "auto":
+                    fmt = "png" if has_alpha else "jpeg"
+                pil_format, mime = FORMATS.get(fmt, FORMATS["jpeg"])
+
+                if max_edge and max(img.size) > max_edge:
+                    img.thumbnail((max_edge, max_edge), Image.LANCZOS)
+                if pil_format == "JPEG" and img.mode != "RGB":
+                    img = img.convert("RGB")
+
+                buf = io.BytesIO()
+                save_kwargs = {"quality": quality} if pil_format in ("JPEG", "WEBP") else {"optimize": True}
+                img.save(buf, pil_format, **save_kwargs)
+                encoded = buf.getvalue()
+        except Exception as e:
+            print(f"⚠️ 参考图预处理失败，使用原图: {e}")
+            return original
+
+        # 未缩放且重新编码反而更大时，直接用原图
+        if img.size == original_size and len(encoded) >= raw_size:
+            return original
+
+        print(f"🗜️ 参考图预处理: {original_size[0]}x{original_size[1]} {raw_size} bytes -> "
+              f"{img.size[0]}x{img.size[1]} {len(encoded)} bytes ({mime})")
+        return StreamedDataURI(mime, data=encoded)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._total_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+流式 JSON 请求体
+图生图请求中的参考图以 StreamedDataURI 占位，发送时先输出 JSON 外壳，
+再从磁盘 (或参考图缓存) 分块 base64 编码写出，通过 chunked 传输发送，
+内存占用与参考图的数量和大小无关
+"""
+
+import asyncio
+import base64
+import json
+import re
+import uuid
+from typing import AsyncIterator, Iterator, Optional
+
+# 3 的倍数，保证每块可以独立 base64 编码
+DEFAULT_READ_SIZE = 48 * 1024
+# aiter() 每次进入线程时读取并编码的字节数上限 (减少线程切换次数)
+ASYNC_BATCH_SIZE = 256 * 1024
+
+
+class StreamedDataURI:
+    """
+    请求体中待流式写出的 Data URI
+    data 不为空时编码内存中的数据 (如缩放后的参考图)，否则分块读取 path 指向的文件
+    """
+
+    def __init__(self, mime: str, path: Optional[str] = None, data: Optional[bytes] = None):
+        self.mime = mime
+        self.path = path
+        self.data = data
+
+    def iter_base64(self, read_size: int = DEFAULT_READ_SIZE) -> Iterator[bytes]:
+        read_size = max(3, read_size - read_size % 3)
+        if self.data is not None:
+            view = memoryview(self.data)
+            for start in range(0, len(view), read_size):
+                yield base64.b64encode(view[start:start + read_size])
+            return
+        with open(self.path, "rb") as f:
+            while True:
+                chunk = f.read(read_size)
+                if not chunk:
+                    break
+                yield base64.b64encode(chunk)
+
+    def __repr__(self):
+        source = f"{len(self.data)} bytes" if self.data is not None else self.path
+        return f"StreamedDataURI({self.mime}, {source})"
+
+
+def contains_streamed(obj) -> bool:
+    """payload 中是否含有需要流式写出的部分"""
+    if isinstance(obj, StreamedDataURI):
+        return True
+    if isinstance(obj, dict):
+        return any(contains_streamed(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return any(contains_streamed(v) for v in obj)
+    return False
+
+
+class StreamingJSONBody:
+    """
+    可重复迭代的 JSON 请求体 (每次迭代重新读取参考图，重试时可直接复用)
+    同步客户端 (requests) 直接迭代；httpx.AsyncClient 使用 aiter()，读盘与编码在线程中进行
+    """
+
+    def __init__(self, payload: dict, read_size: int = DEFAULT_READ_SIZE):
+        self.payload = payload
+        self.read_size = read_size
+
+    def __iter__(self) -> Iterator[bytes]:
+        sources = []
+        # 占位符带随机前缀，避免与提示词等正文内容冲突
+        nonce = uuid.uuid4().hex
+
+        def placeholder(obj):
+            if isinstance(obj, StreamedDataURI):
+                sources.append(obj)
+                return f"@@{nonce}:{len(sources) - 1}@@"
+            raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+        envelope = json.dumps(self.payload, default=placeholder)
+        pos = 0
+        for match in re.finditer(f'"@@{nonce}:(\\d+)@@"', envelope):
+            source = sources[int(match.group(1))]
+            yield envelope[pos:match.start()].encode("utf-8")
+            yield f'"data:{source.mime};base64,'.encode("ascii")
+            yield from source.iter_base64(self.read_size)
+            yield b'"'
+            pos = match.end()
+        yield envelope[pos:].encode("utf-8")
+
+    async def aiter(self) -> AsyncIterator[bytes]:
+        iterator = iter(self)
+
+        def next_batch() -> bytes:
+            # 读参考图文件与 base64 编码都在这里 (线程中) 完成，不阻塞事件循环
+            parts, size = [], 0
+            for chunk in iterator:
+                parts.append(chunk)
+                size += len(chunk)
+                if size >= ASYNC_BATCH_SIZE:
+                    break
+            return b"".join(parts)
+
+        try:
+            while True:
+                batch = await asyncio.to_thread(next_batch)
+                if not batch:
+                    break
+                yield batch
+        finally:
+            try:
+                iterator.close()
+            except ValueError:
+                # 被取消时线程可能仍在读取，读完后由垃圾回收关闭文件
+                pass
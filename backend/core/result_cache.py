@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+生成结果缓存 (按内容寻址)
+老师把同一道练习题的提示词发给全班，几十个学生会提交完全相同的请求。
+按 (增强后的提示词, 模型, 尺寸, 画质, 风格, 参考图内容摘要) 精确匹配，
+命中时直接复用 GENERATED_DIR 中已生成的图片，不调用上游、不消耗额度。
+索引保存在 app.db (result_cache 表)，按学科开启
+"""
+
+import hashlib
+import os
+import shutil
+import threading
+from typing import Dict, List, Optional
+
+from .db_manager import DBManager
+from .image_io import DownloadedImage, sniff_image_type
+
+
+class ResultCacheError(Exception):
+    """命中缓存但无法把缓存的图片放到目标路径"""
+
+
+def file_digest(path: str, chunk_size: int = 1024 * 1024) -> str:
+    """文件内容的 sha256"""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _thumb_path(path: str) -> str:
+    base, _ = os.path.splitext(path)
+    return f"{base}.thumb.jpg"
+
+
+class ResultCache:
+    """
+    config.json -> result_cache:
+      - enabled: 是否启用 (默认 false)
+      - subjects: 开启缓存的学科列表，["*"] 表示全部
+      - ttl: 条目有效期 (秒，0 表示不过期)
+    请求体中 force_fresh=true 时跳过查找，生成后用新结果替换缓存条目；
+    自带 Key / base_url 的请求不查找也不写入 (键中不含上游，不能与系统上游的结果混用)
+    """
+
+    def __init__(self, db: DBManager, generated_dir: str, cfg: Optional[Dict] = None):
+        cfg = cfg or {}
+        self.db = db
+        self.generated_dir = generated_dir
+        self.enabled = bool(cfg.get("enabled", False))
+        self.subjects = set(cfg.get("subjects", ["*"]) or [])
+        self.ttl = float(cfg.get("ttl", 0))
+
+        self._lock = threading.Lock()
+        self._digests: Dict[tuple, str] = {}  # (path, mtime_ns, size) -> sha256
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.skipped = 0
+        self.errors = 0
+
+    def applies_to(self, subject: str) -> bool:
+        return self.enabled and ("*" in self.subjects or (subject or "general") in self.subjects)
+
+    def _ref_digest(self, path: str) -> str:
+        st = os.stat(path)
+        key = (os.path.realpath(path), st.st_mtime_ns, st.st_size)
+        with self._lock:
+            digest = self._digests.get(key)
+        if digest is None:
+            digest = file_digest(path)
+            with self._lock:
+                if len(self._digests) > 1024:
+                    self._digests.clear()
+                self._digests[key] = digest
+        return digest
+
+    def make_key(self, enhanced_prompt: str, model: str, size: str, quality: str, style: str, ref_paths: List[str]) -> str:
+        """参考图按内容摘要参与计算 (同一张图重新上传也能命中)；会读取文件，应在线程中调用"""
+        refs = sorted(self._ref_digest(p) for p in ref_paths)
+        material = "\x1f".join([enhanced_prompt, model or "", size or "", quality or "", style or ""] + refs)
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    def lookup(self, key: str, save_path: str) -> Optional[DownloadedImage]:
+        """
+        命中时把缓存的图片以硬链接 (不支持时复制) 放到 save_path，连同缩略图；
+        原文件已被删除的条目视为失效；链接与复制都失败时抛出 ResultCacheError
+        (调用方不应因此改为重新生成并扣费)
+        """
+        entry = self.db.get_cached_result(key, self.ttl or None)
+        source = os.path.join(self.generated_dir, entry["filename"]) if entry else None
+        if entry is None or not os.path.exists(source):
+            with self._lock:
+                if entry is None:
+                    self.misses += 1
+                else:
+                    self.stale += 1
+            if entry is not None:
+                self.db.delete_cached_result(key)
+            return None
+
+        try:
+            self._link(source, save_path)
+            if os.path.exists(_thumb_path(source)):
+                self._link(_thumb_path(source), _thumb_path(save_path))
+        except OSError as e:
+            print(f"⚠️ 复用缓存结果失败: {e}")
+            for path in (save_path, _thumb_path(save_path)):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            with self._lock:
+                self.errors += 1
+            raise ResultCacheError(f"Failed to reuse cached result: {e}") from e
+
+        with self._lock:
+            self.hits += 1
+        print(f"⚡ 命中生成结果缓存: {entry['filename']}")
+        with open(save_path, "rb") as f:
+            mime = sniff_image_type(f.read(32)) or "image/png"
+        return DownloadedImage(save_path, entry["bytes"] or os.path.getsize(save_path), entry["sha256"] or "", mime)
+
+    @staticmethod
+    def _link(source: str, target: str):
+        try:
+            os.link(source, target)
+        except OSError:
+            shutil.copyfile(source, target)
+
+    def store(self, key: str, saved: DownloadedImage):
+        self.db.put_cached_result(key, os.path.basename(saved.path), saved.size, saved.sha256)
+
+    def skip(self):
+        """force_fresh 跳过查找"""
+        with self._lock:
+            self.skipped += 1
+
+    def purge(self) -> int:
+        deleted = self.db.purge_result_cache()
+        print(f"🧹 已清空生成结果缓存 ({deleted} 条)")
+        return deleted
+
+    def stats(self) -> Dict:
+        entries = self.db.count_cached_results()
+        with self._lock:
+            lookups = self.hits + self.misses + self.stale
+            return {
+                "enabled": self.enabled,
+                "subjects": sorted(self.subjects),
+                "entries": entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "stale": self.stale,
+                "skipped": self.skipped,
+                "errors": self.errors,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+            }
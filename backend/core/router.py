@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+多中转路由表
+同一个模型可以配置多个上游 (各自的 base_url、Key 池、权重与出图接口类型)，
+按实时的耗时 EWMA 与错误率排序选择，失败时自动切换到下一个上游；
+某个中转变慢或故障时，服务继续以当前最优的延迟运行
+"""
+
+import threading
+import time
+from typing import Dict, List, Optional
+
+from .key_scheduler import mask_key
+
+# 接口类型
+STYLE_CHAT = "chat"      # /v1/chat/completions (Gemini 等)
+STYLE_IMAGES = "images"  # /v1/images/generations (OpenAI 兼容)
+
+
+class Provider:
+    """路由表中的一个上游"""
+
+    def __init__(self, name: str, base_url: str, api_keys: List[str], weight: float = 1.0,
+                 style: Optional[str] = None, model: Optional[str] = None):
+        self.name = name
+        self.base_url = base_url.rstrip("/")
+        self.api_keys = api_keys
+        self.weight = max(weight, 0.01)
+        self.style = style
+        self.model = model  # 该上游使用的模型名 (与对外模型名不同时配置)
+
+        self.in_flight = 0
+        self.successes = 0
+        self.failures = 0
+        self.latency_ewma: Optional[float] = None
+        self.error_ewma = 0.0
+        self.consecutive_failures = 0
+        self.down_until = 0.0
+
+    def to_dict(self, now: float) -> Dict:
+        return {
+            "name": self.name,
+            "base_url": self.base_url,
+            "keys": [mask_key(k) for k in self.api_keys],
+            "weight": self.weight,
+            "style": self.style or "auto",
+            "model": self.model,
+            "in_flight": self.in_flight,
+            "successes": self.successes,
+            "failures": self.failures,
+            "latency_ewma": round(self.latency_ewma, 2) if self.latency_ewma is not None else None,
+            "error_rate": round(self.error_ewma, 3),
+            "down_for": round(max(0.0, self.down_until - now), 1),
+        }
+
+
+class ProviderRouter:
+    """
+    config.json -> routes:
+      {
+        "gemini-3-pro-image-preview": [
+          {"name": "relay-a", "base_url": "https://a.example.com", "api_keys": ["sk-..."], "weight": 2, "style": "chat"},
+          {"name": "relay-b", "base_url": "https://b.example.com", "api_keys": ["sk-..."], "model": "gemini-3-pro-image"}
+        ]
+      }
+    api_keys 省略时使用系统 Key；style 省略时按模型名自动判断
+    config.json -> routing: ewma_alpha / error_penalty / failure_threshold / cooldown /
+      default_latency (还没有成功样本的上游按该耗时估计)
+    只用于系统 Key 的请求；自带 Key 或自定义 base_url 的请求不经过路由表
+    """
+
+    def __init__(self, routes: Optional[Dict] = None, cfg: Optional[Dict] = None, default_keys: Optional[List[str]] = None):
+        cfg = cfg or {}
+        self.ewma_alpha = float(cfg.get("ewma_alpha", 0.3))
+        self.error_penalty = float(cfg.get("error_penalty", 4.0))
+        self.failure_threshold = int(cfg.get("failure_threshold", 3))
+        self.cooldown = float(cfg.get("cooldown", 30))
+        self.default_latency = float(cfg.get("default_latency", 20))
+
+        self._lock = threading.Lock()
+        self._routes: Dict[str, List[Provider]] = {}
+        for model, entries in (routes or {}).items():
+            providers = []
+            for idx, entry in enumerate(entries or []):
+                if not entry.get("base_url"):
+                    continue
+                keys = entry.get("api_keys", default_keys or [])
+                if isinstance(keys, str):
+                    keys = [k.strip() for k in keys.split(",") if k.strip()]
+                providers.append(Provider(
+                    entry.get("name") or f"{model}#{idx}",
+                    entry["base_url"],
+                    [k for k in keys if k],
+                    float(entry.get("weight", 1.0)),
+                    entry.get("style"),
+                    entry.get("model"),
+                ))
+            if providers:
+                self._routes[model] = providers
+
+    def base_urls(self) -> List[str]:
+        return sorted({p.base_url for providers in self._routes.values() for p in providers})
+
+    def api_keys(self) -> List[str]:
+        return sorted({k for providers in self._routes.values() for p in providers for k in p.api_keys})
+
+    def has_route(self, model: str) -> bool:
+        return model in self._routes
+
+    def _score(self, provider: Provider) -> float:
+        """越小越优: 期望耗时 × 错误惩罚 × 当前负载 / 权重"""
+        latency = provider.latency_ewma if provider.latency_ewma is not None else self.default_latency
+        return latency * (1 + self.error_penalty * provider.error_ewma) * (1 + provider.in_flight) / provider.weight
+
+    def plan(self, model: str, styles: Optional[tuple] = None) -> List[Provider]:
+        """
+        本次请求尝试上游的顺序 (styles 限定接口类型，如图生图只能走 chat)
+        暂时下线的上游排在最后，保证全部下线时仍有机会发出请求
+        """
+        now = time.time()
+        with self._lock:
+            providers = [p for p in self._routes.get(model, []) if not styles or (p.style or None) in styles]
+            up = sorted((p for p in providers if p.down_until <= now), key=self._score)
+            down = sorted((p for p in providers if p.down_until > now), key=lambda p: p.down_until)
+            return up + down
+
+    def acquire(self, provider: Provider):
+        with self._lock:
+            provider.in_flight += 1
+
+    def release(self, provider: Provider, ok: bool, latency: float):
+        now = time.time()
+        with self._lock:
+            provider.in_flight = max(0, provider.in_flight - 1)
+            provider.error_ewma += self.ewma_alpha * ((0.0 if ok else 1.0) - provider.error_ewma)
+            if ok:
+                provider.successes += 1
+                provider.consecutive_failures = 0
+                provider.down_until = 0.0
+                if provider.latency_ewma is None:
+                    provider.latency_ewma = latency
+                else:
+                    provider.latency_ewma += self.ewma_alpha * (latency - provider.latency_ewma)
+                return
+
+            provider.failures += 1
+            provider.consecutive_failures += 1
+            if provider.consecutive_failures >= self.failure_threshold:
+                provider.down_until = now + self.cooldown
+                print(f"⛔ 上游 {provider.name} 连续失败 {provider.consecutive_failures} 次，下线 {self.cooldown:.0f}s")
+
+    def cancel(self, provider: Provider):
+        """调用被取消 (对冲落败、客户端断开): 只归还在途计数，不影响耗时与错误率"""
+        with self._lock:
+            provider.in_flight = max(0, provider.in_flight - 1)
+
+    def snapshot(self) -> Dict[str, List[Dict]]:
+        now = time.time()
+        with self._lock:
+            return {model: [p.to_dict(now) for p in providers] for model, providers in self._routes.items()}
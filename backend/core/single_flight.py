@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+相同请求合并 (single-flight)
+学生双击、浏览器重试会在几秒内发来完全相同的生成请求。按请求内容的规范化哈希合并:
+第一个请求 (leader) 真正执行，执行期间到达的相同请求直接等待同一结果；
+完成后的短时间窗口内到达的重复请求也直接复用结果，上游只调用一次、额度只扣一次
+"""
+
+import asyncio
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional
+
+# progress(stage): 进度回调 (如任务队列的阶段更新)
+Progress = Callable[[str], Awaitable[None]]
+
+
+async def _no_progress(stage: str):
+    pass
+
+
+class SingleFlight:
+    """
+    config.json -> single_flight:
+      - enabled: 是否启用 (默认 true)
+      - window: 成功完成后继续复用结果的秒数 (0 表示只合并执行中的请求)
+    只在事件循环线程中使用，无需加锁
+    执行中的进度阶段转发给所有等待者 (合并进来的请求也能看到 generating 等阶段)
+    """
+
+    MAX_RECENT = 256
+
+    def __init__(self, cfg: Optional[Dict] = None):
+        cfg = cfg or {}
+        self.enabled = bool(cfg.get("enabled", True))
+        self.window = float(cfg.get("window", 10))
+
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self._listeners: Dict[str, List[Progress]] = {}  # key -> 等待者的进度回调
+        self._stages: Dict[str, str] = {}  # key -> 最近的进度阶段
+        self._recent: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (result, finished_at)
+        self.leaders = 0
+        self.joined = 0
+        self.recent_hits = 0
+
+    @staticmethod
+    def make_key(*parts) -> str:
+        return hashlib.sha256(json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")).hexdigest()
+
+    def _prune(self, now: float):
+        while self._recent:
+            key, (_, finished_at) = next(iter(self._recent.items()))
+            if now - finished_at < self.window and len(self._recent) <= self.MAX_RECENT:
+                break
+            self._recent.popitem(last=False)
+
+    def _broadcaster(self, key: str) -> Progress:
+        listeners = self._listeners[key]
+
+        async def broadcast(stage: str):
+            self._stages[key] = stage
+            for progress in list(listeners):
+                try:
+                    await progress(stage)
+                except Exception as e:
+                    print(f"⚠️ 转发进度失败: {e}")
+
+        return broadcast
+
+    def _finished(self, key: str, task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+            self._listeners.pop(key, None)
+            self._stages.pop(key, None)
+        # 失败 / 取消的结果不缓存，后续重复请求重新执行
+        if task.cancelled() or task.exception() is not None or self.window <= 0:
+            return
+        self._recent[key] = (task.result(), time.monotonic())
+        self._prune(time.monotonic())
+
+    async def run(self, key: str, factory: Callable[[Progress], Awaitable], progress: Optional[Progress] = None):
+        """
+        执行 factory(progress) 或加入相同 key 的执行
+        实际工作在独立的 Task 中运行: 某个等待者断开 (被取消) 不会中断其他等待者共享的执行；
+        factory 收到的 progress 会把阶段转发给所有仍在等待的调用方，中途加入者先收到当前阶段
+        """
+        if not self.enabled:
+            return await factory(progress or _no_progress)
+
+        self._prune(time.monotonic())
+        recent = self._recent.get(key)
+        if recent is not None:
+            self.recent_hits += 1
+            print("🔁 重复请求，直接返回刚完成的结果")
+            return recent[0]
+
+        task = self._inflight.get(key)
+        if task is None:
+            self.leaders += 1
+            self._listeners[key] = []
+            task = asyncio.create_task(factory(self._broadcaster(key)))
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._finished(key, t))
+        else:
+            self.joined += 1
+            print("🔁 相同请求正在执行，合并等待")
+            if progress:
+                await progress(self._stages.get(key, "waiting_duplicate"))
+
+        listeners = self._listeners.get(key)
+        if progress and listeners is not None and not task.done():
+            listeners.append(progress)
+        try:
+            return await asyncio.shield(task)
+        finally:
+            if progress and listeners is not None and progress in listeners:
+                listeners.remove(progress)
+
+    def stats(self) -> Dict:
+        return {
+            "enabled": self.enabled,
+            "in_flight": len(self._inflight),
+            "recent": len(self._recent),
+            "leaders": self.leaders,
+            "joined": self.joined,
+            "recent_hits": self.recent_hits,
+        }
@@ -3,6 +3,7 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import HTMLResponse, FileResponse, StreamingResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
 from typing import List, Optional, Dict
 import os
@@ -15,7 +16,10 @@ from urllib.parse import quote, unquote
 import zipfile
 import io
 import re
+import asyncio
 import time
+import uuid
+import httpx
 from jose import JWTError, jwt
 from PIL import Image
 
@@ -24,10 +28,17 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 if BASE_DIR not in sys.path:
     sys.path.insert(0, BASE_DIR)
 
-from core.image_generator import ImageGenerator
+from core.image_generator import get_image_generator
+from core.generation_options import GenerationOptions
+from core.async_image_generator import get_async_image_generator
+from core.admission import AdmissionClient, AdmissionRejected
+from core.image_io import DownloadedImage, describe_image
 from core.batch_image_generator import BatchImageGenerator
 from core.digital_human import DigitalHumanGenerator
 from core.db_manager import DBManager
+from core.job_queue import JobError, JobQueue
+from core.single_flight import SingleFlight
+from core.result_cache import ResultCache, ResultCacheError
 from core.auth_utils import verify_password, get_password_hash, create_access_token, SECRET_KEY, ALGORITHM
 
 app = FastAPI(title="智绘工坊 API")
@@ -77,10 +88,17 @@ app.mount("/static", StaticFiles(directory=STATIC_DIR), name="static")
 DATA_DIR = os.path.join(EXEC_DIR, "data")
 os.makedirs(DATA_DIR, exist_ok=True)
 
-img_gen = ImageGenerator()
+img_gen = get_image_generator()
+async_gen = get_async_image_generator()
 batch_gen = BatchImageGenerator()
 digital_human_gen = DigitalHumanGenerator()
 db = DBManager(db_path=os.path.join(DATA_DIR, "app.db"))
+job_queue = JobQueue(db, img_gen.config.get("jobs", {}))
+# 后台落盘 (fast_return): 独立的 worker，不被耗时的生成任务占满
+persistence_cfg = img_gen.config.get("deferred_persistence", {})
+persist_queue = JobQueue(db, persistence_cfg, name="后台落盘队列")
+single_flight = SingleFlight(img_gen.config.get("single_flight", {}))
+result_cache = ResultCache(db, GENERATED_DIR, img_gen.config.get("result_cache", {}))
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/auth/login")
 
@@ -104,6 +122,14 @@ def scan_and_sync_db():
     """后台任务：扫描文件夹，生成缩略图，同步DB"""
     print("🔄 Syncing files and database...")
     
+    # 0. 清理中断下载残留的临时文件 (见 core/image_io.ImageSink)
+    for part in glob.glob(os.path.join(GENERATED_DIR, ".*.part")):
+        try:
+            if time.time() - os.path.getmtime(part) > 3600:
+                os.remove(part)
+        except OSError:
+            pass
+
     # 1. 扫描并生成缩略图
     extensions = ["*.png", "*.jpg", "*.jpeg"]
     files = glob.glob(os.path.join(GENERATED_DIR, "*.png"))
@@ -243,6 +269,25 @@ class SingleGenRequest(BaseModel):
     model: Optional[str] = None # Added model selection
     reference_image_url: Optional[str] = None
     reference_image_urls: List[str] = []
+    force_fresh: bool = False # 跳过生成结果缓存，重新生成
+    fast_return: bool = False # 上游返回图片 URL 后立即响应，下载与入库在后台完成
+    variants: int = 1 # 一次生成的候选图数量 (1 ~ MAX_VARIANTS)
+
+class CompareGenRequest(BaseModel):
+    prompt: str
+    models: List[str]
+    size: str = "1024x1024"
+    quality: str = "standard"
+    style: str = "vivid"
+    subject: str = "general"
+    grade: str = "general"
+    reference_image_url: Optional[str] = None
+    reference_image_urls: List[str] = []
+    force_fresh: bool = False
+
+class BatchGenRequest(BaseModel):
+    items: List[SingleGenRequest]
+    concurrency: Optional[int] = None # 同时执行的条数 (默认 config.json -> batch.concurrency)
 
 class ModifyGenRequest(BaseModel):
     prompt: str
@@ -329,6 +374,10 @@ async def download_batch(req: BatchDownloadRequest):
 
 # --- Helpers ---
 
+def model_cost(model: str) -> int:
+    """单张图片的额度消耗 (Gemini 2 点，其余 1 点)"""
+    return 2 if "gemini" in model.lower() else 1
+
 def determine_execution_mode(current_user: Optional[Dict], x_model_key: Optional[str], cost: int = 1):
     # Priority 1: User provided Key (BYOK)
     if x_model_key:
@@ -346,8 +395,435 @@ def determine_execution_mode(current_user: Optional[Dict], x_model_key: Optional
 
     raise HTTPException(status_code=401, detail="Login required or provide x-model-key.")
 
+def admission_client(current_user: Optional[Dict], x_model_key: Optional[str] = None) -> AdmissionClient:
+    """上游排队身份: 登录用户按账号 (Pro 加权)，匿名 BYOK 按 Key"""
+    if current_user:
+        return img_gen.admission.client(user_id=current_user['id'], is_pro=bool(current_user.get('is_pro')))
+    return img_gen.admission.client(api_key=x_model_key)
+
+def admission_error(e: AdmissionRejected) -> HTTPException:
+    """排队已满 / 排队超时 -> 503 + Retry-After"""
+    retry_after = max(1, int(round(e.retry_after)))
+    return HTTPException(
+        status_code=503,
+        detail={"message": str(e), "estimated_wait": retry_after},
+        headers={"Retry-After": str(retry_after)}
+    )
+
+# 单次请求最多的候选图数量
+MAX_VARIANTS = 4
+
+def check_variants(req: SingleGenRequest):
+    if not 1 <= req.variants <= MAX_VARIANTS:
+        raise HTTPException(status_code=400, detail=f"variants must be between 1 and {MAX_VARIANTS}")
+
+def output_stem(prompt: str, timestamp: int, name_tag: Optional[str] = None) -> str:
+    """
+    生成结果的文件名 (不含扩展名)
+    末尾附加随机后缀: 同一秒内相同提示词的请求 (全班提交同一道题、命中同一条缓存) 不会写到同一个文件
+    """
+    stem = f"{sanitize_filename(prompt)}_{timestamp}" + (f"_{sanitize_filename(name_tag)}" if name_tag else "")
+    return f"{stem}_{uuid.uuid4().hex[:8]}"
+
+def enhance_prompt(req: SingleGenRequest) -> str:
+    """附加学科与年级上下文"""
+    enhanced_prompt = req.prompt
+    context_prompts = []
+    if req.subject and req.subject != "general": context_prompts.append(f"Subject: {req.subject}")
+    if req.grade and req.grade != "general": context_prompts.append(f"Target Audience: {req.grade} students")
+    if context_prompts: enhanced_prompt += " (" + ", ".join(context_prompts) + ")"
+    return enhanced_prompt
+
+def reference_paths(req: SingleGenRequest):
+    """请求中的参考图 URL (去重) 与其中存在的本地文件路径"""
+    all_ref_urls = list(set([u for u in [req.reference_image_url] + req.reference_image_urls if u]))
+    ref_paths = []
+    for ref_url in all_ref_urls:
+        ref_filename = os.path.basename(ref_url)
+        p = os.path.join(UPLOAD_DIR, ref_filename) if "uploads" in ref_url else os.path.join(GENERATED_DIR, ref_filename)
+        if os.path.exists(p): ref_paths.append(p)
+    return all_ref_urls, ref_paths
+
+def save_generation_record(user_id: Optional[int], owner: str, filename: str, stem: str,
+                           prompt: str, subject: str, grade: str, timestamp: int, meta: Dict):
+    """写入图库 (images 表) 与同名 JSON 备份"""
+    db.log_image(
+        user_id=user_id,
+        filename=filename,
+        prompt=prompt,
+        subject=subject,
+        grade=grade,
+        metadata=meta
+    )
+    
+    # Save JSON for backup/legacy compatibility
+    json_meta = meta.copy()
+    json_meta.update({
+        "prompt": prompt,
+        "subject": subject,
+        "grade": grade,
+        "timestamp": timestamp,
+        "featured": False,
+        "owner": owner
+    })
+    with open(os.path.join(GENERATED_DIR, f"{stem}.json"), 'w', encoding='utf-8') as f:
+        json.dump(json_meta, f, ensure_ascii=False, indent=2)
+
+def quota_status(current_user: Optional[Dict]):
+    """(剩余额度, 是否 Pro)"""
+    if not current_user:
+        return 0, False
+    updated_user = db.get_user_by_id(current_user['id'])
+    return max(0, updated_user['quota_limit'] - updated_user['quota_used']), bool(updated_user['is_pro'])
+
 # ...
 
+async def run_single_generation(req: SingleGenRequest, current_user: Optional[Dict], mode: str,
+                                runtime_key: Optional[str], runtime_base_url: Optional[str], cost: int,
+                                progress=None, name_tag: Optional[str] = None) -> Dict:
+    """
+    单图生成流水线 (同步接口 /api/generate/single、多模型对比与任务队列共用)
+    mode: "system" 成功后扣除额度；"user" 自带 Key 不扣额度；"reserved" 额度已由批量接口预留，不再扣除；
+    progress: 可选的 async 回调，进入各阶段时以阶段名调用；
+    name_tag: 附加到文件名的标记 (同一秒内并发生成同一提示词时区分文件)；
+    失败时抛出 HTTPException，上游排队被拒时抛出 AdmissionRejected
+    """
+    if req.variants > 1:
+        return await run_variant_generation(req, current_user, mode, runtime_key, runtime_base_url, cost,
+                                            progress=progress, name_tag=name_tag)
+
+    client = admission_client(current_user, runtime_key)
+    async def report(stage: str):
+        if progress:
+            await progress(stage)
+
+    timestamp = int(time.time())
+    stem = output_stem(req.prompt, timestamp, name_tag)
+    filename = f"{stem}.png"
+    
+    # Enhanced Prompt Logic
+    enhanced_prompt = enhance_prompt(req)
+    
+    # Run Generation (本次请求的参数，不改写共享的 img_gen.config)
+    options = GenerationOptions(size=req.size, quality=req.quality, style=req.style)
+    
+    # Use request model if provided, else keep default
+    request_model = req.model if req.model else img_gen.model
+
+    # 整个生成流程 (含参考图尝试、回退与下载) 共用一个截止时间
+    deadline = img_gen.deadline_for("generate")
+    final_path = None
+    saved = None  # DownloadedImage: 落盘时已算好大小与 sha256
+    
+    # Handle References
+    all_ref_urls, ref_paths = reference_paths(req)
+
+    # 生成结果缓存 (按学科开启): 相同请求直接复用已生成的图片
+    # 自带 Key / base_url 的请求由用户自己的上游生成，既不复用系统上游的结果，也不把结果提供给其他用户
+    cache_key = None
+    if result_cache.applies_to(req.subject) and not (runtime_key or runtime_base_url):
+        cache_key = await run_in_threadpool(
+            result_cache.make_key, enhanced_prompt, request_model, req.size, req.quality, req.style, ref_paths
+        )
+        if req.force_fresh:
+            result_cache.skip()
+        else:
+            try:
+                saved = await run_in_threadpool(result_cache.lookup, cache_key, os.path.join(GENERATED_DIR, filename))
+            except ResultCacheError as e:
+                # 缓存命中但复用文件失败 (磁盘错误等)，不改为付费重新生成
+                raise HTTPException(status_code=500, detail=str(e))
+            final_path = saved.path if saved else None
+    cache_hit = final_path is not None
+    fell_back = False
+
+    if not cache_hit:
+        await report("generating")
+        
+        if ref_paths:
+            print(f"🖼️ Attempting generation with {len(ref_paths)} reference images...")
+            saved = await async_gen.modify_to_file(
+                enhanced_prompt, 
+                ref_paths,
+                os.path.join(GENERATED_DIR, filename),
+                base_url=runtime_base_url,
+                api_key=runtime_key,
+                model=request_model,
+                deadline=deadline,
+                client=client
+            )
+            if saved:
+                print(f"✅ Reference generation saved ({saved.size} bytes)")
+                final_path = saved.path
+            else:
+                print("❌ Reference generation failed (Model declined, failed or download error).")
+    
+    if not final_path and not deadline.expired():
+        if ref_paths:
+             print("⚠️ Ref gen failed, falling back to Text-to-Image (Ref ignored).")
+             fell_back = True
+        
+        if req.fast_return and persistence_cfg.get("enabled", True):
+            # 上游返回 URL 时立即响应，下载、缩略图与入库交给后台落盘队列
+            image = await async_gen.generate_image(
+                enhanced_prompt,
+                base_url=runtime_base_url,
+                api_key=runtime_key,
+                model=request_model,
+                deadline=deadline,
+                client=client,
+                options=options
+            )
+            if isinstance(image, str) and image.startswith("http"):
+                meta = {
+                    "size": req.size,
+                    "quality": req.quality,
+                    "style": req.style,
+                    "enhanced_prompt": enhanced_prompt,
+                    "refs": all_ref_urls
+                }
+                return await defer_persistence(
+                    req, current_user, mode, cost, image, filename, stem, timestamp, meta,
+                    None if fell_back else cache_key
+                )
+            # Chat 模型返回的 Data URI 没有可先展示的 URL，按原流程落盘
+            if image and not isinstance(image, DownloadedImage):
+                image = await async_gen.download_image(image, os.path.join(GENERATED_DIR, filename), deadline=deadline)
+            saved = image or None
+        else:
+            saved = await async_gen.generate_to_file(
+                enhanced_prompt,
+                os.path.join(GENERATED_DIR, filename),
+                base_url=runtime_base_url,
+                api_key=runtime_key,
+                model=request_model,
+                deadline=deadline,
+                client=client,
+                options=options
+            )
+        final_path = saved.path if saved else None
+    
+    if final_path:
+        await report("thumbnail")
+        await run_in_threadpool(create_thumbnail, final_path)
+        
+        await report("saving")
+        # Record Usage if System (Only for logged in users); 命中缓存不扣额度
+        if mode == "system" and current_user and not cache_hit:
+            db.update_user_quota(current_user['id'], cost)
+
+        # 回退为文生图的结果与请求不符，不写入缓存
+        if cache_key and not cache_hit and not fell_back:
+            await run_in_threadpool(result_cache.store, cache_key, saved)
+
+        # Log to DB
+        meta = {
+            "size": req.size,
+            "quality": req.quality,
+            "style": req.style,
+            "enhanced_prompt": enhanced_prompt,
+            "refs": all_ref_urls,
+            "bytes": saved.size,
+            "sha256": saved.sha256
+        }
+        if cache_hit:
+            meta["cache_hit"] = True
+        save_generation_record(
+            current_user['id'] if current_user else None,
+            current_user['username'] if current_user else "guest",
+            filename, stem, req.prompt, req.subject, req.grade, timestamp, meta
+        )
+
+        # Return Updated Quota
+        remaining, is_pro = quota_status(current_user)
+        
+        return {
+            "success": True,
+            "url": f"/static/generated/{filename}",
+            "remaining_quota": remaining,
+            "is_pro": is_pro,
+            "cache_hit": cache_hit
+        }
+    elif deadline.expired():
+        raise HTTPException(status_code=504, detail="Generation timed out")
+    else:
+        raise HTTPException(status_code=500, detail="Generation failed")
+
+def pending_token(persist_id: str) -> str:
+    """/api/pending 的访问令牌: 只随快速返回的响应签发给发起请求的一方，代理有效期过后失效"""
+    expires = int(time.time() + float(persistence_cfg.get("proxy_ttl", 900)))
+    return jwt.encode({"sub": f"pending:{persist_id}", "exp": expires}, SECRET_KEY, algorithm=ALGORITHM)
+
+async def defer_persistence(req: SingleGenRequest, current_user: Optional[Dict], mode: str, cost: int,
+                            image_url: str, filename: str, stem: str, timestamp: int, meta: Dict,
+                            cache_key: Optional[str]) -> Dict:
+    """
+    先返回指向上游图片的临时代理地址 (/api/pending/{id})，落盘在后台完成后图库中才出现该图片
+    额度在上游成功返回时扣除，后台下载最终失败时退还；
+    落盘任务写入 app.db，服务重启后继续执行
+    """
+    charged = cost if mode == "system" and current_user else 0
+    if charged:
+        db.update_user_quota(current_user['id'], charged)
+
+    job = await persist_queue.submit(
+        "persist_generation",
+        {
+            "image_url": image_url,
+            "filename": filename,
+            "stem": stem,
+            "timestamp": timestamp,
+            "prompt": req.prompt,
+            "subject": req.subject,
+            "grade": req.grade,
+            "owner": current_user['username'] if current_user else "guest",
+            "meta": meta,
+            "cache_key": cache_key,
+            "charged": charged
+        },
+        user_id=current_user['id'] if current_user else None
+    )
+    print(f"⚡ 快速返回: 上游图片已就绪，后台落盘 {filename}")
+
+    remaining, is_pro = quota_status(current_user)
+    return {
+        "success": True,
+        "url": f"/api/pending/{job['id']}?token={pending_token(job['id'])}",
+        "final_url": f"/static/generated/{filename}",
+        "pending": True,
+        "persist_job_id": job["id"],
+        "remaining_quota": remaining,
+        "is_pro": is_pro,
+        "cache_hit": False
+    }
+
+async def run_variant_generation(req: SingleGenRequest, current_user: Optional[Dict], mode: str,
+                                 runtime_key: Optional[str], runtime_base_url: Optional[str], cost: int,
+                                 progress=None, name_tag: Optional[str] = None) -> Dict:
+    """
+    一次生成 req.variants 张候选图
+    文生图优先用一次 n > 1 的 /v1/images/generations 调用 (上游不支持时并发单张调用)，
+    参考图生成并发调用；全部并行下载、批量生成缩略图。
+    每张图单独记录到 images 表，metadata 中以相同的 generation_id 分组；
+    额度按成功的张数扣除，不经过生成结果缓存
+    """
+    client = admission_client(current_user, runtime_key)
+    async def report(stage: str):
+        if progress:
+            await progress(stage)
+
+    timestamp = int(time.time())
+    stem = output_stem(req.prompt, timestamp, name_tag)
+    generation_id = uuid.uuid4().hex
+    stems = [f"{stem}_v{i + 1}" for i in range(req.variants)]
+    save_paths = [os.path.join(GENERATED_DIR, f"{s}.png") for s in stems]
+
+    enhanced_prompt = enhance_prompt(req)
+    options = GenerationOptions(size=req.size, quality=req.quality, style=req.style)
+    request_model = req.model if req.model else img_gen.model
+    deadline = img_gen.deadline_for("generate")
+    all_ref_urls, ref_paths = reference_paths(req)
+
+    await report("generating")
+    results = [None] * len(save_paths)
+    if ref_paths:
+        print(f"🖼️ Generating {len(save_paths)} variants with {len(ref_paths)} reference images...")
+        results = list(await asyncio.gather(*(
+            async_gen.modify_to_file(
+                enhanced_prompt, ref_paths, path,
+                base_url=runtime_base_url, api_key=runtime_key, model=request_model,
+                deadline=deadline, client=client
+            ) for path in save_paths
+        ), return_exceptions=True))
+
+    # 参考图生成失败的候选回退为文生图 (与单张流程一致)
+    missing = [i for i, saved in enumerate(results) if not isinstance(saved, DownloadedImage)]
+    fell_back = set(missing) if ref_paths else set()
+    if missing and not deadline.expired():
+        if ref_paths:
+            print(f"⚠️ {len(missing)} ref variants failed, falling back to Text-to-Image (Ref ignored).")
+        generated = await async_gen.generate_variants_to_files(
+            enhanced_prompt, [save_paths[i] for i in missing],
+            base_url=runtime_base_url, api_key=runtime_key, model=request_model,
+            deadline=deadline, client=client, options=options
+        )
+        for i, saved in zip(missing, generated):
+            results[i] = saved
+
+    variants = [(i, saved) for i, saved in enumerate(results) if isinstance(saved, DownloadedImage)]
+    if not variants:
+        # 全部失败: 排队被拒时交给上层转换为 503
+        for saved in results:
+            if isinstance(saved, AdmissionRejected):
+                raise saved
+        if deadline.expired():
+            raise HTTPException(status_code=504, detail="Generation timed out")
+        raise HTTPException(status_code=500, detail="Generation failed")
+
+    await report("thumbnail")
+    await asyncio.gather(*(run_in_threadpool(create_thumbnail, saved.path) for _, saved in variants))
+
+    await report("saving")
+    if mode == "system" and current_user:
+        db.update_user_quota(current_user['id'], cost * len(variants))
+
+    urls = []
+    for i, saved in variants:
+        filename = os.path.basename(saved.path)
+        meta = {
+            "size": req.size,
+            "quality": req.quality,
+            "style": req.style,
+            "enhanced_prompt": enhanced_prompt,
+            "refs": [] if i in fell_back else all_ref_urls,
+            "bytes": saved.size,
+            "sha256": saved.sha256,
+            "generation_id": generation_id,
+            "variant": i + 1
+        }
+        save_generation_record(
+            current_user['id'] if current_user else None,
+            current_user['username'] if current_user else "guest",
+            filename, stems[i], req.prompt, req.subject, req.grade, timestamp, meta
+        )
+        urls.append(f"/static/generated/{filename}")
+
+    remaining, is_pro = quota_status(current_user)
+    return {
+        "success": True,
+        "url": urls[0],
+        "urls": urls,
+        "generation_id": generation_id,
+        "requested": req.variants,
+        "remaining_quota": remaining,
+        "is_pro": is_pro,
+        "cache_hit": False
+    }
+
+def single_generation_key(req: SingleGenRequest, current_user: Optional[Dict], mode: str,
+                          runtime_key: Optional[str], runtime_base_url: Optional[str]) -> str:
+    """同一用户 (或同一自带 Key) 的相同请求内容 -> 同一个合并键"""
+    if current_user:
+        identity = f"user:{current_user['id']}"
+    else:
+        identity = "byok:" + SingleFlight.make_key(runtime_key)
+    refs = sorted(set(u for u in [req.reference_image_url] + req.reference_image_urls if u))
+    return SingleFlight.make_key(
+        identity, mode, runtime_base_url, " ".join(req.prompt.split()), req.size, req.quality, req.style,
+        req.subject, req.grade, req.model or img_gen.model, refs, req.force_fresh, req.variants, req.fast_return
+    )
+
+async def run_single_generation_once(req: SingleGenRequest, current_user: Optional[Dict], mode: str,
+                                     runtime_key: Optional[str], runtime_base_url: Optional[str], cost: int,
+                                     progress=None) -> Dict:
+    """合并短时间内的重复请求 (双击 / 浏览器重试)，上游只调用一次、额度只扣一次"""
+    key = single_generation_key(req, current_user, mode, runtime_key, runtime_base_url)
+    return await single_flight.run(
+        key,
+        lambda shared_progress: run_single_generation(req, current_user, mode, runtime_key, runtime_base_url, cost, progress=shared_progress),
+        progress=progress
+    )
+
 @app.post("/api/generate/single")
 async def generate_single(
     req: SingleGenRequest, 
@@ -357,134 +833,368 @@ async def generate_single(
     x_model_base_url: Optional[str] = Header(None, alias="x-model-base-url")
 ):
     try:
-        # Determine Cost
+        check_variants(req)
+        # Determine Cost (每张候选图单独计费)
         request_model = req.model if req.model else img_gen.model
-        cost = 2 if "gemini" in request_model.lower() else 1
+        cost = model_cost(request_model)
         
-        mode, runtime_key, runtime_base_url = determine_execution_mode(current_user, x_model_key, cost=cost)
+        mode, runtime_key, runtime_base_url = determine_execution_mode(current_user, x_model_key, cost=cost * req.variants)
         if runtime_base_url is None and x_model_base_url:
             runtime_base_url = x_model_base_url
 
-        timestamp = int(time.time())
-        safe_prompt = sanitize_filename(req.prompt)
-        filename = f"{safe_prompt}_{timestamp}.png"
-        
-        # Enhanced Prompt Logic
-        enhanced_prompt = req.prompt
-        context_prompts = []
-        if req.subject and req.subject != "general": context_prompts.append(f"Subject: {req.subject}")
-        if req.grade and req.grade != "general": context_prompts.append(f"Target Audience: {req.grade} students")
-        if context_prompts: enhanced_prompt += " (" + ", ".join(context_prompts) + ")"
-        
-        # Run Generation
-        original_config = img_gen.config.copy()
-        img_gen.config["image"]["size"] = req.size
-        img_gen.config["image"]["quality"] = req.quality
-        img_gen.config["image"]["style"] = req.style
-        
-        # Use request model if provided, else keep default
-        request_model = req.model if req.model else img_gen.model
+        return await run_single_generation_once(req, current_user, mode, runtime_key, runtime_base_url, cost)
+    except HTTPException as he: raise he
+    except AdmissionRejected as ar: raise admission_error(ar)
+    except Exception as e: raise HTTPException(status_code=500, detail=str(e))
 
-        final_path = None
-        
-        # Handle References
-        all_ref_urls = list(set([u for u in [req.reference_image_url] + req.reference_image_urls if u]))
-        if all_ref_urls:
-            ref_paths = []
-            for ref_url in all_ref_urls:
-                ref_filename = os.path.basename(ref_url)
-                p = os.path.join(UPLOAD_DIR, ref_filename) if "uploads" in ref_url else os.path.join(GENERATED_DIR, ref_filename)
-                if os.path.exists(p): ref_paths.append(p)
-            
-            if ref_paths:
-                print(f"🖼️ Attempting generation with {len(ref_paths)} reference images...")
-                image_url = img_gen.generate_modified_image(
-                    enhanced_prompt, 
-                    ref_paths,
-                    base_url=runtime_base_url,
-                    api_key=runtime_key,
-                    model=request_model
-                )
-                if image_url:
-                    print(f"✅ Reference generation returned URL: {image_url[:50]}...")
-                    save_path = os.path.join(GENERATED_DIR, filename)
-                    if img_gen.download_image(image_url, save_path):
-                        final_path = save_path
-                    else:
-                        print("❌ Failed to download reference generated image.")
-                else:
-                    print("❌ Reference generation returned None (Model declined or failed).")
-        
-        if not final_path:
-            if all_ref_urls and 'ref_paths' in locals() and ref_paths:
-                 print("⚠️ Ref gen failed, falling back to Text-to-Image (Ref ignored).")
-            
-            final_path = img_gen.generate_and_download(
-                enhanced_prompt,
-                filename,
-                folder=GENERATED_DIR,
-                base_url=runtime_base_url,
-                api_key=runtime_key,
-                model=request_model
-            )
-        
-        img_gen.config = original_config
-        
-        if final_path:
-            create_thumbnail(final_path)
-            
-            # Record Usage if System (Only for logged in users)
-            if mode == "system" and current_user:
-                db.update_user_quota(current_user['id'], cost)
+# 多模型对比一次最多的模型数
+MAX_COMPARE_MODELS = 6
 
-            # Log to DB
-            meta = {
-                "size": req.size,
-                "quality": req.quality,
-                "style": req.style,
-                "enhanced_prompt": enhanced_prompt,
-                "refs": all_ref_urls
-            }
-            db.log_image(
-                user_id=current_user['id'] if current_user else None,
-                filename=filename,
-                prompt=req.prompt,
-                subject=req.subject,
-                grade=req.grade,
-                metadata=meta
+@app.post("/api/generate/compare")
+async def generate_compare(
+    req: CompareGenRequest,
+    current_user: Optional[Dict] = Depends(get_current_user_optional),
+    x_model_key: Optional[str] = Header(None, alias="x-model-key"),
+    x_model_base_url: Optional[str] = Header(None, alias="x-model-base-url")
+):
+    """
+    同一提示词并发发给多个模型，按完成顺序以 NDJSON 逐行返回
+    每个成功的结果单独记录到图库并按该模型扣费；最后一行为汇总
+    """
+    models = list(dict.fromkeys(m for m in req.models if m))
+    if not models:
+        raise HTTPException(status_code=400, detail="No models specified")
+    if len(models) > MAX_COMPARE_MODELS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_COMPARE_MODELS} models per comparison")
+
+    # 额度按全部模型的总消耗预先检查
+    total_cost = sum(model_cost(m) for m in models)
+    mode, runtime_key, runtime_base_url = determine_execution_mode(current_user, x_model_key, cost=total_cost)
+    if runtime_base_url is None and x_model_base_url:
+        runtime_base_url = x_model_base_url
+
+    fields = req.dict(exclude={"models"})
+    started = time.time()
+
+    async def run_one(model: str) -> Dict:
+        try:
+            result = await run_single_generation(
+                SingleGenRequest(**fields, model=model), current_user, mode,
+                runtime_key, runtime_base_url, model_cost(model), name_tag=model
             )
-            
-            # Save JSON for backup/legacy compatibility
-            json_meta = meta.copy()
-            json_meta.update({
-                "prompt": req.prompt,
-                "subject": req.subject,
-                "grade": req.grade,
-                "timestamp": timestamp,
-                "featured": False,
-                "owner": current_user['username'] if current_user else "guest"
-            })
-            with open(os.path.join(GENERATED_DIR, f"{safe_prompt}_{timestamp}.json"), 'w', encoding='utf-8') as f:
-                json.dump(json_meta, f, ensure_ascii=False, indent=2)
-
-            # Return Updated Quota
-            remaining = 0
-            is_pro = False
-            if current_user:
-                updated_user = db.get_user_by_id(current_user['id'])
-                remaining = updated_user['quota_limit'] - updated_user['quota_used']
-                is_pro = bool(updated_user['is_pro'])
-            
-            return {
-                "success": True,
-                "url": f"/static/generated/{filename}",
-                "remaining_quota": max(0, remaining),
-                "is_pro": is_pro
-            }
-        else:
-            raise HTTPException(status_code=500, detail="Generation failed")
-    except HTTPException as he: raise he
-    except Exception as e: raise HTTPException(status_code=500, detail=str(e))
+            return {"model": model, **result, "elapsed": round(time.time() - started, 1)}
+        except HTTPException as he:
+            return {"model": model, "success": False, "status": he.status_code, "error": he.detail}
+        except AdmissionRejected as ar:
+            return {"model": model, "success": False, "status": 503, "error": str(ar), "retry_after": max(1, int(round(ar.retry_after)))}
+        except Exception as e:
+            return {"model": model, "success": False, "status": 500, "error": str(e)}
+
+    async def event_stream():
+        tasks = [asyncio.create_task(run_one(m)) for m in models]
+        succeeded = 0
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                item = await next_done
+                succeeded += 1 if item.get("success") else 0
+                yield json.dumps(item, ensure_ascii=False) + "\n"
+            yield json.dumps({
+                "done": True,
+                "succeeded": succeeded,
+                "failed": len(models) - succeeded,
+                "elapsed": round(time.time() - started, 1)
+            }) + "\n"
+        finally:
+            # 客户端断开时取消尚未完成的生成
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# 批量接口一次最多的条数
+MAX_BATCH_ITEMS = 50
+
+def charged_units(result: Dict, cost: int) -> int:
+    """一次成功生成实际消耗的额度 (命中缓存不扣，多张候选图按成功张数)"""
+    if result.get("cache_hit"):
+        return 0
+    return cost * len(result.get("urls") or [result["url"]])
+
+@app.post("/api/generate/batch")
+async def generate_batch(
+    req: BatchGenRequest,
+    current_user: Optional[Dict] = Depends(get_current_user_optional),
+    x_model_key: Optional[str] = Header(None, alias="x-model-key"),
+    x_model_base_url: Optional[str] = Header(None, alias="x-model-base-url")
+):
+    """
+    一次提交多条生成，并发执行，按完成顺序以 NDJSON 逐行返回 (index 为请求中的序号)，最后一行为汇总
+    使用系统额度时在开始前一次性预留全部额度，结束后退还未用掉的部分
+    """
+    items = req.items
+    if not items:
+        raise HTTPException(status_code=400, detail="No items specified")
+    if len(items) > MAX_BATCH_ITEMS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_ITEMS} items per batch")
+    for item in items:
+        check_variants(item)
+
+    costs = [model_cost(item.model or img_gen.model) for item in items]
+    total_cost = sum(cost * item.variants for cost, item in zip(costs, items))
+    mode, runtime_key, runtime_base_url = determine_execution_mode(current_user, x_model_key, cost=total_cost)
+    if runtime_base_url is None and x_model_base_url:
+        runtime_base_url = x_model_base_url
+
+    reserved = 0
+    if mode == "system" and current_user:
+        if not await run_in_threadpool(db.reserve_quota, current_user['id'], total_cost):
+            raise HTTPException(status_code=403, detail=f"Quota exceeded (Cost: {total_cost}). Please provide Custom API Key.")
+        reserved = total_cost
+        mode = "reserved"
+
+    batch_cfg = img_gen.config.get("batch", {})
+    concurrency = max(1, min(req.concurrency or int(batch_cfg.get("concurrency", 4)), MAX_BATCH_ITEMS))
+    semaphore = asyncio.Semaphore(concurrency)
+    started = time.time()
+    used = {"units": 0}
+
+    async def run_one(index: int, item: SingleGenRequest) -> Dict:
+        async with semaphore:
+            try:
+                # 批量结果直接落盘，不走快速返回
+                result = await run_single_generation(
+                    item.copy(update={"fast_return": False}), current_user, mode,
+                    runtime_key, runtime_base_url, costs[index], name_tag=f"b{index}"
+                )
+                used["units"] += charged_units(result, costs[index])
+                return {"index": index, **result, "elapsed": round(time.time() - started, 1)}
+            except HTTPException as he:
+                return {"index": index, "success": False, "status": he.status_code, "error": he.detail}
+            except AdmissionRejected as ar:
+                return {"index": index, "success": False, "status": 503, "error": str(ar), "retry_after": max(1, int(round(ar.retry_after)))}
+            except Exception as e:
+                return {"index": index, "success": False, "status": 500, "error": str(e)}
+
+    def settle() -> int:
+        """退还预留但未用掉的额度"""
+        refund = reserved - used["units"]
+        if refund > 0:
+            db.update_user_quota(current_user['id'], -refund)
+        return max(0, refund)
+
+    async def event_stream():
+        tasks = [asyncio.create_task(run_one(i, item)) for i, item in enumerate(items)]
+        succeeded = 0
+        settled = False
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                item = await next_done
+                succeeded += 1 if item.get("success") else 0
+                yield json.dumps(item, ensure_ascii=False) + "\n"
+            refunded = settle()
+            settled = True
+            remaining, _ = quota_status(current_user)
+            yield json.dumps({
+                "done": True,
+                "succeeded": succeeded,
+                "failed": len(items) - succeeded,
+                "reserved": reserved,
+                "charged": used["units"] if reserved else 0,
+                "refunded": refunded,
+                "remaining_quota": remaining,
+                "elapsed": round(time.time() - started, 1)
+            }) + "\n"
+        finally:
+            # 客户端断开时取消尚未完成的生成并退还额度
+            for task in tasks:
+                task.cancel()
+            if not settled:
+                await asyncio.gather(*tasks, return_exceptions=True)
+                settle()
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# --- 异步任务 (Job) ---
+
+async def run_single_generation_job(job: Dict, progress) -> Dict:
+    """任务队列 handler: 按提交时确定的执行模式运行单图生成流水线"""
+    ctx = job["context"]
+    current_user = db.get_user_by_id(job["user_id"]) if job["user_id"] else None
+    try:
+        return await run_single_generation_once(
+            SingleGenRequest(**job["request"]), current_user, ctx["mode"],
+            job["secrets"].get("api_key"), ctx.get("base_url"), ctx["cost"], progress=progress
+        )
+    except HTTPException as he:
+        raise JobError(he.detail)
+    except AdmissionRejected as ar:
+        raise JobError(str(ar))
+
+job_queue.register("generate_single", run_single_generation_job)
+
+async def run_persist_generation_job(job: Dict, progress) -> Dict:
+    """
+    后台落盘: 下载上游图片、生成缩略图、写入图库与结果缓存
+    可重复执行 (重启后重放): 已下载的文件与已入库的记录不会重复处理
+    """
+    r = job["request"]
+    path = os.path.join(GENERATED_DIR, r["filename"])
+
+    await progress("downloading")
+    if os.path.exists(path):
+        saved = await run_in_threadpool(describe_image, path)
+    else:
+        saved = await async_gen.download_image(r["image_url"], path, deadline=img_gen.deadline_for("generate"))
+    if not saved:
+        if r.get("charged") and job["user_id"]:
+            db.update_user_quota(job["user_id"], -r["charged"])
+            print(f"↩️ 后台下载失败，已退还 {r['charged']} 点额度")
+        raise JobError("下载上游图片失败")
+
+    await progress("thumbnail")
+    await run_in_threadpool(create_thumbnail, path)
+
+    await progress("saving")
+    if r.get("cache_key"):
+        await run_in_threadpool(result_cache.store, r["cache_key"], saved)
+    if not db.get_image_metadata(r["filename"]):
+        meta = dict(r["meta"], bytes=saved.size, sha256=saved.sha256)
+        save_generation_record(
+            job["user_id"], r["owner"], r["filename"], r["stem"],
+            r["prompt"], r["subject"], r["grade"], r["timestamp"], meta
+        )
+    return {"url": f"/static/generated/{r['filename']}"}
+
+persist_queue.register("persist_generation", run_persist_generation_job)
+
+@app.get("/api/pending/{persist_id}")
+async def get_pending_image(persist_id: str, token: str = ""):
+    """
+    快速返回的临时图片地址: 落盘完成后直接返回本地文件，之前代理上游图片
+    只在 deferred_persistence.proxy_ttl 秒内有效 (上游图片 URL 通常很快过期)；
+    须带上响应中签发的 token (<img> 请求无法携带 Authorization 头)
+    """
+    try:
+        claims = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        raise HTTPException(status_code=404, detail="Not found")
+    if claims.get("sub") != f"pending:{persist_id}":
+        raise HTTPException(status_code=404, detail="Not found")
+
+    job = await asyncio.to_thread(db.get_job, persist_id)
+    if not job or job["kind"] != "persist_generation":
+        raise HTTPException(status_code=404, detail="Not found")
+    r = job["request"]
+    path = os.path.join(GENERATED_DIR, r["filename"])
+    if os.path.exists(path):
+        return FileResponse(path)
+    if job["status"] == "failed" or time.time() - job["created_at"] > float(persistence_cfg.get("proxy_ttl", 900)):
+        raise HTTPException(status_code=410, detail="Pending image expired")
+
+    client = async_gen.http_pool.client_for(r["image_url"])
+    try:
+        upstream = await client.send(client.build_request("GET", r["image_url"], timeout=30), stream=True)
+    except httpx.HTTPError as e:
+        print(f"❌ 代理临时图片失败 {persist_id}: {e}")
+        raise HTTPException(status_code=502, detail="Upstream image unavailable")
+    if upstream.status_code != 200:
+        await upstream.aclose()
+        raise HTTPException(status_code=502, detail=f"Upstream image unavailable ({upstream.status_code})")
+
+    async def body():
+        try:
+            async for chunk in upstream.aiter_bytes(img_gen.download_chunk_size):
+                yield chunk
+        except httpx.HTTPError as e:
+            # 响应头已发出，只能提前结束响应体
+            print(f"❌ 代理临时图片中断 {persist_id}: {e}")
+        finally:
+            await upstream.aclose()
+
+    return StreamingResponse(
+        body(),
+        media_type=upstream.headers.get("content-type", "image/png"),
+        headers={"Cache-Control": "private, max-age=60"}
+    )
+
+@app.post("/api/jobs/generate")
+async def submit_generate_job(
+    req: SingleGenRequest,
+    current_user: Optional[Dict] = Depends(get_current_user_optional),
+    x_model_key: Optional[str] = Header(None, alias="x-model-key"),
+    x_model_base_url: Optional[str] = Header(None, alias="x-model-base-url")
+):
+    """
+    提交单图生成任务，立即返回 job_id
+    参数与 /api/generate/single 相同；额度在提交时检查，成功生成后扣除
+    """
+    check_variants(req)
+    request_model = req.model if req.model else img_gen.model
+    cost = model_cost(request_model)
+
+    mode, runtime_key, runtime_base_url = determine_execution_mode(current_user, x_model_key, cost=cost * req.variants)
+    if runtime_base_url is None and x_model_base_url:
+        runtime_base_url = x_model_base_url
+
+    job = await job_queue.submit(
+        "generate_single",
+        req.dict(),
+        user_id=current_user['id'] if current_user else None,
+        context={"mode": mode, "cost": cost, "base_url": runtime_base_url},
+        secrets={"api_key": runtime_key} if runtime_key else None
+    )
+    return {"success": True, "job_id": job["id"], "job": job}
+
+async def _get_visible_job(job_id: str, current_user: Optional[Dict]) -> Dict:
+    """任务只对提交者与管理员可见 (匿名 BYOK 任务凭 job_id 访问)"""
+    job = await job_queue.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job["user_id"] and not (current_user and (current_user['id'] == job["user_id"] or current_user['username'] == 'admin')):
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@app.get("/api/jobs/{job_id}")
+async def get_job(
+    job_id: str,
+    wait: float = 0,
+    since: float = 0,
+    current_user: Optional[Dict] = Depends(get_current_user_optional)
+):
+    """
+    查询任务状态
+    长轮询: wait > 0 时最多等待 wait 秒 (上限 60)，直到 updated_at 晚于 since
+    """
+    job = await _get_visible_job(job_id, current_user)
+    if wait > 0 and job["status"] not in ("succeeded", "failed"):
+        job = await job_queue.wait(job_id, since=since, timeout=min(wait, 60))
+    return job
+
+@app.get("/api/jobs/{job_id}/events")
+async def job_events(job_id: str, current_user: Optional[Dict] = Depends(get_current_user_optional)):
+    """以 Server-Sent Events 推送任务进度 (event: job)，任务结束后关闭"""
+    await _get_visible_job(job_id, current_user)
+
+    async def event_stream():
+        async for job in job_queue.watch(job_id):
+            if job is None:
+                yield ": keep-alive\n\n"
+                continue
+            yield f"event: job\ndata: {json.dumps(job, ensure_ascii=False)}\n\n"
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 @app.post("/api/generate/modify")
 async def generate_modify(
@@ -496,7 +1206,7 @@ async def generate_modify(
 ):
     try:
         # Determine Cost (Modify uses system default model)
-        cost = 2 if "gemini" in img_gen.model.lower() else 1
+        cost = model_cost(img_gen.model)
         
         mode, runtime_key, runtime_base_url = determine_execution_mode(current_user, x_model_key, cost=cost)
         if runtime_base_url is None and x_model_base_url: runtime_base_url = x_model_base_url
@@ -513,43 +1223,48 @@ async def generate_modify(
         safe_prompt = sanitize_filename(req.prompt)
         new_filename = f"modified_{safe_prompt}_{timestamp}.png"
         
-        image_url = img_gen.generate_modified_image(
-            req.prompt, [original_path], base_url=runtime_base_url, api_key=runtime_key, model=img_gen.model
+        deadline = img_gen.deadline_for("modify")
+        save_path = os.path.join(GENERATED_DIR, new_filename)
+        saved = await async_gen.modify_to_file(
+            req.prompt, [original_path], save_path, base_url=runtime_base_url, api_key=runtime_key, model=img_gen.model,
+            deadline=deadline, client=admission_client(current_user, runtime_key)
         )
         
-        if image_url:
-            save_path = os.path.join(GENERATED_DIR, new_filename)
-            if img_gen.download_image(image_url, save_path):
-                create_thumbnail(save_path)
-                
-                if mode == "system" and current_user:
-                    db.update_user_quota(current_user['id'], cost)
-                
-                # Try to inherit metadata
-                parent_meta = db.get_image_metadata(filename)
-                subject = parent_meta['subject'] if parent_meta else 'general'
-                grade = parent_meta['grade'] if parent_meta else 'general'
-
-                db.log_image(
-                    user_id=current_user['id'] if current_user else None,
-                    filename=new_filename,
-                    prompt=req.prompt,
-                    subject=subject,
-                    grade=grade,
-                    metadata={"parent": filename, "type": "modification"}
-                )
+        if saved:
+            await run_in_threadpool(create_thumbnail, save_path)
+            
+            if mode == "system" and current_user:
+                db.update_user_quota(current_user['id'], cost)
+            
+            # Try to inherit metadata
+            parent_meta = db.get_image_metadata(filename)
+            subject = parent_meta['subject'] if parent_meta else 'general'
+            grade = parent_meta['grade'] if parent_meta else 'general'
 
-                remaining = 0
-                if current_user:
-                    updated_user = db.get_user_by_id(current_user['id'])
-                    remaining = updated_user['quota_limit'] - updated_user['quota_used']
+            db.log_image(
+                user_id=current_user['id'] if current_user else None,
+                filename=new_filename,
+                prompt=req.prompt,
+                subject=subject,
+                grade=grade,
+                metadata={"parent": filename, "type": "modification", "bytes": saved.size, "sha256": saved.sha256}
+            )
 
-                return {
-                    "success": True,
-                    "url": f"/static/generated/{new_filename}",
-                    "remaining_quota": max(0, remaining)
-                }
+            remaining = 0
+            if current_user:
+                updated_user = db.get_user_by_id(current_user['id'])
+                remaining = updated_user['quota_limit'] - updated_user['quota_used']
+
+            return {
+                "success": True,
+                "url": f"/static/generated/{new_filename}",
+                "remaining_quota": max(0, remaining)
+            }
+        if deadline.expired():
+            raise HTTPException(status_code=504, detail="Modification timed out")
         raise HTTPException(status_code=500, detail="Modification failed")
+    except HTTPException as he: raise he
+    except AdmissionRejected as ar: raise admission_error(ar)
     except Exception as e: raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/gallery")
@@ -702,6 +1417,64 @@ async def update_user(req: UserUpdateRequest, current_user: Dict = Depends(get_c
     db.update_user_status(req.user_id, req.is_pro, req.quota_limit)
     return {"success": True}
 
+@app.get("/api/admin/keys")
+async def get_key_health(current_user: Dict = Depends(get_current_user)):
+    """系统 Key 的调度、熔断与限速状态"""
+    if current_user['username'] != 'admin':
+        raise HTTPException(status_code=403, detail="Admin only")
+    return {"keys": img_gen.key_scheduler.snapshot(), "rate": img_gen.key_rate.snapshot()}
+
+@app.get("/api/admin/routes")
+async def get_route_health(current_user: Dict = Depends(get_current_user)):
+    """路由表中各上游的延迟、错误率与在线状态"""
+    if current_user['username'] != 'admin':
+        raise HTTPException(status_code=403, detail="Admin only")
+    return {"routes": img_gen.router.snapshot()}
+
+@app.get("/api/admin/admission")
+async def get_admission_stats(current_user: Dict = Depends(get_current_user)):
+    """各上游通道的在途数、排队深度与预计等待时间，以及重复请求合并情况"""
+    if current_user['username'] != 'admin':
+        raise HTTPException(status_code=403, detail="Admin only")
+    return {"lanes": img_gen.admission.snapshot(), "single_flight": single_flight.stats()}
+
+@app.get("/api/admin/latency")
+async def get_latency_stats(current_user: Dict = Depends(get_current_user)):
+    """各模型的生成耗时分位数与对冲请求统计"""
+    if current_user['username'] != 'admin':
+        raise HTTPException(status_code=403, detail="Admin only")
+    return {"enabled": img_gen.hedging.enabled, "models": img_gen.hedging.snapshot()}
+
+@app.get("/api/admin/result_cache")
+async def get_result_cache_stats(current_user: Dict = Depends(get_current_user)):
+    """生成结果缓存的条目数与命中率"""
+    if current_user['username'] != 'admin':
+        raise HTTPException(status_code=403, detail="Admin only")
+    return await run_in_threadpool(result_cache.stats)
+
+@app.post("/api/admin/result_cache/purge")
+async def purge_result_cache(current_user: Dict = Depends(get_current_user)):
+    """清空生成结果缓存 (只删除索引，不删除图片文件)"""
+    if current_user['username'] != 'admin':
+        raise HTTPException(status_code=403, detail="Admin only")
+    deleted = await run_in_threadpool(result_cache.purge)
+    return {"success": True, "deleted": deleted}
+
+@app.get("/api/admin/optimize_cache")
+async def get_optimize_cache_stats(current_user: Dict = Depends(get_current_user)):
+    """Magic Optimize 缓存命中统计"""
+    if current_user['username'] != 'admin':
+        raise HTTPException(status_code=403, detail="Admin only")
+    return await run_in_threadpool(img_gen.prompt_cache.stats)
+
+@app.post("/api/admin/optimize_cache/purge")
+async def purge_optimize_cache(current_user: Dict = Depends(get_current_user)):
+    """清空 Magic Optimize 缓存 (修改优化模板或发现错误结果后使用)"""
+    if current_user['username'] != 'admin':
+        raise HTTPException(status_code=403, detail="Admin only")
+    deleted = await run_in_threadpool(img_gen.prompt_cache.purge)
+    return {"success": True, "deleted": deleted}
+
 @app.post("/api/optimize_prompt")
 async def optimize_prompt_endpoint(
     req: OptimizePromptRequest,
@@ -713,10 +1486,48 @@ async def optimize_prompt_endpoint(
         if not current_user and not x_model_key:
              raise HTTPException(status_code=403, detail="Login required or provide x-model-key header.")
         
-        optimized = img_gen.optimize_prompt(req.prompt, subject=req.subject, model=req.model)
+        optimized = await async_gen.optimize_prompt(
+            req.prompt, subject=req.subject, model=req.model, deadline=img_gen.deadline_for("optimize"),
+            client=admission_client(current_user, x_model_key)
+        )
         return {"success": True, "optimized_prompt": optimized}
+    except HTTPException as he: raise he
+    except AdmissionRejected as ar: raise admission_error(ar)
     except Exception as e: raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/api/optimize_prompt/stream")
+async def optimize_prompt_stream_endpoint(
+    req: OptimizePromptRequest,
+    current_user: Optional[Dict] = Depends(get_current_user_optional),
+    x_model_key: Optional[str] = Header(None, alias="x-model-key")
+):
+    """
+    流式 Magic Optimize (Server-Sent Events)
+    event: delta -> {"text": 片段}；event: done -> {"optimized_prompt": 最终结果}
+    """
+    if not current_user and not x_model_key:
+        raise HTTPException(status_code=403, detail="Login required or provide x-model-key header.")
+
+    async def event_stream():
+        try:
+            async for kind, text in async_gen.optimize_prompt_stream(
+                req.prompt, subject=req.subject, model=req.model, deadline=img_gen.deadline_for("optimize"),
+                client=admission_client(current_user, x_model_key)
+            ):
+                field = "text" if kind == "delta" else "optimized_prompt"
+                yield f"event: {kind}\ndata: {json.dumps({field: text}, ensure_ascii=False)}\n\n"
+        except AdmissionRejected as ar:
+            payload = {"detail": str(ar), "retry_after": max(1, int(round(ar.retry_after)))}
+            yield f"event: error\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+        except Exception as e:
+            yield f"event: error\ndata: {json.dumps({'detail': str(e)}, ensure_ascii=False)}\n\n"
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.post("/api/upload")
 async def upload_file(file: UploadFile = File(...)):
     try:
@@ -782,12 +1593,24 @@ async def startup_event():
     # Scan thumbnails
     import threading
     threading.Thread(target=scan_and_sync_db, daemon=True).start()
+    # 预热上游连接 (config.json -> http.prewarm_connections)
+    asyncio.create_task(async_gen.prewarm_connections())
+    # 启动任务队列并恢复上次未完成的任务
+    await job_queue.start()
+    await persist_queue.start()
     
     # Ensure default admin user exists
     if not db.get_user_by_username("admin"):
         db.create_user("admin", get_password_hash(ADMIN_PASSWORD), is_pro=True)
         print("👤 Default admin user created (password: admin888)")
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    await job_queue.stop()
+    await persist_queue.stop()
+    await async_gen.aclose()
+    img_gen.http_pool.close()
+
 # --- Frontend Static Serving ---
 if getattr(sys, 'frozen', False):
     FRONTEND_DIST_DIR = os.path.join(BUNDLE_DIR, "dist")